@@ -4,6 +4,7 @@ import sys
 import glob
 import shutil
 import tempfile
+import multiprocessing
 
 if hasattr(sys, "frozen"):
 	# py2exe may get paths wrong
@@ -244,5 +245,7 @@ def main():
 		app.MainLoop()
 
 if __name__ == '__main__':
+	# the search index workers need this under py2exe
+	multiprocessing.freeze_support()
 	main()
 
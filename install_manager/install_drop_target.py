@@ -5,6 +5,8 @@ from install_manager.install_module import ModuleInstallDialog
 from install_manager import zipinstaller
 import traceback
 from util.unicode import to_unicode, to_str
+from search import index
+from search.index_builder import index_builder
 
 class ModuleDropTarget(wx.FileDropTarget):
 	def __init__(self, window):
@@ -96,3 +98,39 @@ class ModuleDropTarget(wx.FileDropTarget):
 				p.Destroy()			
 		
 		biblemgr.set_new_paths(path_changed=to_str(dest_dir))
+
+# the Bibles there were before the modules were last reloaded
+_bibles_before_reload = None
+
+def remember_bibles(biblemgr):
+	global _bibles_before_reload
+	_bibles_before_reload = set(biblemgr.bible.GetModuleList())
+
+def find_new_bibles(biblemgr):
+	"""After the modules have been reloaded (e.g. books have been installed,
+	or a path with books in it added), offer to index the new Bibles"""
+	global _bibles_before_reload
+	if _bibles_before_reload is None:
+		return
+
+	bibles = [
+		name for name in biblemgr.bible.GetModuleList()
+		if name not in _bibles_before_reload and not index.IndexExists(name)
+	]
+	_bibles_before_reload = None
+
+	if bibles:
+		# after the rest of the program has caught up with the reload
+		wx.CallAfter(offer_to_index, bibles)
+
+def offer_to_index(bibles):
+	"""Offer to index the given Bibles, so they can be searched straight
+	away. This happens in the background."""
+	if wx.MessageBox(
+		_("Create search indexes for the new Bibles now? They will be "
+		"created in the background."), 
+		_("Create Indexes?"), wx.YES_NO) == wx.YES:
+		index_builder.build_all(bibles, index.Index)
+
+biblemgr.on_before_reload += remember_bibles
+biblemgr.on_after_reload += find_new_bibles
@@ -0,0 +1,100 @@
+"""Shows how the matches of a search are spread over the books of an index,
+and over the chapters of each book, as a histogram. The counts come from
+a search with the COUNT type, so they are there straight away even when
+there are a lot of matches."""
+import wx
+
+from util.unicode import to_str
+from search import index
+
+class Histogram(wx.ScrolledWindow):
+	"""A bar for each of a list of (label, count), one under the other"""
+	def __init__(self, parent):
+		super(Histogram, self).__init__(parent, style=wx.SUNKEN_BORDER)
+		self.SetBackgroundColour(wx.SystemSettings.GetColour(wx.SYS_COLOUR_WINDOW))
+		self.bars = []
+		self.Bind(wx.EVT_PAINT, self.on_paint)
+		self.Bind(wx.EVT_SIZE, lambda event: (event.Skip(), self.Refresh()))
+
+	def set_bars(self, bars):
+		self.bars = bars
+		dc = wx.ClientDC(self)
+		dc.Font = self.Font
+		self.row_height = dc.GetTextExtent("0")[1] + 6
+		self.SetScrollRate(0, self.row_height)
+		self.SetVirtualSize((-1, self.row_height * len(bars)))
+		self.Scroll(0, 0)
+		self.Refresh()
+
+	def on_paint(self, event):
+		dc = wx.PaintDC(self)
+		self.PrepareDC(dc)
+		if not self.bars:
+			return
+
+		dc.Font = self.Font
+		dc.TextForeground = self.ForegroundColour
+		label_width = max(dc.GetTextExtent(label)[0]
+			for label, count in self.bars) + 12
+		count_width = max(dc.GetTextExtent(str(count))[0]
+			for label, count in self.bars) + 12
+
+		most = max(count for label, count in self.bars)
+		bar_room = max(self.ClientSize[0] - label_width - count_width, 1)
+
+		dc.Pen = wx.TRANSPARENT_PEN
+		dc.Brush = wx.Brush(
+			wx.SystemSettings.GetColour(wx.SYS_COLOUR_HIGHLIGHT))
+
+		for row, (label, count) in enumerate(self.bars):
+			y = row * self.row_height
+			dc.DrawText(label, 6, y + 3)
+			width = max(bar_room * count / most, 1)
+			dc.DrawRectangle(label_width, y + 3, width, self.row_height - 6)
+			dc.DrawText(str(count), label_width + width + 6, y + 3)
+
+class DistributionDialog(wx.Dialog):
+	"""Shows the counts of a search (as Index.Search gives them with COUNT)
+	for all the books, or for the chapters of one of them"""
+	def __init__(self, parent, search_index, counts, title):
+		super(DistributionDialog, self).__init__(parent, title=title,
+			style=wx.DEFAULT_DIALOG_STYLE|wx.RESIZE_BORDER)
+
+		self.books = [
+			(index.bookname_ui(to_str(search_index.books[number].bookname)),
+				book_counts)
+			for number, book_counts in counts if book_counts
+		]
+
+		self.choice = wx.Choice(self, choices=[_("All books")] +
+			[bookname for bookname, book_counts in self.books])
+		self.choice.Selection = 0
+		self.choice.Bind(wx.EVT_CHOICE, self.on_choice)
+
+		self.histogram = Histogram(self)
+
+		sizer = wx.BoxSizer(wx.VERTICAL)
+		sizer.Add(self.choice, 0, wx.GROW|wx.ALL, 6)
+		sizer.Add(self.histogram, 1, wx.GROW|wx.LEFT|wx.RIGHT, 6)
+		sizer.Add(self.CreateStdDialogButtonSizer(wx.OK), 0, wx.GROW|wx.ALL, 6)
+		self.SetSizer(sizer)
+		self.Size = 450, 500
+
+		self.on_choice()
+
+	def on_choice(self, event=None):
+		selection = self.choice.Selection
+		if selection == 0:
+			bars = [
+				(bookname, sum(count for group, count in book_counts))
+				for bookname, book_counts in self.books
+			]
+		else:
+			# books without chapters have their matches counted under None
+			bookname, book_counts = self.books[selection - 1]
+			bars = [
+				(group is None and bookname or _("Chapter %d") % group, count)
+				for group, count in book_counts
+			]
+
+		self.histogram.set_bars(bars)
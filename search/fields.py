@@ -7,6 +7,10 @@ from util.debug import dprint, WARNING
 class BaseField(object):
 	field_name = None
 
+	# whether the values of this field are space separated tokens, which are
+	# searched for on their own. These fields get postings built for them.
+	tokenized = False
+
 	def __init__(self):
 		self.matches = []
 	
@@ -33,6 +37,7 @@ class BaseField(object):
 
 class StrongsField(BaseField):
 	field_name = "strongs"
+	tokenized = True
 
 	@classmethod	
 	def prepare(cls, input):
@@ -1,4 +1,5 @@
 import re
+import sys
 import unicodedata
 
 import wx
@@ -6,12 +7,14 @@ from backend.verse_template import VerseTemplate
 from backend.book import Bible
 from util.string_util import KillTags, ReplaceUnicode, replace_amp, htmlify_unicode, remove_amps
 from util.debug import dprint, ERROR, WARNING
+from util.lru_cache import LRUCache
+from util.unicode import to_str, to_unicode
 
 from search.query_parser import removeformatting
 
 from backend.bibleinterface import biblemgr
 from gui.reference_display_frame import ReferenceDisplayFrame
-from swlib.pysw import SW, VerseList
+from swlib.pysw import SW, VerseList, GetBestRange, TOP
 import guiconfig
 
 #TODO: highlight Aenon - AE joined up, that is - in KJV
@@ -246,17 +249,159 @@ def highlight_section(results, start, end, start_tag, end_tag):
 		last_upto = upto
 		
 
+def strongs_highlighter(value):
+	"""Make a function to highlight links to the strong's number value"""
+	match = re.match("([GH])(\d+)(\w?)", value.upper())
+	if not match:
+		return None
+	prefix, number, extra = match.group(1, 2, 3)
+	lang = ["Hebrew", "Greek"][prefix=="G"]
+	number = str(int(number))
+	if extra:
+		number += "!%s" % extra
+
+	href = r"strongs://%s/0*%s(?:!\w)?" % (lang, number)
+	link_matcher = re.compile(
+		'^<a([^>]*)(href="%s")([^>]*)>([^<]*)</a>$' % href
+	)
+
+	def highlight_strongs(results):
+		for tokens in results:
+			for idx, token in enumerate(tokens):
+				# highlight strong's numbers...
+				tokens[idx] = link_matcher.sub(
+					r'<a name="highlight"></a><span class="search_highlight"><a \1\2\3>\4</a></span>',
+					token)
+
+	return highlight_strongs
+
+def morph_highlighter(value):
+	"""Make a function to highlight the morphology value"""
+	parts = value.split(":", 1)
+	if len(parts) != 2:
+		dprint(WARNING, "Not two parts in split. Skipping")
+		return None
+
+	k, v = parts
+	if k == "Robinson":
+		k = "(?:Robinson|Greek)"
+
+	k = '%s:%s' % (k, v)
+	k = SW.URL.encode(str(k)).c_str()
+	v = SW.URL.encode(str(v)).c_str()
+
+	d = r'^(<a class="morph" href="morph://%s/%s">)([^<]*)(</a>)$' % (k, v)
+
+	morph_matcher = re.compile(d)
+	def highlight_morph(results):
+		count = 0
+		for tokens in results:
+			for idx, token in enumerate(tokens):
+				tokens[idx], c = morph_matcher.subn(
+					r'<a name="highlight"></a><span class="search_highlight">\1\2\3</span>',
+					token
+				)
+				count += c
+
+		if count == 0:
+			dprint(WARNING, "Didn't highlight morph - are they on?", value)
+
+	return highlight_morph
+
+def ref_highlighter(value, is_bible):
+	"""Make a function to highlight cross references to the verses in
+	value"""
+	if is_bible:
+		ref = re.compile(
+			r'^(<a href="bible:([^#]*)(#.*)?">)(.*?)(</a>)$'
+		)
+	else:
+		# if we aren't in the bible, the start and end will be in
+		# different tokens. So match start and then end
+		ref = re.compile(
+			r'^(<a href="bible:([^#]*)(#.*)?">)|(</a>)$'
+		)
+
+	v = VerseList(value, userInput=True)
+	def highlight_refs(results):
+		in_ref = [False]
+		def subst(match):
+			if (is_bible or match.group(1)):
+				if match.group(2).startswith("%3F"):
+					url = SW.URL("bible:" +
+					SW.URL.decode(str(match.group(2))).c_str())
+					values = url.getParameterValue("values")
+					references = VerseList([
+						url.getParameterValue("val%s" % value)
+						for value in range(int(values))
+					])
+				else:
+					reference_text = SW.URL.decode(str(match.group(2))).c_str()
+					references = VerseList(reference_text)
+			else:
+				# our closing </a>?
+				if not is_bible and in_ref[0] and match.group(4):
+					in_ref[0] = False
+					return "</span>%s" % match.group(4)
+
+				return match.group(0)
+
+			for item in v:
+				for i in item:
+					if references.VerseInRange(i):
+						if is_bible:
+							# wrap the contents of the <a> in formatting
+							return '%s<a name="highlight"></a><span class="search_highlight">%s</span>%s' % match.group(1, 4, 5)
+						else:
+							# start the formatting, to be completed with
+							# the </a> tag handling above
+							in_ref[0] = True
+							return '%s<a name="highlight"></a><span class="search_highlight">' % \
+								match.group(1)
+
+			return match.group(0)
+
+		for tokens in results:
+			for idx, token in enumerate(tokens):
+				tokens[idx] = ref.sub(subst, token)
+
+	return highlight_refs
+
+def compile_fields(fields, is_bible):
+	"""Make the functions which highlight each of the fields in the results
+	of unite. They can be shared between highlighting many texts."""
+	highlighters = []
+	for key, value in fields:
+		if key == "strongs":
+			highlighter = strongs_highlighter(value)
+		elif key == "morph":
+			highlighter = morph_highlighter(value)
+		elif key == "ref":
+			highlighter = ref_highlighter(value, is_bible)
+		else:
+			continue
+
+		if highlighter is not None:
+			highlighters.append(highlighter)
+
+	return highlighters
+
 def highlight(string1, string2, is_bible, regexes, fields=(),
 		start_tag='<a name="highlight"></a><span class="search_highlight">',
-		end_tag='</span>'):
+		end_tag='</span>', results=None, field_highlighters=None):
 	"""Highlight string2 with the regular expressions regexes, being matched
 	on string1
 
 	string1 should be text processed through striptext
 	string2 should be the same text, but with extra rendering niceties
 	start_tag and end_tag give the tags for the start and end of highlighting
+	results is what unite gives for string1 and string2, if it has been
+	worked out already. It is changed by highlighting.
+	field_highlighters are what compile_fields gives for fields, if they
+	have been made already.
 	"""
-	results = unite(string1, string2, is_bible)
+	if results is None:
+		results = unite(string1, string2, is_bible)
 	
 	# if we couldn't process it, return string2 intact
 	if not results:
@@ -273,111 +418,11 @@ def highlight(string1, string2, is_bible, regexes, fields=(),
 			dprint(ERROR, "Regular expression not matched against plain text",
 				regex.pattern, string1)
 	
-	for key, value in fields:
-		if key == "strongs":
-			match = re.match("([GH])(\d+)(\w?)", value.upper())
-			if not match:
-				continue
-			prefix, number, extra = match.group(1, 2, 3)
-			lang = ["Hebrew", "Greek"][prefix=="G"]
-			number = str(int(number))
-			if extra:
-				number += "!%s" % extra
-
-			href = r"strongs://%s/0*%s(?:!\w)?" % (lang, number)
-			link_matcher = re.compile(
-				'^<a([^>]*)(href="%s")([^>]*)>([^<]*)</a>$' % href
-			)
-
-			for tokens in results:
-				for idx, token in enumerate(tokens):
-					# highlight strong's numbers...
-					tokens[idx] = link_matcher.sub(
-						r'<a name="highlight"></a><span class="search_highlight"><a \1\2\3>\4</a></span>',
-						token)
+	if field_highlighters is None:
+		field_highlighters = compile_fields(fields, is_bible)
 
-		elif key == "morph":
-			parts = value.split(":", 1)
-			if len(parts) != 2:
-				dprint(WARNING, "Not two parts in split. Skipping")
-				continue
-
-			k, v = parts
-			if k == "Robinson":
-				k = "(?:Robinson|Greek)"
-
-			k = '%s:%s' % (k, v)
-			k = SW.URL.encode(str(k)).c_str()
-			v = SW.URL.encode(str(v)).c_str()
-
-			d = r'^(<a class="morph" href="morph://%s/%s">)([^<]*)(</a>)$' % (k, v)
-
-			count = 0
-			morph_matcher = re.compile(d)
-			for tokens in results:
-				for idx, token in enumerate(tokens):
-					tokens[idx], c = morph_matcher.subn(
-						r'<a name="highlight"></a><span class="search_highlight">\1\2\3</span>',
-						token
-					)
-					count += c
-
-			if count == 0:
-				dprint(WARNING, "Didn't highlight morph - are they on?", value)
-
-		elif key == "ref":
-			if is_bible:
-				ref = re.compile(
-					r'^(<a href="bible:([^#]*)(#.*)?">)(.*?)(</a>)$'
-				)
-			else:
-				# if we aren't in the bible, the start and end will be in
-				# different tokens. So match start and then end
-				ref = re.compile(
-					r'^(<a href="bible:([^#]*)(#.*)?">)|(</a>)$'
-				)
-
-			v = VerseList(value, userInput=True)
-			in_ref = [False]
-			def subst(match):
-				if (is_bible or match.group(1)):
-					if match.group(2).startswith("%3F"):
-						url = SW.URL("bible:" +
-						SW.URL.decode(str(match.group(2))).c_str())
-						values = url.getParameterValue("values")
-						references = VerseList([
-							url.getParameterValue("val%s" % value)
-							for value in range(int(values))
-						])
-					else:
-						reference_text = SW.URL.decode(str(match.group(2))).c_str()
-						references = VerseList(reference_text)
-				else:
-					# our closing </a>?
-					if not is_bible and in_ref[0] and match.group(4):
-						in_ref[0] = False
-						return "</span>%s" % match.group(4)
-
-					return match.group(0)
-
-				for item in v:
-					for i in item:
-						if references.VerseInRange(i):
-							if is_bible:
-								# wrap the contents of the <a> in formatting
-								return '%s<a name="highlight"></a><span class="search_highlight">%s</span>%s' % match.group(1, 4, 5)
-							else:
-								# start the formatting, to be completed with
-								# the </a> tag handling above
-								in_ref[0] = True
-								return '%s<a name="highlight"></a><span class="search_highlight">' % \
-									match.group(1)
-
-				return match.group(0)
-
-			for tokens in results:
-				for idx, token in enumerate(tokens):
-					tokens[idx] = ref.sub(subst, token)
+	for highlight_field in field_highlighters:
+		highlight_field(results)
 	
 	replacements = {
 		'<' : '&lt;',
@@ -394,6 +439,174 @@ def highlight(string1, string2, is_bible, regexes, fields=(),
 
 	return htmlify_unicode(''.join(''.join(x) for x in results))
 	
+def prepare_plain_text(content):
+	"""Turn the stripped text of a reference into the plain text which the
+	search regular expressions are matched against"""
+	#TODO: highlight with \n's properly
+	# e.g. /word\nanother/
+
+	# remove non-canonical headings
+	content = re.sub('(<h2 class="heading">.*?</h2>)',
+					 '', content)	
+
+	content = remove_amps(KillTags(ReplaceUnicode(content)))
+	content = content.replace("\n", " ")
+	return removeformatting(content)
+
+def render_verses(book, verselist, template, stripped=False):
+	"""Render all the verses of verselist with template in one pass, returning
+	a dictionary of internal reference -> text"""
+	description = to_unicode(book.mod.Description(), book.mod)
+	verses = {}
+	for body_dict, headings in book.GetReference_yield(verselist,
+			max_verses=sys.maxint, stripped=stripped, display_tags=False):
+		body_dict.update(
+			range=body_dict["reference"],
+			internal_range=body_dict["internal_reference"],
+			version=book.mod.Name(),
+			description=description,
+		)
+
+		verse = template.preverse.safe_substitute(body_dict)
+		for heading_dict in headings:
+			verse += template.headings.safe_substitute(heading_dict)
+
+		verse += template.body.safe_substitute(body_dict)
+		verses[body_dict["internal_reference"]] = verse
+
+	return verses
+
+def highlight_results(book, references, regexes, fields=(), template=None):
+	"""Highlight many search results in a bible at once (e.g. to show, print
+	or export all of them), returning them as one HTML document.
+
+	references are the results as text, e.g. "Genesis 1:1 - Genesis 1:3".
+	The verses of all of them are rendered in one pass through
+	GetReference_yield (and another for their plain text), rather than a
+	pass for each, and the field highlighting is only set up once. Tags
+	aren't shown."""
+	if template is None:
+		template = book.templatelist[-1]
+
+	is_bible = book.mod.Type() == Bible.type
+	verselist = book.vk.ParseVerseList(to_str(u"; ".join(references)),
+		"", True)
+
+	rendered = render_verses(book, verselist, template)
+	end_of_render = book.end_of_render
+
+	biblemgr.temporary_state(biblemgr.plainstate)
+	try:
+		plain = render_verses(book, verselist, VerseTemplate(u"$text "),
+			stripped=True)
+	finally:
+		biblemgr.restore_state()
+
+	field_highlighters = compile_fields(fields, is_bible)
+
+	text = []
+	for reference in references:
+		keys = []
+		result_verses = book.vk.ParseVerseList(to_str(reference), "", True)
+		result_verses.setPosition(TOP)
+		while not ord(result_verses.Error()):
+			keys.append(result_verses.getText())
+			result_verses.increment(1)
+
+		data = template.finalize(
+			u"".join(rendered.get(key, u"") for key in keys)
+		)
+		content = prepare_plain_text(
+			u"".join(plain.get(key, u"") for key in keys)
+		)
+
+		data = highlight(content, data, is_bible, regexes,
+			field_highlighters=field_highlighters)
+		data = data.replace("<!P>","</p><p>")
+
+		text.append(u'<div class="search_result"><h4>%s</h4>%s</div>' % (
+			GetBestRange(reference, userOutput=True), data))
+
+	return u"<html><body>%s%s</body></html>" % (u"".join(text),
+		end_of_render)
+
+# how many verses to keep the rendered text, plain text and their alignment
+# of, so that going back and forth through search results doesn't render
+# them or work them out again
+ALIGNMENT_CACHE_SIZE = 100
+
+# (version, reference, end reference, template, render options) ->
+# (rendered text, plain text, unite results)
+alignment_cache = LRUCache(ALIGNMENT_CACHE_SIZE)
+
+def forget_alignments(*args):
+	"""Forget the cached alignments, as the rendering may have changed"""
+	alignment_cache.clear()
+
+# the modules may have changed
+biblemgr.on_after_reload += forget_alignments
+
+def template_key(template):
+	"""Get something which tells templates apart by what they render"""
+	if template is None:
+		return None
+
+	parts = [type(template).__name__]
+	for name in ("header", "body", "footer", "headings", "preverse"):
+		part = getattr(template, name, None)
+
+		# a SmartBody wraps its template
+		part = getattr(part, "body", part)
+		parts.append(getattr(part, "template", part))
+
+	return tuple(parts)
+
+def render_reference(book, reference, end_reference, template):
+	"""Render the text of a reference for showing highlighted"""
+	if template:
+		book.templatelist.append(template)
+
+	try:
+		return book.GetReference(reference, end_ref=end_reference)
+	finally:
+		if template:
+			book.templatelist.pop()
+
+def get_plain_text(book, reference, end_reference):
+	"""Get the text of the reference as it was indexed, to match the
+	search on"""
+	# TODO: put a function in search to do this for us...
+	biblemgr.temporary_state(biblemgr.plainstate)
+	template = VerseTemplate(u"$text ")#, headings=u"")
+	book.templatelist.append(template)
+	try:
+		content = book.GetReference(reference, stripped=True,
+				end_ref=end_reference)
+	finally:
+		biblemgr.restore_state()
+		book.templatelist.pop()
+
+	return prepare_plain_text(content)
+
+def get_alignment(book, reference, end_reference, template, is_bible):
+	"""Get the rendered text of the reference, its plain text and how they
+	line up (as given by unite). These are cached, as they are slow to work
+	out, by what the rendering depends on."""
+	key = (book.version, reference, end_reference, template_key(template),
+		tuple(sorted(biblemgr.save_state().items())))
+	cached = alignment_cache.get(key)
+	if cached is None:
+		data = render_reference(book, reference, end_reference, template)
+		content = get_plain_text(book, reference, end_reference)
+		results = unite(content, data, is_bible)
+		cached = data, content, tuple(tuple(tokens) for tokens in results)
+		alignment_cache[key] = cached
+
+	data, content, results = cached
+
+	# highlighting changes them
+	return data, content, [list(tokens) for tokens in results]
+
 class HighlightedDisplayFrame(ReferenceDisplayFrame):
 	def __init__(self):
 		self.regexes = []
@@ -417,41 +630,14 @@ class HighlightedDisplayFrame(ReferenceDisplayFrame):
 		if ref_parts:
 			end_reference = ref_parts[0]
 
-		if self.parent.template:
-			self.parent.book.templatelist.append(self.parent.template)
-
-		data = self.parent.book.GetReference(
-			reference,
-			end_ref=end_reference)
-
-		if self.parent.template:
-			self.parent.book.templatelist.pop()
-
-		# TODO: put a function in search to do this for us...
-		biblemgr.temporary_state(biblemgr.plainstate)
-		template = VerseTemplate(u"$text ")#, headings=u"")
-		self.parent.book.templatelist.append(template)
-		
-		
-		content = self.parent.book.GetReference(reference, stripped=True,
-				end_ref=end_reference)
-		biblemgr.restore_state()
-		self.parent.book.templatelist.pop()
-
-		#TODO: highlight with \n's properly
-		# e.g. /word\nanother/
-
-		# remove non-canonical headings
-		content = re.sub('(<h2 class="heading">.*?</h2>)',
-						 '', content)	
-
-		content = remove_amps(KillTags(ReplaceUnicode(content)))
-		content = content.replace("\n", " ")
-		content = removeformatting(content)
+		is_bible = self.parent.book.mod.Type() == Bible.type
+		data, content, results = get_alignment(self.parent.book, reference,
+			end_reference, self.parent.template, is_bible)
 
 		data = highlight(content, data,
-			is_bible=self.parent.book.mod.Type() == Bible.type,
+			is_bible=is_bible,
 			regexes=self.regexes, fields=self.fields,
+			results=results,
 			)
 		
 		# XXX: This replace should be done for us by the backend Bible
@@ -471,6 +657,13 @@ class HighlightedDisplayFrame(ReferenceDisplayFrame):
 			}
 		""")
 	
+	def RefreshUI(self, event=None):
+		if event is None or event.settings_changed:
+			# the text may be rendered differently now
+			forget_alignments()
+
+		super(HighlightedDisplayFrame, self).RefreshUI(event)
+
 	def get_frame_for_search(self):
 		for item in guiconfig.mainfrm.frames:
 			if item.book == self.book:
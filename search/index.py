@@ -7,13 +7,30 @@ import util
 from swlib.pysw import SW
 from swlib import pysw
 import re
+import sys
+import math
+import heapq
+import multiprocessing
 from util.debug import *
+from util.lru_cache import LRUCache
+from util.unicode import to_unicode
 from search.indexed_text import (
-	IndexedText, VerseIndexedText, DictionaryIndexedText
+	IndexedText, VerseIndexedText, DictionaryIndexedText, GenbookText,
+	entries_fingerprint, read_entry_chunks, read_tree_chunks
 )
 from search.stemming import get_stemmer
 from search.fields import all_fields
+from search import index_file
+from search.postings import (
+	build_postings, plain_words, phrase_words, TrigramIndex, word_re
+)
+from search.suggestions import Suggester
+
+# wildcard terms which match more words than this are searched for by
+# scanning the text rather than in the postings of each word
+max_expanded_words = 1000
 
+plain_word_re = re.compile(r"\w+$", re.UNICODE)
 
 _number = 0
 
@@ -30,6 +47,12 @@ ADVANCED = Number()
 ADVANCED_REGEX = ADVANCED | REGEX
 COMBINED = Number()
 
+# only count the matches in each chapter, rather than finding them
+COUNT = Number()
+
+# give the best results first, rather than in the order of the book
+RANKED = Number()
+
 def RemoveDuplicates(vlist):
 	"""This function removes duplicates and overlaps in search results.
 	>>> RemoveDuplicates(["Romans 6:3", "Romans 6:3"])
@@ -69,6 +92,66 @@ def RemoveDuplicates(vlist):
 			verses.update(spl)
 	return [x for x in btext if x not in removals]
 
+def RemoveOverlaps(results):
+	"""This function removes duplicates and overlaps in search results, given
+	as (book number, first line, last line). Any result inside another one is
+	removed. The results come back sorted.
+	>>> RemoveOverlaps([(0, 3, 3), (0, 3, 3)])
+	[(0, 3, 3)]
+	>>> RemoveOverlaps([(0, 3, 4), (0, 4, 4)])
+	[(0, 3, 4)]
+	>>> RemoveOverlaps([(0, 3, 3), (0, 3, 4), (0, 4, 4)])
+	[(0, 3, 4)]
+	>>> RemoveOverlaps([(0, 3, 3), (0, 4, 4)])
+	[(0, 3, 3), (0, 4, 4)]
+	>>> RemoveOverlaps([(0, 2, 3), (0, 3, 4)])
+	[(0, 2, 3), (0, 3, 4)]
+	>>> RemoveOverlaps([(0, 2, 5), (0, 4, 4), (0, 3, 4)])
+	[(0, 2, 5)]
+	>>> RemoveOverlaps([(1, 1, 1), (0, 5, 5)])
+	[(0, 5, 5), (1, 1, 1)]
+	"""
+	ret = []
+	book = furthest = None
+	for result in sorted(results,
+			key=lambda (book, first, last): (book, first, -last)):
+		# anything starting at or after the one before which doesn't go
+		# further than everything so far is inside one of them
+		if result[0] == book and result[2] <= furthest:
+			continue
+
+		ret.append(result)
+		if result[0] != book:
+			book, furthest = result[0], result[2]
+		else:
+			furthest = max(furthest, result[2])
+
+	return ret
+
+class SearchResults(object):
+	"""A list of search results from an index, as (book number, first line,
+	last line). Looking up an item gives its reference as text, which is
+	only worked out when it is asked for."""
+	def __init__(self, index, results=()):
+		self.index = index
+		self.results = list(results)
+
+	def __len__(self):
+		return len(self.results)
+
+	def __getitem__(self, item):
+		return self.index.GetReference(self.results[item])
+
+	def __iter__(self):
+		for result in self.results:
+			yield self.index.GetReference(result)
+
+	def __nonzero__(self):
+		return bool(self.results)
+
+	def extend(self, results):
+		self.results.extend(results)
+
 
 class SearchException(Exception):
 	pass
@@ -96,6 +179,125 @@ class BadBook(Exception):
 		self.index = index
 	
 
+def bookname_ui(bookname):
+	# two translates in case of dashes
+	return pysw.locale.translate(
+		pysw.locale.translate(
+			bookname
+		)
+	).decode(pysw.locale_encoding)
+
+def index_processes():
+	"""Get the number of processes to build indexes with. 1 means build them
+	in this process."""
+	processes = search_config["index_processes"]
+	if processes > 0:
+		return processes
+
+	try:
+		return multiprocessing.cpu_count()
+	except NotImplementedError:
+		return 1
+
+def search_processes():
+	"""Get the number of processes to search books with. 1 means search them
+	in this process."""
+	processes = search_config["search_processes"]
+	if processes > 0:
+		return processes
+
+	try:
+		return multiprocessing.cpu_count()
+	except NotImplementedError:
+		return 1
+
+def _init_worker():
+	"""Set up an index or search worker process.
+
+	Each worker has its own SWORD manager, rather than one shared with the
+	process it was forked from."""
+	import __builtin__
+	if not hasattr(__builtin__, "_"):
+		from util import i18n
+		i18n.install_dummy_translator()
+
+	SW.Log.getSystemLog().setLogLevel(0)
+	biblemgr.mgrs = []
+	biblemgr.make_managers()
+	biblemgr.init_options()
+	biblemgr.temporary_state(biblemgr.plainstate)
+
+def _collect_book((booktype, version, bookname)):
+	return booktype(version, bookname)
+
+def search_book(book, args):
+	"""Search one book, returning the (first line, last line) of each match.
+
+	If mode is COUNT, the (chapter, number of matches) in each chapter are
+	returned instead, and if it is RANKED, the (score, first line, last line)
+	of each match."""
+	wordlist, proximity, is_word_proximity, excludes, strongs, \
+		excluded_strongs, expansions, mode, weights = args
+
+	index_file.book_used(book)
+	matches = book.multi_search(wordlist[:], proximity,
+		is_word_proximity=is_word_proximity, excludes=excludes,
+		strongs=strongs[:], excluded_strongs=excluded_strongs,
+		expansions=expansions)
+
+	if mode == COUNT:
+		return book.count_matches(matches)
+
+	if mode == RANKED:
+		return book.rank_matches(matches, wordlist, expansions, weights)
+
+	return book.find_ranges(matches)
+
+# the search pool is kept between searches, as starting the workers and
+# their SWORD managers is expensive
+_search_pool = None
+
+def get_search_pool(processes):
+	global _search_pool
+	if _search_pool is None:
+		_search_pool = multiprocessing.Pool(processes, _init_worker)
+
+	return _search_pool
+
+def close_search_pool(*args):
+	"""Stop the search workers. They will be started again when needed."""
+	global _search_pool
+	if _search_pool is not None:
+		_search_pool.terminate()
+		_search_pool = None
+
+# the workers' SWORD managers are out of date after a reload
+biblemgr.on_after_reload += close_search_pool
+
+# and the workers keep the index files they have searched mapped in, which
+# windows won't let us replace or delete
+search_utils.on_index_file_closing += close_search_pool
+
+# books which a search worker has loaded: (filename, stamp) -> {number: book}
+# Several indexes are kept, as they may be searched together.
+_worker_books = LRUCache(search_config["index_cache_size"])
+
+def _search_mapped_book((filename, stamp, number, args)):
+	books = _worker_books.get((filename, stamp))
+	if books is None:
+		# forget any older version of this index
+		_worker_books.remove_if(lambda key: key[0] == filename)
+		source = index_file.IndexFile(filename)
+		if source.stamp != stamp:
+			raise SearchException(_("The search index has changed"))
+
+		books = _worker_books[filename, stamp] = dict(
+			(idx, index_file.read_book(source, entry))
+			for idx, entry in enumerate(source.header["books"])
+		)
+
+	return search_book(books[number], args)
+
 class Index(object):
 	def __init__(self, version, progress=printx, booktype=VerseIndexedText):
 		self.version = version
@@ -106,13 +308,93 @@ class Index(object):
 	def book(self):
 		return biblemgr.get_module_book_wrapper(self.version)
 
+	def __getattr__(self, name):
+		# an index read from an index file loads its statistics when they are
+		# first used
+		mapped = self.__dict__.get("_mapped")
+		if mapped is None or name not in index_file.LAZY_INDEX_ATTRIBUTES:
+			raise AttributeError(name)
+
+		source, header = mapped
+		source.load_index(self, header)
+		return self.__dict__[name]
+
 	def init(self, progress=lambda x:x):	
 		"""Index.init - reindxes index"""
 		self.books=[] # has to stay in order
 		self.statistics = {}
+		self.indexed_version = self.get_module_version()
+		InvalidateSearchCache(self.version)
 		self.GenerateIndex(self.version, progress)
 		self.check_for_errors()
 
+	def UpdateIndex(self, progress=lambda x:x):
+		"""Index.UpdateIndex - reindexes only the books which have changed
+		in the module since they were indexed"""
+		old_state = self.__dict__.copy()
+		self.previous_books = dict(
+			(book.bookname, book) for book in self.books
+		)
+
+		try:
+			try:
+				self.init(progress)
+			except BadBook:
+				raise
+
+			except:
+				# leave the index as it was
+				self.__dict__.clear()
+				self.__dict__.update(old_state)
+				raise
+		finally:
+			self.__dict__.pop("previous_books", None)
+
+	def reusable_book(self, bookname, fingerprint=None):
+		"""If we are updating the index and the book of this name hasn't
+		changed since it was indexed, return it. Otherwise return None.
+		fingerprint is the book's current fingerprint, if it is known."""
+		previous_books = self.__dict__.get("previous_books")
+		if not previous_books:
+			return None
+
+		book = previous_books.get(bookname)
+		if book is None or book.is_out_of_date(fingerprint):
+			return None
+
+		return book
+
+	def get_module_version(self):
+		"""Get the version of the module from its .conf file"""
+		module = biblemgr.get_module(self.version)
+		if module is None:
+			return None
+
+		return module.getConfigEntry("Version")
+
+	def is_personal(self):
+		"""Is this a module the user can write to (e.g. a personal
+		commentary)? These can change without their version changing."""
+		module = biblemgr.get_module(self.version)
+		return module is not None and \
+			module.getConfigEntry("ModDrv") == "RawFiles"
+
+	def IsOutOfDate(self):
+		"""Index.IsOutOfDate - has the module changed since it was indexed?"""
+		if "indexed_version" not in self.__dict__:
+			# an index from before we kept track of this; we can't tell
+			return False
+
+		if self.indexed_version != self.get_module_version():
+			return True
+
+		if self.is_personal():
+			for book in self.books:
+				if book.is_out_of_date():
+					return True
+
+		return False
+
 	def check_for_errors(self, raise_exception=True):
 		errors = []
 		has_xml_errors = False
@@ -156,27 +438,18 @@ class Index(object):
 			mod = self.book.mod
 
 			self.book.templatelist.append(template)
-			offsets = [0]
-			books = 0
-			for i in range(1,3):
-				offsets.append(books)
-				books += vk.bookCount(i)
+			booknames = []
 			for i in [1, 2]:
 				for j in range(1, vk.bookCount(i)+1):
-					bookname = vk.bookName(i,j)
-					# two translates in case of dashes
-					bookname_ui = pysw.locale.translate(
-						pysw.locale.translate(
-							bookname
-						)
-					).decode(pysw.locale_encoding)
+					booknames.append(vk.bookName(i,j))
 
-					continuing = progress((bookname_ui, 
-									99*(j+offsets[i])/books))
-					if not continuing:
-						raise Cancelled
-					
-					self.books.append(self.booktype(self.version, bookname))
+			processes = index_processes()
+			if processes > 1:
+				self.books = self.collect_books_in_parallel(booknames,
+					processes, progress)
+
+			else:
+				self.books = self.collect_books(booknames, progress)
 
 			if(self.booktype.gatherstatistics):
 				self.GatherStatistics()
@@ -190,27 +463,120 @@ class Index(object):
 			self.book.SetModule(oldmod, notify=False)
 			
 
+	def collect_books(self, booknames, progress):
+		"""Collect the given books one after another in this process"""
+		books = []
+		for num, bookname in enumerate(booknames):
+			continuing = progress((bookname_ui(bookname), 
+							99*(num+1)/len(booknames)))
+			if not continuing:
+				raise Cancelled
+			
+			book = self.reusable_book(bookname)
+			if book is None:
+				book = self.booktype(self.version, bookname)
+
+			books.append(book)
+
+		return books
+
+	def collect_books_in_parallel(self, booknames, processes, progress):
+		"""Collect the given books in a pool of worker processes, each with
+		its own SWORD manager, and return them in the order given"""
+		# books which haven't changed since we last indexed them don't need
+		# to go to the workers
+		books = [self.reusable_book(bookname) for bookname in booknames]
+		changed = [
+			bookname for bookname, book in zip(booknames, books)
+			if book is None
+		]
+
+		if not changed:
+			return books
+
+		try:
+			pool = multiprocessing.Pool(processes, _init_worker)
+		except OSError, e:
+			dprint(WARNING, "Couldn't start index workers", e)
+			return self.collect_books(booknames, progress)
+
+		try:
+			results = pool.imap(_collect_book, [
+				(self.booktype, self.version, bookname)
+				for bookname in changed
+			])
+			
+			if not progress((bookname_ui(changed[0]), 0)):
+				raise Cancelled
+
+			for num, book in enumerate(results):
+				books[booknames.index(changed[num])] = book
+
+				# report the book we are now waiting on
+				bookname = changed[min(num + 1, len(changed) - 1)]
+				continuing = progress((bookname_ui(bookname), 
+								99*(num+1)/len(changed)))
+				if not continuing:
+					raise Cancelled
+
+			pool.close()
+
+		finally:
+			# if we have been cancelled or something has gone wrong, don't
+			# wait for the other books
+			pool.terminate()
+			pool.join()
+
+		return books
+
 	def GatherStatistics(self):
 		"""Index.GatherStatistics - Gathers statisitics including ranks,
 		occurrences and wordlists for spellchecking"""
 		wordlist = set()
 		letters = set()
+		word_counts = {}
+		line_counts = {}
+		total_lines = 0
+		total_length = 0
 		for book in self.books:
 			letters.update(book.text)
 			wordlist.update(book.text.lower().split())
 
+			# how often each word occurs, and on how many lines, for planning
+			# and ranking searches
+			postings = book.get_postings()
+			if postings is None:
+				postings = build_postings(book.text)
+
+			for word, (offsets, lines) in postings.iteritems():
+				word_counts[word] = word_counts.get(word, 0) + len(offsets)
+				line_counts[word] = line_counts.get(word, 0) + len(set(lines))
+
+			lines = book.text.count(u"\n") + 1
+			total_lines += lines
+			total_length += len(book.text) - (lines - 1)
+
 		self.statistics["wordlist"] = wordlist
+		self.statistics["word_counts"] = word_counts
+		self.statistics["line_counts"] = line_counts
+		self.statistics["lines"] = total_lines
+		self.statistics["average_line_length"] = \
+			float(total_length) / max(total_lines, 1)
 
 		# remove whitespace
 		letters.discard(u"\n")
 		letters.discard(u" ")
 		self.statistics["letters"] = letters
 
+		# stem the words of the postings rather than the wordlist, which has
+		# punctuation on its words (e.g. "god's" or "loved,"). Then the
+		# regular expression a stemmed search term makes from a stem's words
+		# is a plain word term, which is found from the postings rather than
+		# by scanning the text.
+		vocabulary = sorted(word_counts)
 		stemmer = get_stemmer(self.book.mod)
 		stem_map = {}
-		for word, stemmed in zip(wordlist, stemmer.stemWords(wordlist)):
-			#if word in stem_map and stemmed not in stem_map:
-			#	print word
+		for word, stemmed in zip(vocabulary, stemmer.stemWords(vocabulary)):
 			if stemmed in stem_map:
 				stem_map[stemmed].append(word)
 
@@ -282,7 +648,7 @@ class Index(object):
 	
 	def Search(self, regexes, excl_regexes, fields, excl_fields,
 		type=COMBINED, proximity=15, is_word_proximity=True, 
-		progress=lambda x:x, searchrange=None):
+		progress=lambda x:x, searchrange=None, limit=100):
 		"""Index.Search - this function does all bible searching
 		
 		In:	words - words to search for
@@ -294,12 +660,68 @@ class Index(object):
 					and any of:
 						CASESENSITIVE: does man==Man?
 						ADVANCED: groups by matched text. Not MULTIWORD
+						COUNT: only count the matches
+						RANKED: give the best results first
 			proximity - search radius for MULTIWORD
 			progress - function for reporting search progress
 			searchrange - see BookRange
+			limit - how many results to give when RANKED
 		
-		Out: results, regular expressions
+		Out: results, as (book number, first line, last line), and whether
+		they may be incorrect. If counting, the results are (book number,
+		counts) for each book searched, where counts is a list of (chapter,
+		number of matches) for the chapters with matches in them. Books
+		without chapters have theirs counted under None.
 		"""
+		if type & RANKED:
+			return self.ranked_search(regexes, excl_regexes, fields,
+				excl_fields, type, proximity, is_word_proximity, progress,
+				searchrange, limit)
+
+		results = []
+		for book_results in self.IterSearch(regexes, excl_regexes, fields,
+				excl_fields, type, proximity, is_word_proximity, progress,
+				searchrange):
+			if type & COUNT:
+				results.append(book_results)
+			else:
+				results += book_results
+
+		return results, self.MaybeIncorrectResults(fields)
+
+	def ranked_search(self, regexes, excl_regexes, fields, excl_fields,
+		type, proximity, is_word_proximity, progress, searchrange, limit):
+		"""Get the limit best results of a search, the best first. Only the
+		best so far are kept as each book is searched."""
+		heap = []
+		for book_results in self.IterSearch(regexes, excl_regexes, fields,
+				excl_fields, type, proximity, is_word_proximity, progress,
+				searchrange):
+			for result in book_results:
+				if len(heap) < limit:
+					heapq.heappush(heap, result)
+				elif result > heap[0]:
+					heapq.heapreplace(heap, result)
+
+		heap.sort(reverse=True)
+		results = [(number, first, last) for score, number, first, last in heap]
+		return results, self.MaybeIncorrectResults(fields)
+
+	def IterSearch(self, regexes, excl_regexes, fields, excl_fields,
+		type=COMBINED, proximity=15, is_word_proximity=True, 
+		progress=lambda x:x, searchrange=None):
+		"""Index.IterSearch - like Search, but yields the results for each
+		book as soon as it has been searched, so that they can be shown
+		straight away. Whether the results may be incorrect can be found out
+		afterwards with MaybeIncorrectResults.
+
+		If counting, this yields (book number, counts) for each book, as
+		described in Search. If ranking, this yields the (score, book number,
+		first line, last line) of each result in the book.
+
+		The search is started straight away, rather than when the results
+		are first asked for, so several indexes can be searched at once (see
+		search.multi_search)."""
 
 		if self.book.version != self.version:
 			self.book.SetModule(self.version)
@@ -319,29 +741,54 @@ class Index(object):
 		else:
 			books=self.books
 		
-		results=[]
-		
 		flags = re.IGNORECASE * (not case_sensitive) | re.UNICODE | re.MULTILINE
 		
 		if not regexes and not fields:
 			# we can't search for just a negative at the moment
 			# so -/a/ isn't a valid search
-			return [], False
+			return iter([])
 
-		return self.multi_search(
+		return self.iter_multi_search(
 			regexes, excl_regexes, fields, excl_fields, books, proximity, 
-			is_word_proximity, flags, progress
+			is_word_proximity, flags, progress,
+			mode=type & (COUNT | RANKED)
 		)
-		
+
+	def MaybeIncorrectResults(self, fields):
+		"""Index.MaybeIncorrectResults - could a search on fields have given
+		incorrect results, because of problems found while indexing?"""
+		if not fields:
+			return False
+
+		return self.check_for_errors(raise_exception=False)
 	
 	def multi_search(self, regexes, excl_regexes, fields, excl_fields, books, 
 		proximity, is_word_proximity, flags, progress):
 
 		results = []
+		for book_results in self.iter_multi_search(regexes, excl_regexes,
+				fields, excl_fields, books, proximity, is_word_proximity,
+				flags, progress):
+			results += book_results
+
+		return results, self.MaybeIncorrectResults(fields)
+
+	def iter_multi_search(self, regexes, excl_regexes, fields, excl_fields,
+		books, proximity, is_word_proximity, flags, progress, mode=0):
+		"""Start searching books, returning an iterator over the results of
+		each one in order. If mode is COUNT or RANKED, the results are as
+		described in IterSearch."""
+
+		expansions = self.expand_terms(regexes + excl_regexes)
+		planned = self.plan_search(regexes, expansions)
+		if planned is None:
+			# one of the words isn't in this index
+			progress((_("Done"), 100))
+			return iter([])
 
 		try:
 			excludelist = [(re.compile(e, flags), 0) for e in excl_regexes]
-			wordlist = [(re.compile(e, flags), 0) for e in regexes]
+			wordlist = [(re.compile(e, flags), 0) for e in planned]
 		except re.error, e:
 			raise SearchException(
 				_("There seems to be an error in your regular expression.\n"
@@ -362,32 +809,327 @@ class Index(object):
 						_("You cannot search on the field %r") % key
 					)
 				
+		weights = None
+		if mode == RANKED:
+			weights = self.get_ranking_weights(planned, expansions)
+
+		args = (wordlist, proximity, is_word_proximity, excludelist,
+			strongs[0], strongs[1], expansions, mode, weights)
+
+		# the books we have already searched for this (with any scope) are
+		# kept in the search cache, so only search the rest
+		cache_key = self.get_cache_key(regexes, excl_regexes, fields,
+			excl_fields, proximity, is_word_proximity, flags, mode)
+
+		cached = {}
+		if cache_key is not None:
+			cached = search_cache.get(cache_key, {})
+			search_cache[cache_key] = cached
+
+		numbers = self.get_book_numbers(books)
+		to_search = [
+			book for book, number in zip(books, numbers)
+			if number not in cached
+		]
+
+		book_results = self.search_books(to_search, args, progress)
+		return self.iter_book_results(numbers, cached, book_results, mode,
+			progress)
+
+	def iter_book_results(self, numbers, cached, book_results, mode,
+		progress):
+		"""Yield the results of the books numbered numbers, from the cache
+		or as they come back from book_results"""
+		for number in numbers:
+			if number not in cached:
+				# the books not in the cache come back from search_books in
+				# the same order
+				try:
+					cached[number] = book_results.next()
+				except StopIteration:
+					# we were cancelled before we got to this book
+					break
+
+			if mode == COUNT:
+				yield number, cached[number]
+			elif mode == RANKED:
+				yield [(score, number, first, last)
+					for score, first, last in cached[number]]
+			else:
+				yield [(number, first, last) for first, last in cached[number]]
+		
+		progress((_("Done"), 100))
+	
+	def get_ranking_weights(self, regexes, expansions):
+		"""Get the BM25 weight (inverse document frequency) of each term,
+		from how many lines its words are on, and the average length of a
+		line (None if the index doesn't have the statistics)."""
+		# XXX: Indexes created before line counts were gathered don't have
+		# them, so all terms weigh the same
+		line_counts = self.statistics.get("line_counts")
+		if not line_counts:
+			return [1.] * len(regexes), None
+
+		lines = self.statistics["lines"]
+		term_weights = []
+		for regex in regexes:
+			words = expansions.get(regex, plain_words(regex))
+			phrase = phrase_words(regex)
+			if words is not None:
+				frequency = min(lines,
+					sum(line_counts.get(word, 0) for word in words))
+			elif phrase is not None:
+				# it can't be on more lines than its rarest word
+				frequency = min(line_counts.get(word, 0) for word in phrase)
+			else:
+				# we can't tell how common a regular expression is
+				term_weights.append(1.)
+				continue
+
+			term_weights.append(math.log(
+				1 + (lines - frequency + .5) / (frequency + .5)
+			))
+
+		return term_weights, self.statistics["average_line_length"]
+
+	def plan_search(self, regexes, expansions):
+		"""Order the search terms so that the rarest comes first, using how
+		often each word occurs in the index. Terms we don't know the
+		frequency of (e.g. regular expressions we couldn't expand) go last.
+		Each book is searched from the matches of the first term, so the
+		ranges found follow how rare the terms are, not the order they were
+		given in.
+
+		Returns None if one of the terms doesn't occur in the index at all,
+		as then nothing can match and no book need be searched."""
+		word_counts = self.statistics.get("word_counts")
+		keep_order = False
+		if not word_counts:
+			# XXX: Indexes created before word counts were gathered only have
+			# their wordlist. That still tells us if a term isn't in the
+			# index, but their terms are searched in the order given.
+			word_counts = self.get_wordlist_counts()
+			keep_order = True
+			if not word_counts:
+				return regexes
+
+		frequencies = []
+		for regex in regexes:
+			words = expansions.get(regex, plain_words(regex))
+			phrase = phrase_words(regex)
+			if words is not None:
+				frequency = sum(word_counts.get(word, 0) for word in words)
+			elif phrase is not None:
+				# it can't occur more often than its rarest word
+				frequency = min(word_counts.get(word, 0) for word in phrase)
+			else:
+				frequency = sys.maxint
+
+			if not frequency:
+				return None
+
+			frequencies.append(frequency)
+
+		if keep_order:
+			return regexes
+
+		return [regex for frequency, regex in
+			sorted(zip(frequencies, regexes), key=lambda item: item[0])]
+
+	def get_wordlist_counts(self):
+		"""Count each word of the wordlist once, for indexes created before
+		word counts were gathered, or return None if there is no wordlist.
+		Its words are split up as the postings split them (e.g. "god's" is
+		god and s), so that every word of the index is in it."""
+		wordlist = self.statistics.get("wordlist")
+		if not wordlist:
+			return None
+
+		# it is built the first time it is used, and again if the statistics
+		# have been gathered again since
+		counts = self.__dict__.get("_wordlist_counts")
+		if counts is None or counts[0] is not wordlist:
+			counts = self._wordlist_counts = wordlist, dict(
+				(word, 1) for item in wordlist for word in word_re.findall(item)
+			)
+
+		return counts[1]
+
+	def expand_terms(self, patterns):
+		"""Find the words of the index that each wildcard or regular
+		expression term can match, so that they can be looked up in the
+		postings instead of scanning the text for them. This returns a
+		dictionary of pattern -> words for the terms we could expand."""
+		vocabulary = self.get_vocabulary()
+		expansions = {}
+		if vocabulary is None:
+			return expansions
+
+		for pattern in patterns:
+			if plain_words(pattern) is not None:
+				continue
+
+			words = vocabulary.expand(pattern)
+
+			# a term matching a lot of words is as quick to find by scanning
+			if words is not None and len(words) <= max_expanded_words:
+				expansions[pattern] = words
+
+		return expansions
+
+	def get_vocabulary(self):
+		"""Get the TrigramIndex of the words in the index, or None if we
+		don't have them"""
+		word_counts = self.statistics.get("word_counts")
+		if not word_counts:
+			return None
+
+		# it is built the first time it is used, and again if the statistics
+		# have been gathered again since
+		vocabulary = self.__dict__.get("_vocabulary")
+		if vocabulary is None or vocabulary[0] is not word_counts:
+			vocabulary = self._vocabulary = (
+				word_counts, TrigramIndex(word_counts)
+			)
+
+		return vocabulary[1]
+
+	def SuggestWords(self, word, limit=5):
+		"""Index.SuggestWords - get up to limit words from the index which
+		word may be a misspelling of, the most likely first"""
+		suggester = self.get_suggester()
+		if suggester is None:
+			return []
+
+		return suggester.suggest(word, limit)
+
+	def get_suggester(self):
+		"""Get the Suggester for the words in the index, or None if we don't
+		have them"""
+		# XXX: Indexes created before word counts were gathered don't have
+		# them, so use the plain words of the wordlist
+		source = self.statistics.get("word_counts") or \
+			self.statistics.get("wordlist")
+
+		if not source:
+			return None
+
+		# it is built the first time it is used, and again if the statistics
+		# have been gathered again since
+		suggester = self.__dict__.get("_suggester")
+		if suggester is None or suggester[0] is not source:
+			if isinstance(source, dict):
+				word_counts = source
+			else:
+				word_counts = dict(
+					(word, 1) for word in source if plain_word_re.match(word)
+				)
+
+			suggester = self._suggester = source, Suggester(word_counts)
+
+		return suggester[1]
+
+	def GetReference(self, result):
+		"""Index.GetReference - get a search result as text"""
+		number, first, last = result
+		return self.books[number].get_range_text(first, last)
+
+	def get_cache_key(self, regexes, excl_regexes, fields, excl_fields,
+		proximity, is_word_proximity, flags, mode=0):
+		"""Get the key of a search in the search cache, or None if this index
+		can't be cached (because it hasn't been written out)"""
+		stamp = self.get_stamp()
+		if stamp is None:
+			return None
+
+		return (self.version, stamp, tuple(regexes), tuple(excl_regexes),
+			tuple(tuple(field) for field in fields),
+			tuple(tuple(field) for field in excl_fields),
+			proximity, bool(is_word_proximity), flags, mode)
+
+	def get_stamp(self):
+		"""Identifies this version of the index: the stamp of the index file
+		it is in, or None if it hasn't been written out"""
+		mapped = self.__dict__.get("_mapped")
+		if mapped is None:
+			return None
+
+		return mapped[0].stamp
+
+	def get_book_numbers(self, books):
+		"""Get the positions of books in this index"""
+		numbers = dict((id(book), number)
+			for number, book in enumerate(self.books))
+
+		return [numbers[id(book)] for book in books]
+
+	def search_books(self, books, args, progress):
+		"""Search books, yielding the results for each of them in order. If
+		the search is cancelled, this stops early."""
+		processes = search_processes()
+		locations = [index_file.book_location(book) for book in books]
+		if processes > 1 and len(books) > 1 and None not in locations:
+			return self.search_in_parallel(books, locations, args,
+				processes, progress)
+
+		return self.search_in_process(books, args, progress)
+
+	def search_in_process(self, books, args, progress):
 		# Do multiword
 		for num, book in enumerate(books):
 			continuing = progress((book.bookname, (100*num)/len(books)))
 			if not continuing:
 				break			
 
-			matches = book.multi_search(wordlist[:], proximity,
-				is_word_proximity=is_word_proximity, excludes=excludelist,
-				strongs=strongs[0][:], excluded_strongs=strongs[1])
+			yield search_book(book, args)
+	
+	def search_in_parallel(self, books, locations, args, processes,
+		progress):
+		"""Search books in the search worker processes, which read them from
+		the index file. The results for each book come back in the order of
+		books."""
+		try:
+			pool = get_search_pool(processes)
+		except OSError, e:
+			dprint(WARNING, "Couldn't start search workers", e)
+			return self.search_in_process(books, args, progress)
 
-			results += book.find_index(matches)
-		
-		progress((_("Done"), 100))
+		tasks = pool.imap(_search_mapped_book, [
+			location + (args,) for location in locations
+		])
 
-		if not fields:
-			maybe_incorrect_results = False
-		else:
-			maybe_incorrect_results = self.check_for_errors(raise_exception=False)
-		return results, maybe_incorrect_results
-	
+		return self.iter_parallel_results(books, tasks, progress)
+
+	def iter_parallel_results(self, books, tasks, progress):
+		finished = False
+		try:
+			for num, book_results in enumerate(tasks):
+				yield book_results
+				continuing = progress((books[num].bookname, 
+					(100*(num + 1))/len(books)))
+				if not continuing:
+					break
+
+			else:
+				finished = True
+
+		finally:
+			if not finished:
+				# the workers are still busy with the rest of the books,
+				# so throw them away
+				close_search_pool()
 	
 	def WriteIndex(self, progress=util.noop):
 		search_utils.WriteIndex(self, progress=progress)
 
+def in_subtree(path, node):
+	"""Is path the path of node, or of a node under it?"""
+	return path == node or path.startswith(node + u"/")
+
 class GenBookIndex(Index):
-	def __init__(self, version, progress=lambda x:x, booktype=IndexedText):
+	"""An index of a general book. Each top level node of the book, with the
+	nodes under it, is indexed as a book of its own (see GenbookText)."""
+	def __init__(self, version, progress=lambda x:x, booktype=GenbookText):
 		super(GenBookIndex, self).__init__(version, progress, booktype=booktype)
 
 	def GenerateIndex(self, mod, progress = lambda x:x):
@@ -410,9 +1152,29 @@ class GenBookIndex(Index):
 			mod = self.book.mod
 
 			self.book.templatelist.append(template)
-			self.books.append(self.booktype(self.version))
+
+			root = pysw.TK(mod.getKey(), mod)
+			root.root()
+			top_level_nodes = len(list(root))
+
+			upto = 0
+			for start, items, ids in read_tree_chunks(mod):
+				continuing = progress((start,
+							95*upto/max(top_level_nodes, 1)))
+				upto += 1
+
+				book = self.reusable_book(start, entries_fingerprint(items))
+				if book is None:
+					book = self.booktype(self.version, start, items=items,
+						ids=ids)
+
+				self.books.append(book)
+
+				if not continuing:
+					raise Cancelled
 
 			if self.booktype.gatherstatistics:
+				progress(("index", 99))
 				self.GatherStatistics()
 				
 		finally:
@@ -422,8 +1184,90 @@ class GenBookIndex(Index):
 			self.book.templatelist.pop()
 			
 			self.book.SetModule(oldmod, notify=False)
+
+	def scope_paths(self, searchrange):
+		"""Get the node paths of searchrange, or None if it is the whole
+		book"""
+		if isinstance(searchrange, basestring):
+			searchrange = [searchrange]
+
+		paths = [path.rstrip(u"/") or u"/" for path in searchrange]
+		if u"/" in paths:
+			return None
+
+		return paths
+
+	def BookRange(self, searchrange):
+		"""Find the books (top level nodes) which the nodes in searchrange
+		are in. searchrange is the path of a node, e.g. u"/Book 1/Chapter 2",
+		or a list of them."""
+		paths = self.scope_paths(searchrange)
+		if paths is None:
+			return self.books
+
+		books = []
+		for book in self.books:
+			# XXX: Indexes from before general books were split up have
+			# the whole book in one
+			start = getattr(book, "start", None)
+			if start is None or [path for path in paths
+					if in_subtree(path, start)]:
+				books.append(book)
+
+		if not books:
+			raise SearchException(
+				_("Couldn't find '%s' in this book") % u", ".join(paths)
+			)
+
+		return books
+
+	def IterSearch(self, regexes, excl_regexes, fields, excl_fields,
+		type=COMBINED, proximity=15, is_word_proximity=True, 
+		progress=lambda x:x, searchrange=None):
+		"""Like Index.IterSearch, but only gives the matches which start in
+		the nodes of searchrange (see BookRange) or the nodes under them.
+		When counting, the matches in the whole of the top level nodes they
+		are in are counted."""
+		results = super(GenBookIndex, self).IterSearch(regexes, excl_regexes,
+			fields, excl_fields, type, proximity, is_word_proximity, progress,
+			searchrange)
+
+		paths = None
+		if searchrange:
+			paths = self.scope_paths(searchrange)
+
+		if paths is None or type & COUNT:
+			return results
+
+		return self.iter_subtree_results(results, paths)
+
+	def iter_subtree_results(self, results, paths):
+		"""Leave out the results which don't start in the nodes at paths"""
+		try:
+			for book_results in results:
+				# the book number and first line are the second and third
+				# last of both normal and ranked results
+				yield [result for result in book_results
+					if self.in_nodes(result[-3], result[-2], paths)]
+		finally:
+			close = getattr(results, "close", None)
+			if close is not None:
+				close()
+
+	def in_nodes(self, number, line, paths):
+		"""Is line of the book numbered number in the nodes at paths?"""
+		book = self.books[number]
+		if getattr(book, "start", None) in paths:
+			return True
+
+		reference = book.get_reference_table()[line]
+		for path in paths:
+			if in_subtree(reference, path):
+				return True
+
+		return False
 		
-class DictionaryIndex(GenBookIndex):
+class DictionaryIndex(Index):
 	def __init__(self, version, progress=lambda x:x, 
 		booktype=DictionaryIndexedText):
 		super(DictionaryIndex, self).__init__(version, progress, 
@@ -452,13 +1296,21 @@ class DictionaryIndex(GenBookIndex):
 
 			self.book.templatelist.append(template)
 			entry_size = 200
-			for a in range(0, len(topics), entry_size):
-				continuing = progress((topics[a], 
-							95*a/len(topics)))
+			upto = 0
+			for items in read_entry_chunks(mod, entry_size):
+				# the topic list only gives us how many entries there are,
+				# for the progress
+				start = to_unicode(items[0][0], mod)
+				continuing = progress((start, 
+							95*upto/max(len(topics), 1)))
+				upto += len(items)
 
-				
-				self.books.append(self.booktype(self.version, 
-					start=topics[a], entries=entry_size))
+				book = self.reusable_book(start, entries_fingerprint(items))
+				if book is None or book.entries != entry_size:
+					book = self.booktype(self.version, 
+						start=start, entries=entry_size, items=items)
+
+				self.books.append(book)
 				
 				if not continuing:
 					raise Cancelled
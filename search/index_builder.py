@@ -0,0 +1,219 @@
+"""Builds search indexes in the background.
+
+Indexes are built one at a time in a separate process, which has its own
+SWORD manager, so the program can still be used while they are built. Builds
+are queued with index_builder.build(), and report what they are doing through
+the observer lists on index_builder. These are only fired from poll(), which
+the GUI calls every so often while there is something building, so observers
+are always called on the GUI thread.
+"""
+import atexit
+import multiprocessing
+import Queue
+import traceback
+
+from util.observerlist import ObserverList
+from util.debug import dprint, WARNING
+from search import index
+
+# how a build finished
+BUILT = "built"
+CANCELLED = "cancelled"
+FAILED = "failed"
+
+class IndexJob(object):
+	"""A queued or running index build"""
+	def __init__(self, version, index_type, update=False):
+		self.version = version
+		self.index_type = index_type
+		self.update = update
+		self.bookname = None
+		self.percent = 0
+
+def _build_index((version, index_type, update), messages, cancelled):
+	"""Build and write the index for version. This runs in its own process,
+	and tells the GUI how it is going through messages."""
+	index._init_worker()
+
+	def progress((bookname, percent)):
+		messages.put(("progress", version, bookname, percent))
+		return not cancelled.is_set()
+
+	message = None
+	try:
+		try:
+			if update:
+				built_index = index.ReadIndex(version)
+				built_index.UpdateIndex(progress)
+			else:
+				built_index = index_type(version, progress)
+
+		except index.BadBook, e:
+			# the index is still usable, so write it, but tell the user
+			built_index = e.index
+			message = unicode(e)
+
+		built_index.WriteIndex(progress=progress)
+		if cancelled.is_set():
+			raise index.Cancelled
+
+	except index.Cancelled:
+		messages.put(("finished", version, CANCELLED, None))
+
+	except Exception, e:
+		messages.put(("finished", version, FAILED, traceback.format_exc()))
+
+	else:
+		messages.put(("finished", version, BUILT, message))
+
+class IndexBuilder(object):
+	"""A queue of index builds, run one after another in another process"""
+	def __init__(self):
+		self.jobs = []
+		self.current = None
+		self.process = None
+		self.messages = None
+		self.cancelled = None
+
+		# (version)
+		self.on_started = ObserverList()
+
+		# (version, bookname, percent)
+		self.on_progress = ObserverList()
+
+		# (version, status, message)
+		# status is one of BUILT, CANCELLED or FAILED. message is a problem
+		# the user should be told about, or None
+		self.on_finished = ObserverList()
+
+		# called when there is something to poll for
+		self.on_busy = ObserverList()
+
+	def build(self, version, index_type, update=False):
+		"""Queue up a build of the index for version. If update is True, only
+		the books which have changed are indexed again."""
+		if self.is_queued(version):
+			return
+
+		self.jobs.append(IndexJob(version, index_type, update))
+		self.start_next()
+
+	def build_all(self, versions, index_type):
+		"""Queue up builds of the indexes for all of versions which don't
+		already have one"""
+		for version in versions:
+			if not index.IndexExists(version):
+				self.build(version, index_type)
+
+	def is_busy(self):
+		return self.current is not None or bool(self.jobs)
+
+	def get_job(self, version):
+		"""Get the queued or running build for version, or None"""
+		for job in [self.current] + self.jobs:
+			if job is not None and job.version == version:
+				return job
+
+		return None
+
+	def is_queued(self, version):
+		return self.get_job(version) is not None
+
+	def cancel(self, version):
+		"""Cancel the build for version. If it is running, it stops at the
+		next book it comes to."""
+		for job in self.jobs[:]:
+			if job.version == version:
+				self.jobs.remove(job)
+				self.on_finished(version, CANCELLED, None)
+
+		if self.current is not None and self.current.version == version:
+			self.cancelled.set()
+
+	def start_next(self):
+		if self.current is not None or not self.jobs:
+			return
+
+		job = self.jobs.pop(0)
+
+		# the index file is going to be replaced, so nothing in this process
+		# (e.g. the search workers) can have it open
+		index.CloseIndex(job.version)
+
+		self.messages = multiprocessing.Queue()
+		self.cancelled = multiprocessing.Event()
+
+		# not a daemon, as it may start its own pool of index workers
+		self.process = multiprocessing.Process(
+			target=_build_index,
+			args=((job.version, job.index_type, job.update),
+				self.messages, self.cancelled)
+		)
+
+		try:
+			self.process.start()
+		except OSError, e:
+			dprint(WARNING, "Couldn't start index builder", e)
+			self.process = None
+			self.on_finished(job.version, FAILED, unicode(e))
+			self.start_next()
+			return
+
+		self.current = job
+		self.on_started(job.version)
+		self.on_busy()
+
+	def poll(self):
+		"""Pass on what the running build has been doing to our observers,
+		and start the next build when it has finished"""
+		if self.current is None:
+			return
+
+		# check before we read the messages, so that if it has died we know
+		# we have everything it sent
+		alive = self.process.is_alive()
+		finished = None
+		while finished is None:
+			try:
+				message = self.messages.get_nowait()
+			except Queue.Empty:
+				break
+
+			if message[0] == "progress":
+				version, bookname, percent = message[1:]
+				self.current.bookname = bookname
+				self.current.percent = percent
+				self.on_progress(version, bookname, percent)
+
+			else:
+				finished = message[1:]
+
+		if finished is None:
+			if alive:
+				return
+
+			finished = (self.current.version, FAILED,
+				_("The indexing process stopped unexpectedly"))
+
+		self.process.join()
+		self.process = None
+		self.current = None
+		self.on_finished(*finished)
+		self.start_next()
+
+	def shutdown(self):
+		"""Stop all builds, for when we are exiting"""
+		self.jobs = []
+		if self.current is None:
+			return
+
+		self.cancelled.set()
+		self.process.join(2)
+		if self.process.is_alive():
+			self.process.terminate()
+
+		self.process = None
+		self.current = None
+
+index_builder = IndexBuilder()
+atexit.register(index_builder.shutdown)
@@ -0,0 +1,581 @@
+"""The binary search index file format.
+
+An index file is laid out like this:
+	magic (8 bytes)
+	format version, header offset, header length (little endian)
+	sections...
+	header
+
+The header is UTF-8 JSON describing the index and each of its books, and
+where each section for a book lies in the file. Sections hold the book text
+(UTF-8), its verse offsets, lengths and references (fixed width arrays),
+field data, word postings and field postings.
+
+The file is memory mapped when read, so opening an index only reads the
+header. A book's sections are only decoded the first time one of its text,
+index, field_data, postings or field_postings attributes is used (and the index statistics
+the first time they are used), and several processes with the same index open
+share the same pages. The field data and field postings are loaded separately
+from the rest, as only searches on fields need them. Only the most recently
+used books are kept loaded (see resident_books); the rest are unloaded, and
+load themselves again when they are next used.
+
+Text which is all ASCII is kept as the UTF-8 str it is stored as, rather than
+decoded to unicode, which would take two or four times the memory. Regular
+expressions and postings offsets work the same on either. This only helps
+books which are all ASCII: a book with any other character in it (e.g. a
+curly quote, a long dash or an accented name) is decoded to unicode in full,
+as the postings and the results are in terms of characters, not bytes.
+"""
+import json
+import mmap
+import os
+import re
+import struct
+import sys
+import weakref
+from array import array
+
+from util.lru_cache import LRUCache
+
+MAGIC = "BPBIDX\x00\x1a"
+FORMAT_VERSION = 1
+PREAMBLE = struct.Struct("<8sIQQ")
+
+# attributes which are stored in sections and loaded on demand
+LAZY_ATTRIBUTES = ("text", "index", "field_data", "postings",
+	"reference_table", "field_postings")
+LAZY_INDEX_ATTRIBUTES = ("statistics",)
+
+# the lazy attributes which are loaded separately from the others
+FIELD_ATTRIBUTES = ("field_data", "field_postings")
+
+# the lazy attributes which are dropped when a book is unloaded. The
+# reference table is kept, as it may have been worked out from the module.
+UNLOADED_ATTRIBUTES = ("text", "index", "field_data", "postings",
+	"field_postings")
+
+# how many books to keep loaded
+MAX_RESIDENT_BOOKS = 100
+
+# the attributes of books and indexes which are kept in the header. Any
+# others (e.g. those of a search in progress) aren't written.
+BOOK_ATTRIBUTES = ("bookname", "version", "errors_on_collection",
+	"_has_xml_errors", "fingerprint", "start", "entries")
+INDEX_ATTRIBUTES = ("version", "indexed_version")
+
+# open index files, so that they can be closed before being deleted
+_open_files = weakref.WeakValueDictionary()
+
+non_ascii = re.compile("[\x80-\xff]")
+
+def unload_book(book):
+	"""Drop the sections book has loaded. It will load them again when they
+	are next used, as long as its file is still open."""
+	source, entry = book._mapped
+	if source.file.closed:
+		return
+
+	for name in UNLOADED_ATTRIBUTES:
+		book.__dict__.pop(name, None)
+
+# books which have loaded their sections, by (id of their index file, id of
+# the book), the most recently used last
+resident_books = LRUCache(MAX_RESIDENT_BOOKS, on_evict=unload_book)
+
+def book_used(book):
+	"""Note that book has just been used, so that it is unloaded last"""
+	mapped = book.__dict__.get("_mapped")
+	if mapped is not None:
+		resident_books.get((id(mapped[0]), id(book)))
+
+class IndexFileError(Exception):
+	pass
+
+def is_index_file(filename):
+	"""Is filename in this format (as opposed to an old zipped index)?"""
+	f = open(filename, "rb")
+	try:
+		return f.read(len(MAGIC)) == MAGIC
+	finally:
+		f.close()
+
+def close_index_file(filename):
+	"""Close filename if we have it mapped, so that it can be deleted"""
+	index_file = _open_files.pop(os.path.abspath(filename), None)
+	if index_file is not None:
+		index_file.close()
+
+def _encode_value(value):
+	if isinstance(value, str):
+		# byte strings (e.g. SWORD key text) must come back as byte strings
+		return {"bytes": value.decode("latin-1")}
+
+	if isinstance(value, (set, frozenset)):
+		return {"set": [_encode_value(item) for item in value]}
+
+	if isinstance(value, dict):
+		return {"dict": [
+			[_encode_value(key), _encode_value(item)]
+			for key, item in value.iteritems()
+		]}
+
+	if isinstance(value, (list, tuple)):
+		return [_encode_value(item) for item in value]
+
+	return value
+
+def _decode_value(value):
+	if isinstance(value, dict):
+		if "bytes" in value:
+			return value["bytes"].encode("latin-1")
+
+		if "set" in value:
+			return set(_decode_value(item) for item in value["set"])
+
+		return dict(
+			(_decode_value(key), _decode_value(item))
+			for key, item in value["dict"]
+		)
+
+	if isinstance(value, list):
+		return [_decode_value(item) for item in value]
+
+	return value
+
+def _simple_attributes(obj, names):
+	"""Get the attributes of obj out of names which it has, to store in the
+	header"""
+	attributes = {}
+	for key in names:
+		if key in obj.__dict__:
+			attributes[key] = _encode_value(obj.__dict__[key])
+
+	return attributes
+
+def _decode_attributes(attributes):
+	return dict(
+		(str(key), _decode_value(value))
+		for key, value in attributes.iteritems()
+	)
+
+class _SectionWriter(object):
+	def __init__(self, f):
+		self.f = f
+
+	def write(self, data):
+		"""Write a section, returning its (offset, length)"""
+		if isinstance(data, array):
+			data = data.tostring()
+
+		offset = self.f.tell()
+		self.f.write(data)
+		return offset, len(data)
+
+def _copy_book(writer, book):
+	"""If book was read from an index file which is still open, copy its
+	sections across unchanged and return its header entry. Otherwise return
+	None."""
+	mapped = book.__dict__.get("_mapped")
+	if mapped is None:
+		return None
+
+	source, entry = mapped
+	if source.file.closed or source.swap_bytes:
+		return None
+
+	sections = {}
+	for name in entry["sections"]:
+		sections[name] = writer.write(source.section(entry, name))
+
+	reference_table = book.__dict__.get("reference_table")
+	if "reference_table" not in sections and reference_table is not None:
+		sections["reference_table"] = writer.write(
+			u"\x00".join(reference_table).encode("utf8")
+		)
+
+	return dict(
+		type=type(book).__name__,
+		attributes=_simple_attributes(book, BOOK_ATTRIBUTES),
+		ref_type=entry["ref_type"],
+		fields=entry["fields"],
+		field_postings=entry.get("field_postings", []),
+		sections=sections,
+	)
+
+def _write_book(writer, book):
+	# books which were kept from the last time the index was written (see
+	# Index.UpdateIndex) are copied straight from the old file
+	copied = _copy_book(writer, book)
+	if copied is not None:
+		return copied
+
+	sections = {}
+	sections["text"] = writer.write(book.text.encode("utf8"))
+
+	refs = [ref for ref, start, length in book.index]
+	starts = array("i", [start for ref, start, length in book.index])
+	lengths = array("i", [length for ref, start, length in book.index])
+	sections["starts"] = writer.write(starts)
+	sections["lengths"] = writer.write(lengths)
+
+	if all(isinstance(ref, tuple) and len(ref) == 2 for ref in refs):
+		ref_type = "pairs"
+		ref_data = array("i")
+		for ref in refs:
+			ref_data.extend(ref)
+
+	elif all(isinstance(ref, (int, long)) for ref in refs):
+		# e.g. the node ids of general books
+		ref_type = "ints"
+		ref_data = array("i", refs)
+
+	elif all(isinstance(ref, str) for ref in refs):
+		ref_type = "bytes"
+		ref_data = "\x00".join(refs)
+
+	else:
+		ref_type = "unicode"
+		ref_data = u"\x00".join(refs).encode("utf8")
+
+	sections["refs"] = writer.write(ref_data)
+
+	reference_table = book.__dict__.get("reference_table")
+	if reference_table is not None:
+		sections["reference_table"] = writer.write(
+			u"\x00".join(reference_table).encode("utf8")
+		)
+
+	field_names = sorted(book.field_data)
+	for field_name in field_names:
+		sections["field:%s" % field_name] = writer.write(
+			book.field_data[field_name].encode("utf8")
+		)
+
+	postings = book.get_postings()
+	if postings is not None:
+		words = sorted(postings)
+		counts = array("i")
+		offsets = array("i")
+		lines = array("i")
+		for word in words:
+			word_offsets, word_lines = postings[word]
+			counts.append(len(word_offsets))
+			offsets.extend(word_offsets)
+			lines.extend(word_lines)
+
+		sections["words"] = writer.write(
+			u"\x00".join(words).encode("utf8")
+		)
+		sections["counts"] = writer.write(counts)
+		sections["offsets"] = writer.write(offsets)
+		sections["lines"] = writer.write(lines)
+
+	field_postings = book.__dict__.get("field_postings") or {}
+	for field_name in sorted(field_postings):
+		postings = field_postings[field_name]
+		tokens = sorted(postings)
+		counts = array("i")
+		spans = array("i")
+		for token in tokens:
+			counts.append(len(postings[token]) // 2)
+			spans.extend(postings[token])
+
+		sections["fieldtokens:%s" % field_name] = writer.write(
+			u"\x00".join(tokens).encode("utf8")
+		)
+		sections["fieldcounts:%s" % field_name] = writer.write(counts)
+		sections["fieldspans:%s" % field_name] = writer.write(spans)
+
+	return dict(
+		type=type(book).__name__,
+		attributes=_simple_attributes(book, BOOK_ATTRIBUTES),
+		ref_type=ref_type,
+		fields=field_names,
+		field_postings=sorted(field_postings),
+		sections=sections,
+	)
+
+def write_index(index, filename, progress=lambda x:x):
+	"""Write index out to filename.
+
+	The index is written to a temporary file first, which then replaces
+	filename, so an existing index is never left half written.
+	progress is called with (book name, percentage) and writing stops if it
+	returns False, in which case False is returned."""
+	temp_filename = filename + ".tmp"
+	f = open(temp_filename, "wb")
+	try:
+		f.write(PREAMBLE.pack(MAGIC, FORMAT_VERSION, 0, 0))
+		writer = _SectionWriter(f)
+
+		books = []
+		length = float(len(index.books) + 1)
+		for idx, book in enumerate(index.books):
+			if not progress((book.bookname, 100*idx/length)):
+				f.close()
+				os.remove(temp_filename)
+				return False
+
+			books.append(_write_book(writer, book))
+
+		statistics = writer.write(
+			json.dumps(_encode_value(index.statistics), separators=(",", ":"))
+		)
+
+		header = dict(
+			type=type(index).__name__,
+			booktype=index.booktype.__name__,
+			byteorder=sys.byteorder,
+			attributes=_simple_attributes(index, INDEX_ATTRIBUTES),
+			sections=dict(statistics=statistics),
+			books=books,
+		)
+
+		header_data = json.dumps(header, separators=(",", ":"))
+		header_offset, header_length = writer.write(header_data)
+		f.seek(0)
+		f.write(PREAMBLE.pack(MAGIC, FORMAT_VERSION, header_offset,
+			header_length))
+	finally:
+		if not f.closed:
+			f.close()
+
+	# we may have the old file mapped, and windows won't let us rename over
+	# it in either case
+	close_index_file(filename)
+	if os.path.exists(filename):
+		os.remove(filename)
+
+	os.rename(temp_filename, filename)
+
+	# point everything at the new file, so that it can be unloaded and loaded
+	# again from there
+	index_file = IndexFile(filename)
+	index._mapped = index_file, index_file.header
+	for book, entry in zip(index.books, index_file.header["books"]):
+		book._mapped = index_file, entry
+		if "text" in book.__dict__:
+			resident_books[id(index_file), id(book)] = book
+
+	return True
+
+class IndexFile(object):
+	"""A memory mapped index file"""
+	def __init__(self, filename):
+		self.filename = os.path.abspath(filename)
+		self.file = open(filename, "rb")
+		try:
+			self.map = mmap.mmap(self.file.fileno(), 0,
+				access=mmap.ACCESS_READ)
+		except Exception:
+			self.file.close()
+			raise
+
+		magic, version, header_offset, header_length = \
+			PREAMBLE.unpack(self.map[:PREAMBLE.size])
+
+		if magic != MAGIC:
+			self.close()
+			raise IndexFileError("%s is not a search index" % filename)
+
+		if version != FORMAT_VERSION:
+			self.close()
+			raise IndexFileError(
+				"%s has index format version %d, expected %d" % (
+				filename, version, FORMAT_VERSION)
+			)
+
+		self.header = json.loads(
+			self.map[header_offset:header_offset + header_length]
+		)
+		self.swap_bytes = self.header["byteorder"] != sys.byteorder
+
+		# identifies this version of the file
+		info = os.fstat(self.file.fileno())
+		self.stamp = info.st_size, info.st_mtime
+
+		_open_files[self.filename] = self
+
+	def close(self):
+		if not self.file.closed:
+			self.map.close()
+			self.file.close()
+
+		# its books can't be unloaded any more, so they needn't be kept track
+		# of
+		resident_books.remove_if(lambda key: key[0] == id(self))
+
+	def section(self, entry, name):
+		if self.file.closed:
+			raise IndexFileError("%s has been closed" % self.filename)
+
+		offset, length = entry["sections"][name]
+		return self.map[offset:offset + length]
+
+	def array_section(self, entry, name):
+		a = array("i")
+		a.fromstring(self.section(entry, name))
+		if self.swap_bytes:
+			a.byteswap()
+
+		return a
+
+	def load_index(self, index, header):
+		"""Load the statistics into index"""
+		index.statistics = _decode_value(
+			json.loads(self.section(header, "statistics"))
+		)
+
+	def text_section(self, entry, name):
+		"""Get a UTF-8 text section, as a str if it is all ASCII, or
+		otherwise as unicode"""
+		text = self.section(entry, name)
+		if non_ascii.search(text):
+			return text.decode("utf8")
+
+		return text
+
+	def load_book(self, book, entry, name=None):
+		"""Load the sections of a book into it. If name is given, only the
+		sections needed for that attribute and the ones loaded with it are
+		loaded."""
+		if name is None or name in FIELD_ATTRIBUTES:
+			self.load_fields(book, entry)
+
+		if name is None or name not in FIELD_ATTRIBUTES:
+			self.load_text(book, entry)
+
+		resident_books[id(self), id(book)] = book
+
+	def load_text(self, book, entry):
+		text = self.text_section(entry, "text")
+		starts = self.array_section(entry, "starts")
+		lengths = self.array_section(entry, "lengths")
+
+		ref_type = entry["ref_type"]
+		if ref_type == "pairs":
+			ref_data = self.array_section(entry, "refs")
+			refs = zip(ref_data[::2], ref_data[1::2])
+		elif ref_type == "ints":
+			refs = self.array_section(entry, "refs")
+		else:
+			ref_data = self.section(entry, "refs")
+			if ref_type == "unicode":
+				ref_data = ref_data.decode("utf8")
+
+			refs = ref_data.split("\x00")
+			if not ref_data:
+				refs = []
+
+		reference_table = None
+		if "reference_table" in entry["sections"]:
+			reference_table = self.section(
+				entry, "reference_table").decode("utf8").split(u"\x00")
+
+			if not refs:
+				reference_table = []
+
+		postings = None
+		if "words" in entry["sections"]:
+			postings = {}
+			words = self.section(entry, "words").decode("utf8").split(u"\x00")
+			counts = self.array_section(entry, "counts")
+			offsets = self.array_section(entry, "offsets")
+			lines = self.array_section(entry, "lines")
+			upto = 0
+			for word, count in zip(words, counts):
+				postings[word] = (offsets[upto:upto + count],
+					lines[upto:upto + count])
+				upto += count
+
+		book.__dict__.update(
+			text=text,
+			index=zip(refs, starts, lengths),
+			postings=postings,
+		)
+
+		# don't lose a reference table worked out since the book was first
+		# loaded
+		if reference_table is not None or \
+				"reference_table" not in book.__dict__:
+			book.reference_table = reference_table
+
+	def load_fields(self, book, entry):
+		field_data = {}
+		for field_name in entry["fields"]:
+			field_data[field_name] = self.text_section(
+				entry, "field:%s" % field_name)
+
+		field_postings = None
+		if "field_postings" in entry:
+			field_postings = {}
+			for field_name in entry["field_postings"]:
+				field_postings[field_name] = self.load_field_postings(
+					entry, field_name)
+
+		book.__dict__.update(
+			field_data=field_data,
+			field_postings=field_postings,
+		)
+
+	def load_field_postings(self, entry, field_name):
+		postings = {}
+		tokens = self.section(entry, "fieldtokens:%s" % field_name)
+		if not tokens:
+			return postings
+
+		counts = self.array_section(entry, "fieldcounts:%s" % field_name)
+		spans = self.array_section(entry, "fieldspans:%s" % field_name)
+		upto = 0
+		for token, count in zip(tokens.decode("utf8").split(u"\x00"), counts):
+			postings[token] = spans[upto:upto + count*2]
+			upto += count*2
+
+		return postings
+
+def read_book(index_file, entry):
+	"""Make the book described by entry in index_file. It will load its
+	sections when first used."""
+	from search import indexed_text
+
+	book_type = getattr(indexed_text, entry["type"])
+	book = book_type.__new__(book_type)
+	book.__dict__.update(_decode_attributes(entry["attributes"]))
+	book._mapped = index_file, entry
+	return book
+
+def book_location(book):
+	"""Get (filename, stamp, book number) for a book read from an index
+	file which is still open, or None if it wasn't read from one"""
+	mapped = book.__dict__.get("_mapped")
+	if mapped is None or mapped[0].file.closed:
+		return None
+
+	source, entry = mapped
+	for number, item in enumerate(source.header["books"]):
+		if item is entry:
+			return source.filename, source.stamp, number
+
+	return None
+
+def read_index(filename):
+	"""Read the index in filename.
+
+	Only the header is read here; each book loads itself from the mapped
+	file when it is first searched."""
+	from search import index as index_module
+	from search import indexed_text
+
+	index_file = IndexFile(filename)
+	header = index_file.header
+
+	books = [read_book(index_file, entry) for entry in header["books"]]
+
+	index_type = getattr(index_module, header["type"])
+	index = index_type.__new__(index_type)
+	index.__dict__.update(_decode_attributes(header["attributes"]))
+	index.booktype = getattr(indexed_text, header["booktype"])
+	index._mapped = index_file, header
+	index.books = books
+	return index
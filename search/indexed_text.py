@@ -2,6 +2,9 @@ from backend.bibleinterface import biblemgr
 from swlib.pysw import VK, TOP, SW, TK
 import re
 import sys
+import hashlib
+from array import array
+from bisect import bisect_left
 from util.debug import dprint, WARNING, ERROR, is_debugging
 from util.unicode import to_unicode, to_str
 
@@ -9,6 +12,104 @@ from util.unicode import to_unicode, to_str
 from search.query_parser import removeformatting
 from search import process_text
 from search import fields
+from search.postings import (
+	build_postings, build_field_postings, TermMatcher, FieldPostings
+)
+from search import index_file
+
+# how much a term matching again on a line counts (k1) and how much the
+# length of the lines matters (b) in BM25 scores when ranking results
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# the score a match whose terms are all on one word gets when ranking,
+# divided by the number of words it spans
+PROXIMITY_WEIGHT = 1.
+
+def tokenized_fields():
+	"""Get the names of the fields which have postings built for them"""
+	return [field.field_name for field in fields.all_fields if field.tokenized]
+
+def entries_fingerprint(items):
+	"""Get a fingerprint of the (key text, raw entry) pairs of a text, to
+	tell whether it has changed"""
+	fingerprint = hashlib.md5()
+	for key_text, raw_entry in items:
+		fingerprint.update(key_text)
+		fingerprint.update("\x00")
+		fingerprint.update(raw_entry)
+		fingerprint.update("\x00")
+
+	return fingerprint.hexdigest()
+
+def top_level_path(path):
+	"""Get the path of the top level node of a general book which path is
+	in (or is)"""
+	return u"/".join(path.split(u"/")[:2])
+
+def read_entry_chunks(module, size):
+	"""Read the (key text, raw entry) pairs of all the entries of a
+	dictionary, yielding them size at a time.
+
+	The module is gone through once from the top, rather than finding the
+	start of each chunk by its key and reading it again for the keys, which
+	is slow for large dictionaries. Collecting the text of a chunk puts the
+	module's key back afterwards, so we carry on from where the chunk
+	ended."""
+	module.setPosition(TOP)
+	module.Error()
+
+	items = []
+	while not ord(module.Error()):
+		items.append((module.getKeyText(), module.getRawEntry()))
+		module.increment(1)
+		if len(items) == size:
+			yield items
+			items = []
+
+	if items:
+		yield items
+
+def read_tree_chunks(module, start=None):
+	"""Read the (key text, raw entry) pairs of the nodes of a general book,
+	and the ids of the nodes (see GenbookText), yielding (path of the top
+	level node, pairs, ids) for each top level node along with all the nodes
+	under it.
+
+	The tree is gone through once from the top in depth first order, which
+	is the order the module increments in, so the nodes under a top level
+	node come straight after it. As with read_entry_chunks, collecting the
+	text of a chunk puts the module's key back afterwards, so we carry on
+	from where it ended. If start is given, only the top level
+	node with that path is read."""
+	if start is None:
+		module.setPosition(TOP)
+	else:
+		module.getKey().setText(to_str(start, module))
+
+	module.Error()
+
+	top = None
+	items = []
+	ids = []
+	while not ord(module.Error()):
+		key_text = module.getKeyText()
+		path = top_level_path(to_unicode(key_text, module))
+		if path != top and items:
+			yield top, items, ids
+			if start is not None:
+				return
+
+			items = []
+			ids = []
+
+		top = path
+		items.append((key_text, module.getRawEntry()))
+		ids.append(SW.TreeKeyIdx.castTo(module.getKey()).getOffset())
+		module.increment(1)
+
+	if items:
+		yield top, items, ids
 
 class IndexedText(object):
 	"""A bit of text, one reference per line, with an index built against it"""
@@ -17,6 +118,8 @@ class IndexedText(object):
 		self.index = [] # ref, start, length
 		self.text = ""
 		self.field_data = {}
+		self.postings = None
+		self.field_postings = None
 
 		self.bookname = bookname or version
 		self.version = version
@@ -26,6 +129,27 @@ class IndexedText(object):
 		if create_index:
 			self.collect_text(module)
 	
+	def __getattr__(self, name):
+		# books read from an index file load their text, index, fields and
+		# postings from it when they are first used
+		mapped = self.__dict__.get("_mapped")
+		if mapped is None or name not in index_file.LAZY_ATTRIBUTES:
+			raise AttributeError(name)
+
+		source, entry = mapped
+		source.load_book(self, entry, name)
+		return self.__dict__[name]
+
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		if "_mapped" in state:
+			for name in index_file.LAZY_ATTRIBUTES:
+				state[name] = getattr(self, name)
+
+			del state["_mapped"]
+
+		return state
+
 	def collect_text(self, module):
 		"""Collect the text for a given module, into a reference per line
 		format, then build an index against it"""
@@ -35,43 +159,10 @@ class IndexedText(object):
 		MAGIC_TOKEN = u"\uFDD0"
 
 		xml_token = "&#%d;" % ord(MAGIC_TOKEN)
-		items = []
-
-		old_key = module.getKey()
-		if not ord(old_key.Persist()):
-			# if it wasn't a persistent key, the module owns it
-			# so take a copy of it, and say we own it
-			old_key = old_key.clone()
-			old_key.thisown = True
 
-		entries = self.get_entries()
-		
-		key = self.get_key(module)
-		key.Persist(1)
-		
-		module.setKey(key)
-		if not entries:
-			module.setPosition(TOP)
-
-		key_entry = self.get_key_entry(key)
-		
-		# clear the error
-		module.Error()
-		
-		i = 0
-		if not entries:
-			entries = sys.maxint
-
-		# gather the text		
-		while not ord(module.Error()) and i < entries:
-			items.append((key_entry(), module.getRawEntry()))
-			module.increment(1)
-			i += 1
-			
-		
-		# the key's headings attribute gets set to 1 at the end of the
-		# previous loop...
-		if isinstance(key, VK): key.Headings(0)
+		old_key = self.save_key(module)
+		key, items = self.read_entries(module)
+		self.fingerprint = entries_fingerprint(items)
 		
 		# try and do smart parsing
 		content = None
@@ -118,6 +209,9 @@ class IndexedText(object):
 		content = removeformatting(content)
 		self.text = re.sub("\s*%s\s*" % MAGIC_TOKEN, "\n", content)
 		self.text, self.field_data = self.extract_strongs(self.text)
+		self.postings = build_postings(self.text)
+		self.field_postings = build_field_postings(self.field_data,
+			tokenized_fields())
 
 		if self.text.count('\n') + 1 != len(items):
 			# it is possible that decoding the utf8 of the book above
@@ -148,6 +242,78 @@ class IndexedText(object):
 		# time the user uses it!
 		module.Error()
 
+	def save_key(self, module):
+		"""Get a copy of the module's current key, to restore afterwards"""
+		old_key = module.getKey()
+		if not ord(old_key.Persist()):
+			# if it wasn't a persistent key, the module owns it
+			# so take a copy of it, and say we own it
+			old_key = old_key.clone()
+			old_key.thisown = True
+
+		return old_key
+
+	def read_entries(self, module):
+		"""Read the raw entries of this text from the module.
+
+		Returns the key, which the module is left set to, and a list of
+		(key text, raw entry) pairs."""
+		items = []
+		entries = self.get_entries()
+		
+		key = self.get_key(module)
+		key.Persist(1)
+		
+		module.setKey(key)
+		if not entries:
+			module.setPosition(TOP)
+
+		key_entry = self.get_key_entry(key)
+		
+		# clear the error
+		module.Error()
+		
+		i = 0
+		if not entries:
+			entries = sys.maxint
+
+		# gather the text		
+		while not ord(module.Error()) and i < entries:
+			items.append((key_entry(), module.getRawEntry()))
+			module.increment(1)
+			i += 1
+			
+		
+		# the key's headings attribute gets set to 1 at the end of the
+		# previous loop...
+		if isinstance(key, VK): key.Headings(0)
+
+		return key, items
+
+	def current_fingerprint(self):
+		"""Get the fingerprint of this text as it now is in the module"""
+		module = self.load_module(self.version)
+		old_key = self.save_key(module)
+		try:
+			key, items = self.read_entries(module)
+		finally:
+			module.setKey(old_key)
+			module.Error()
+
+		return entries_fingerprint(items)
+
+	def is_out_of_date(self, current_fingerprint=None):
+		"""Has this text changed in the module since it was indexed?
+		current_fingerprint is the fingerprint of the text as it now is, if
+		it is known already."""
+		# XXX: Indexes created before fingerprints were added don't have
+		# this field, so we can't tell and have to assume they have changed.
+		fingerprint = self.__dict__.get("fingerprint")
+		if current_fingerprint is None and fingerprint is not None:
+			current_fingerprint = self.current_fingerprint()
+
+		return fingerprint is None or fingerprint != current_fingerprint
+
 	def extract_strongs(self, text):
 		# put offset in an array, so that we can write to it in the callback
 		offset = [0]
@@ -189,6 +355,7 @@ class IndexedText(object):
 	def create_index_against_text(self, module, key):
 		"""Build an index against the text"""
 		self.index = [] # reference, start, length
+		self.reference_table = []
 		
 		if self.get_entries():
 			module.getKey().setText(to_str(self.start, module))
@@ -207,57 +374,165 @@ class IndexedText(object):
 			ind = self.get_index(key)
 			start, end = match.span()
 			self.index.append((ind, start, end-start))
+			self.reference_table.append(to_unicode(key.getText(), module))
 			module.increment(1)
 		
 	def find_index(self, mylist):
-		"""Turn a sorted list of begin, end pairs into references using 
+		"""Turn a list of begin, length pairs into references using 
 		the index"""
+		return [
+			self.get_range_text(first, last)
+			for first, last in self.find_ranges(mylist)
+		]
+
+	def find_ranges(self, mylist):
+		"""Turn a list of begin, length pairs into the (first line, last line)
+		that each of them covers"""
 		if not mylist:
 			return []
 		
-		module = self.load_module(self.version)		
-		key = self.get_key(module)
+		starts, ends = self.get_line_offsets()
 
-		upto = 0
-		begin, end = mylist[upto]
 		ret = []
-		for idx, (key_value, start, length) in enumerate(self.index):
-			# find in index
-			# mylist must be sorted
-			while start + length >= begin:
-				# loop here because search phrase may be
-				# multiple times in one verse, so we get all
-				n = 1
-
-				# This loop tells us if we go over verse boundaries
-				while (idx + n < len(self.index) and 
-					self.index[idx + n][1] < begin + end):
-					n += 1
-	
-				self.set_key(module, key, key_value)
-				ref1 = to_unicode(key.getText(), module)
-
-				if n > 1:
-					self.set_key(module, key, self.index[idx+n-1][0])
-					ref2 = to_unicode(key.getText(), module)
-					ret.append("%s - %s" % (ref1, ref2))
+		for begin, length in mylist:
+			# find the first line which doesn't end before our match
+			idx = bisect_left(ends, begin)
+			if idx == len(ends):
+				dprint(
+					WARNING, 
+					"Exceeded index length "
+					"(this usually means 0 width match at the end of the text)", 
+					(begin, length)
+				)
+				break
 
-				else:
-					ret.append(ref1)
-	
-				upto += 1
-				if upto >= len(mylist):
-					return ret
+			# and the last line which starts before its end, so that we know
+			# if we go over verse boundaries
+			last = max(idx, bisect_left(starts, begin + length) - 1)
+			ret.append((idx, last))
 
-				begin, end = mylist[upto]
-		
-		dprint(
-			WARNING, 
-			"Exceeded index length "
-			"(this usually means 0 width match at the end of the text)", 
-			mylist[upto]
-		)
 		return ret
+
+	def count_matches(self, mylist):
+		"""Count a list of begin, length pairs by the group (see
+		get_line_group) of the line each begins on, without working out the
+		lines they cover. This returns a sorted list of (group, count)."""
+		if not mylist:
+			return []
+
+		starts, ends = self.get_line_offsets()
+
+		counts = {}
+		for begin, length in mylist:
+			idx = bisect_left(ends, begin)
+			if idx == len(ends):
+				# as in find_ranges
+				break
+
+			group = self.get_line_group(idx)
+			counts[group] = counts.get(group, 0) + 1
+
+		return sorted(counts.items())
+
+	def get_line_group(self, line):
+		"""Get what matches on a line are counted under when counting them.
+		By default they are all counted together."""
+		return None
+
+	def rank_matches(self, mylist, wordlist, expansions, weights):
+		"""Score a list of begin, length pairs by how relevant the lines they
+		cover are, returning a list of (score, first line, last line).
+
+		Each search term is scored with BM25 (the weights are from
+		Index.get_ranking_weights), counting its matches on the lines, and
+		matches where the terms are closer together get a bonus. When a
+		range of lines has several matches, the best score is kept."""
+		if not mylist:
+			return []
+
+		term_weights, average_length = weights
+		b = BM25_B
+		if not average_length:
+			# don't normalise by the length of lines
+			b, average_length = 0, 1
+
+		if expansions is None:
+			expansions = {}
+
+		matchers = [self.get_matcher(word, expansions.get(word.pattern))
+			for word, length in wordlist]
+
+		starts, ends = self.get_line_offsets()
+
+		scores = {}
+		for (begin, length), (first, last) in zip(mylist,
+				self.find_ranges(mylist)):
+			lower, upper = starts[first], ends[last]
+			normalise = BM25_K1 * (1 - b + b * (upper - lower) / average_length)
+
+			score = 0.
+			for matcher, weight in zip(matchers, term_weights):
+				frequency = 0
+				for span in matcher.spans(lower, upper):
+					frequency += 1
+
+				score += weight * frequency * (BM25_K1 + 1) / \
+					(frequency + normalise)
+
+			# the fewer words the match spans, the closer the terms are
+			words = self.text.count(" ", begin, begin + length) + 1
+			score += PROXIMITY_WEIGHT / words
+
+			if score > scores.get((first, last), -1):
+				scores[first, last] = score
+
+		return [(score, first, last)
+			for (first, last), score in sorted(scores.items())]
+
+	def get_range_text(self, first, last):
+		"""Get the reference of the lines first to last as text"""
+		references = self.get_reference_table()
+		if last > first:
+			return "%s - %s" % (references[first], references[last])
+
+		return references[first]
+
+	def get_line_offsets(self):
+		"""Get sorted arrays of the start and end offsets of each line"""
+		try:
+			return self._line_offsets
+		except AttributeError:
+			pass
+
+		starts = array("i")
+		ends = array("i")
+		for key_value, start, length in self.index:
+			starts.append(start)
+			ends.append(start + length)
+
+		self._line_offsets = starts, ends
+		return starts, ends
+
+	def get_reference_table(self):
+		"""Get the reference of each line as text"""
+		try:
+			table = self.reference_table
+		except AttributeError:
+			# Indexes created before reference tables were added don't have
+			# this field, so work it out once with a key
+			table = None
+
+		if table is None:
+			module = self.load_module(self.version)
+			key = self.get_key(module)
+			table = []
+			for key_value, start, length in self.index:
+				self.set_key(module, key, key_value)
+				table.append(to_unicode(key.getText(), module))
+
+			self.reference_table = table
+
+		return table
 		
 	def cut_down_index(self, bottom, top):
 		### not fully implemented for non-bibles
@@ -302,7 +577,7 @@ class IndexedText(object):
 	# --- Searching functions
 	def multi_search(self, wordlist, proximity, is_word_proximity=True,
 		average_word=0, minimum_average=5, ignore_minimum=False, 
-		excludes=(), strongs=(), excluded_strongs=()):
+		excludes=(), strongs=(), excluded_strongs=(), expansions=None):
 
 		# t is shorter to use than self.text, also should be slightly faster
 		t = self.text
@@ -328,17 +603,50 @@ class IndexedText(object):
 		len_words = 0#len(words)
 		lastbounds = (0, 0)
 		
+		# the words that wildcard terms can match, by their patterns
+		if expansions is None:
+			expansions = {}
+
+		wordlist = [self.get_matcher(word, expansions.get(word.pattern))
+			for word in wordlist]
+		excludes = [self.get_matcher(word, expansions.get(word.pattern))
+			for word, length in excludes]
+		
+		# if the postings tell us a word isn't in this book, we can't match
+		for matcher in wordlist:
+			if matcher.is_empty():
+				return []
+
+		# and we needn't check for excluded words which aren't in it
+		excludes = [matcher for matcher in excludes if not matcher.is_empty()]
+
 		self.start_strongs_find(strongs, excluded_strongs)
 
+		# nor can we match if one of the strong's numbers isn't in it (the
+		# lists just have their end sentinel)
+		for strongs_list in self.strongs[0]:
+			if len(strongs_list) == 1:
+				return []
+
 		if wordlist:
 			# we have to start with the wordlist if we can, otherwise we may
 			# not get references where the word overlaps with the strong's
-			# number
-			result_iter = wordlist.pop(0).finditer(t)
-		else:			
-			result_iter = self.strongs[0].pop(0)
-			self.strongs_upto[0].pop(0)
-			self.current_strongs[0].pop(0)
+			# number. Start with the rarest word, as every match of it has
+			# to be checked for the others. The ranges are built around the
+			# matches of this word, so a match is the rarest word with the
+			# nearest occurrence of each other word, whatever order they were
+			# given in. (Without postings we can't tell which is rarest, so
+			# this is the first of the terms as Index.plan_search ordered
+			# them.)
+			driver = min(wordlist, key=lambda matcher: matcher.estimate())
+			wordlist.remove(driver)
+			result_iter = driver.spans()
+		else:
+			lengths = [len(strongs_list) for strongs_list in self.strongs[0]]
+			driver = lengths.index(min(lengths))
+			result_iter = self.strongs[0].pop(driver)
+			self.strongs_upto[0].pop(driver)
+			self.current_strongs[0].pop(driver)
 			
 			# Knock sentinel off end
 			result_iter = result_iter[:-1]
@@ -378,9 +686,10 @@ class IndexedText(object):
 				if upper < len_t and t[upper] not in " \n":
 					upper = t.find(" ", upper, len_t)
 				
-				# make sure we stay in bounds
+				# make sure we stay in bounds (find gives -1 if there are no
+				# more spaces)
 				if lower < 0: lower = 0
-				if upper > len_t: upper = len_t
+				if upper > len_t or upper == -1: upper = len_t
 					
 			else:
 				lower = match_start
@@ -394,33 +703,12 @@ class IndexedText(object):
 
 			
 			bounds = lower, upper
-			textrange = t[lower: upper]
-
-			# check for the excluded words in our range
-			excluded = False
-			for exclude, length in excludes:
-				if exclude.search(textrange):
-					excluded = True
-					break
-
-			if excluded: 
-				continue
-			
-			self.set_strongs_range(lower, upper, excluded=True)
-			for strongs_info in self.current_strongs[1]:
-				if strongs_info:
-					excluded = True
-					break
-
-			if excluded: 
-				continue
-				
 
 			# check for all the words to match
 			inrange = True
 			
 			for comp in wordlist:
-				if not comp.search(textrange):
+				if not comp.search(lower, upper):
 					inrange = False
 					break
 			
@@ -435,22 +723,36 @@ class IndexedText(object):
 
 			if not inrange:
 				continue
+
+			# check for the excluded words in our range. This is done last,
+			# as most ranges don't get this far
+			excluded = False
+			for exclude in excludes:
+				if exclude.search(lower, upper):
+					excluded = True
+					break
+
+			if excluded: 
+				continue
+			
+			self.set_strongs_range(lower, upper, excluded=True)
+			for strongs_info in self.current_strongs[1]:
+				if strongs_info:
+					excluded = True
+					break
+
+			if excluded: 
+				continue
 			
 			# make range as narrow as possible
 			docontinue = False
 			start, end = match_start, match_end
 
 			for comp in wordlist:
-				backrange = t[bounds[0]: match_start]
-				forwardrange = t[match_end: bounds[1]]
-				
 				# find smallest backwards match				
-				last = None
-				for j in comp.finditer(backrange):
-					last = j
-								
+				last = comp.last(bounds[0], match_start)
 				if last:
-					backind = last.start() + bounds[0]
+					backind = last[0]
 				else: 
 					backind = -1
 
@@ -458,9 +760,9 @@ class IndexedText(object):
 					backind = -1
 	
 				# find smallest forwards match
-				forward_match = comp.search(forwardrange)
+				forward_match = comp.search(match_end, bounds[1])
 				if forward_match: 
-					forwardind = forward_match.end() + match_end
+					forwardind = forward_match[1]
 				else: 
 					forwardind = -1
 				
@@ -551,6 +853,40 @@ class IndexedText(object):
 
 		return mylist
 	
+	def get_matcher(self, regex, words=None):
+		"""Get a TermMatcher for regex against this text. words are the words
+		it can match, if we know them."""
+		return TermMatcher(regex, self.text, self.get_postings(), words)
+
+	def get_postings(self):
+		# XXX: Indexes created before word postings were added don't have
+		# this field, so they will just use regular expressions over the
+		# whole text.
+		try:
+			return self.postings
+		except AttributeError:
+			return None
+
+	def get_field_postings(self, field_type):
+		"""Get the FieldPostings to look up terms in field_type with, or None
+		if we don't have postings for it"""
+		# XXX: Indexes created before field postings were added don't have
+		# this field, so they will just use regular expressions over the
+		# field data.
+		try:
+			field_postings = self.field_postings
+		except AttributeError:
+			return None
+
+		if not field_postings or field_type not in field_postings:
+			return None
+
+		lookups = self.__dict__.setdefault("_field_lookups", {})
+		if field_type not in lookups:
+			lookups[field_type] = FieldPostings(field_postings[field_type])
+
+		return lookups[field_type]
+
 	def start_strongs_find(self, words, excluded):
 		"""Set the strongs words we are looking for. This finds them and sets
 		up to look for them when needed"""
@@ -559,15 +895,12 @@ class IndexedText(object):
 		self.current_strongs = [[], []]
 		for idx, group in enumerate((words, excluded)):
 			for (field_type, word) in group:
-				l = []
-				word = "%s[^\x00]*\x00(?P<first>\d+) (?P<second>\d+)" % word
-
-				regex = re.compile(word, re.MULTILINE|re.UNICODE)
-				for item in regex.finditer(self.field_data[field_type]):
-					l.append((
-							int(item.group("first")),
-							int(item.group("second"))
-					))
+				lookup = self.get_field_postings(field_type)
+				if lookup is not None:
+					l = lookup.spans(word)
+
+				else:
+					l = self.find_field_spans(field_type, word)
 				
 				# end sentinel - we use the end sentinel so that we don't have to
 				# check for the end of the list
@@ -577,6 +910,21 @@ class IndexedText(object):
 				self.strongs[idx].append(l)
 				self.current_strongs[idx].append([])
 
+	def find_field_spans(self, field_type, word):
+		"""Find the (start, end) spans of word in field_type by going through
+		all the field data"""
+		l = []
+		word = "%s[^\x00]*\x00(?P<first>\d+) (?P<second>\d+)" % word
+
+		regex = re.compile(word, re.MULTILINE|re.UNICODE)
+		for item in regex.finditer(self.field_data[field_type]):
+			l.append((
+					int(item.group("first")),
+					int(item.group("second"))
+			))
+
+		return l
+
 	def set_strongs_range(self, start, end, excluded=False):
 		"""Set the current strongs to the ones which fall in this range.
 		start >= previous start values"""
@@ -670,18 +1018,31 @@ class VerseIndexedText(IndexedText):
 
 	def get_index(self, key):
 		return (key.Chapter(), key.Verse())
+
+	def get_line_group(self, line):
+		# the chapter
+		return self.index[line][0][0]
 	
 	def set_key(self, module, key, to):
 		key.Chapter(to[0])
 		key.Verse(to[1])
 
 class DictionaryIndexedText(IndexedText):
-	def __init__(self, version, start, entries, create_index=True):
+	def __init__(self, version, start, entries, create_index=True,
+		items=None):
+		"""items are the (key text, raw entry) pairs of the entries, if they
+		have already been read (see read_entry_chunks). Otherwise they are
+		read from the module, starting at start."""
 		self.start = start
 		self.entries = entries
+		self._items = items
 		bookname = start# + _(" (%d entries) ") % entries
-		super(DictionaryIndexedText, self).__init__(version, bookname,
-			create_index=create_index)
+		try:
+			super(DictionaryIndexedText, self).__init__(version, bookname,
+				create_index=create_index)
+		finally:
+			# they are only needed while collecting the text
+			del self._items
 	
 	def get_key(self, module):
 		key = module.getKey()
@@ -691,23 +1052,88 @@ class DictionaryIndexedText(IndexedText):
 	def get_entries(self):
 		return self.entries
 
+	def read_entries(self, module):
+		items = self.__dict__.get("_items")
+		if items is None:
+			return super(DictionaryIndexedText, self).read_entries(module)
+
+		return None, items
+
+	def create_index_against_text(self, module, key):
+		items = self.__dict__.get("_items")
+		if items is None:
+			return super(DictionaryIndexedText, self).create_index_against_text(
+				module, key)
+
+		# we already have the keys, so we needn't go through the module
+		# again for them
+		self.index = [] # reference, start, length
+		self.reference_table = []
+		iterator = re.compile("^.*$", re.M).finditer(self.text)
+		for (key_text, entry), match in zip(items, iterator):
+			start, end = match.span()
+			self.index.append((key_text, start, end-start))
+			self.reference_table.append(to_unicode(key_text, module))
+
 
 class GenbookText(IndexedText):
-	def get_key_entry(self, key):
-		return key.getLocalName
+	"""A top level node of a general book and all the nodes under it, one
+	node per line in depth first order.
+
+	The lines are referred to in the index by the offset of their node in
+	the book's tree index, which is much smaller than its path and is enough
+	to find the node again (see set_key)."""
+	def __init__(self, version, start, create_index=True, items=None,
+		ids=None):
+		"""start is the path of the top level node. items and ids are the
+		(key text, raw entry) pairs and node ids of its nodes, if they have
+		already been read (see read_tree_chunks). Otherwise they are read
+		from the module."""
+		self.start = start
+		self._items = items
+		self._ids = ids
+		try:
+			super(GenbookText, self).__init__(version, start,
+				create_index=create_index)
+		finally:
+			# they are only needed while collecting the text
+			del self._items, self._ids
+
+	def read_nodes(self, module):
+		"""Get the (key text, raw entry) pairs and ids of our nodes"""
+		items = self.__dict__.get("_items")
+		if items is not None:
+			return items, self._ids
+
+		for start, items, ids in read_tree_chunks(module, self.start):
+			return items, ids
+
+		return [], []
 
 	def get_key(self, module):
-		key = module.getKey()
+		key = TK(module.getKey(), module)
 		key.setText(to_str(self.start, module))
-		return TK(key)
-
-#	def get_key(self, module):
-#		tk = TK(module.getKey())
-#		tk.root()
-#		return tk
-#	
-#	def get_index(self, key):
-#		return str(tk)
+		return key
+
+	def get_index(self, key):
+		return key.getOffset()
+
+	def set_key(self, module, key, to):
+		key.setOffset(to)
+
+	def read_entries(self, module):
+		items, ids = self.read_nodes(module)
+		return None, items
+
+	def create_index_against_text(self, module, key):
+		items, ids = self.read_nodes(module)
+		self.index = [] # node id, start, length
+		self.reference_table = []
+		iterator = re.compile("^.*$", re.M).finditer(self.text)
+		for (key_text, entry), node_id, match in zip(items, ids, iterator):
+			start, end = match.span()
+			self.index.append((node_id, start, end-start))
+			self.reference_table.append(to_unicode(key_text, module))
 
 if __name__ == '__main__':
 	from util import timeit
@@ -0,0 +1,99 @@
+"""Searches several indexes with one query, e.g. to compare how different
+translations word something.
+
+The search of each index is started before any results are read, so that the
+search workers have the books of all of them to work on at once. The results
+are then lined up by the reference of the line each starts on, so that the
+same verse in each translation comes together.
+"""
+from search.index import COMBINED, COUNT, RANKED
+from util.search_utils import GetIndex
+
+def MultiSearch(versions, regexes, excl_regexes, fields, excl_fields,
+	type=COMBINED, proximity=15, is_word_proximity=True,
+	progress=lambda x:x, searchrange=None):
+	"""Search the indexes of versions for a query, parsed as for
+	Index.Search. The indexes are read with GetIndex, so ones which have been
+	used recently are shared rather than read again.
+
+	Out: the results lined up as described in align_results, and whether
+	they may be incorrect in any of the indexes."""
+	assert not type & (COUNT | RANKED), \
+		"Only finding matches is supported across several indexes"
+
+	indexes = [GetIndex(version) for version in versions]
+
+	cancelled = []
+	def index_progress(number, version):
+		def report((bookname, percent)):
+			continuing = progress((u"%s: %s" % (version, bookname),
+				(100 * number + percent) / len(indexes)))
+			if not continuing:
+				cancelled.append(version)
+
+			return continuing
+
+		return report
+
+	searches = [
+		index.IterSearch(regexes, excl_regexes, fields, excl_fields, type,
+			proximity, is_word_proximity,
+			index_progress(number, index.version), searchrange)
+		for number, index in enumerate(indexes)
+	]
+
+	results = [[] for index in indexes]
+	try:
+		for index_results, search in zip(results, searches):
+			for book_results in search:
+				index_results += book_results
+
+			if cancelled:
+				# the search workers have been stopped, so the rest of the
+				# searches won't get any more results
+				break
+
+	finally:
+		for search in searches:
+			close = getattr(search, "close", None)
+			if close is not None:
+				close()
+
+	maybe_incorrect = any(index.MaybeIncorrectResults(fields)
+		for index in indexes)
+
+	return align_results(indexes, results), maybe_incorrect
+
+def align_results(indexes, results):
+	"""Line up the results of searching each of indexes by the reference of
+	the line they start on. results are the (book number, first line, last
+	line) results for each index.
+
+	This returns a list of (reference, {version: results starting on it}).
+	They are in the order of the results of the first index, with any
+	references which only the others have placed after the one they come
+	after in those."""
+	order = {}
+	aligned = {}
+	for index_number, (index, index_results) in enumerate(
+			zip(indexes, results)):
+		# where the references of this index which the earlier ones don't
+		# have go: before all of theirs, until we come to one they have
+		after = ()
+		if index_number:
+			after = (-1,)
+
+		for position, (number, first, last) in enumerate(index_results):
+			reference = index.books[number].get_range_text(first, first)
+			if reference in order:
+				after = order[reference]
+			else:
+				order[reference] = after + (index_number, position)
+				aligned[reference] = {}
+
+			aligned[reference].setdefault(index.version, []).append(
+				(number, first, last)
+			)
+
+	return [(reference, aligned[reference])
+		for reference in sorted(order, key=order.get)]
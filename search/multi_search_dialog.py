@@ -0,0 +1,49 @@
+"""Shows the results of searching several versions at once (see
+search.multi_search), a reference per row and a column for each version, so
+that translations can be compared."""
+import wx
+
+import guiconfig
+import events
+
+class MultiSearchDialog(wx.Dialog):
+	def __init__(self, parent, versions, aligned, maybe_incorrect, title):
+		"""aligned and maybe_incorrect are as MultiSearch gives them"""
+		super(MultiSearchDialog, self).__init__(parent, title=title,
+			style=wx.DEFAULT_DIALOG_STYLE|wx.RESIZE_BORDER)
+
+		self.references = [reference for reference, found in aligned]
+
+		text = _("Double click on a reference to go to it. The numbers are "
+			"how many results each version has starting there.")
+		if maybe_incorrect:
+			text += "\n" + _("Some of the books have old search indexes, "
+				"so these results may be incorrect.")
+
+		label = wx.StaticText(self, label=text)
+
+		self.list = wx.ListCtrl(self, style=wx.LC_REPORT|wx.LC_SINGLE_SEL)
+		self.list.InsertColumn(0, _("Reference"), width=150)
+		for column, version in enumerate(versions):
+			self.list.InsertColumn(column + 1, version,
+				format=wx.LIST_FORMAT_RIGHT)
+
+		for row, (reference, found) in enumerate(aligned):
+			self.list.InsertStringItem(row, reference)
+			for column, version in enumerate(versions):
+				if version in found:
+					self.list.SetStringItem(row, column + 1,
+						str(len(found[version])))
+
+		self.list.Bind(wx.EVT_LIST_ITEM_ACTIVATED, self.on_activated)
+
+		sizer = wx.BoxSizer(wx.VERTICAL)
+		sizer.Add(label, 0, wx.GROW|wx.ALL, 6)
+		sizer.Add(self.list, 1, wx.GROW|wx.LEFT|wx.RIGHT, 6)
+		sizer.Add(self.CreateStdDialogButtonSizer(wx.OK), 0, wx.GROW|wx.ALL, 6)
+		self.SetSizer(sizer)
+		self.Size = 500, 500
+
+	def on_activated(self, event):
+		guiconfig.mainfrm.set_bible_ref(self.references[event.m_itemIndex],
+			source=events.SEARCH)
@@ -0,0 +1,512 @@
+"""Word postings for indexed text.
+
+For every word in a book we keep the sorted character offsets that the word
+starts at, and the line (that is, verse or entry) each occurrence is on. Terms
+which are plain words (or the alternation of words that stemming produces)
+can then be found from these lists instead of scanning the whole text with a
+regular expression.
+
+>>> postings = build_postings(u"In the beginning\\nthe Word")
+>>> sorted(postings)
+[u'beginning', u'in', u'the', u'word']
+>>> list(postings[u"the"][0]), list(postings[u"the"][1])
+([3, 17], [0, 1])
+
+>>> plain_words(r"\\bWord\\b")
+['word']
+>>> plain_words(r"\\b(?:love|loved|loving)\\b")
+['love', 'loved', 'loving']
+>>> print plain_words(r"\\b\\w*ites\\b")
+None
+>>> print plain_words(r"\\btest\\sing\\b")
+None
+
+Phrases of plain words are found from the postings of their rarest word, as
+the offset that word is at in the phrase tells us where the phrase would
+start.
+
+>>> phrase_words(r"\\bin\\sthe\\sBeginning\\b")
+['in', 'the', 'beginning']
+>>> print phrase_words(r"\\bin\\sthe\\sbeg\\w*\\b")
+None
+
+Fields (strong's numbers and morphology) have postings too, from each token
+of a field's value to the spans of text it is attached to.
+
+>>> field_postings = build_field_postings({
+... 	"strongs": u"G3588 robinson:T-NSM\\x000 2\\nG3056 robinson:N-NSM\\x004 8"
+... }, ["strongs"])
+>>> lookup = FieldPostings(field_postings["strongs"])
+>>> lookup.spans("G3056")
+[(4, 8)]
+>>> lookup.spans(r":N-NSM\\b")
+[(4, 8)]
+>>> lookup.spans(r"robinson:T\\b")
+[(0, 2)]
+>>> lookup.spans(r"robinson:T-N\\b")
+[]
+"""
+import re
+import sre_parse
+import sre_constants
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+import heapq
+
+word_re = re.compile(r"\w+", re.UNICODE)
+plain_term_re = re.compile(r"^\\b(?:\(\?:(\w+(?:\|\w+)*)\)|(\w+))\\b$",
+	re.UNICODE)
+
+# the words of a phrase are separated by \s (which can match across verses)
+# or a space
+phrase_term_re = re.compile(r"^\\b(\w+(?:(?:\\s| )\w+)+)\\b$", re.UNICODE)
+phrase_separator_re = re.compile(r"\\s| ")
+
+def build_postings(text):
+	"""Build the postings for text.
+
+	This returns a dictionary of lower case word -> (offsets, lines), where
+	offsets are the character offsets each occurrence starts at and lines are
+	the line numbers they are on."""
+	postings = {}
+	line = 0
+	next_line = text.find(u"\n")
+	if next_line == -1:
+		next_line = len(text)
+
+	for match in word_re.finditer(text):
+		start = match.start()
+		while start > next_line:
+			line += 1
+			next_line = text.find(u"\n", next_line + 1)
+			if next_line == -1:
+				next_line = len(text)
+
+		word = match.group().lower()
+		if word not in postings:
+			postings[word] = array("i"), array("i")
+
+		offsets, lines = postings[word]
+		offsets.append(start)
+		lines.append(line)
+
+	return postings
+
+def plain_words(pattern):
+	"""If pattern only matches whole words from a fixed list, return that
+	list (in lower case). Otherwise return None."""
+	match = plain_term_re.match(pattern)
+	if not match:
+		return None
+
+	words = match.group(1) or match.group(2)
+	return [word.lower() for word in words.split("|")]
+
+# mark the start and end of a word in its trigrams
+WORD_START = u"\x02"
+WORD_END = u"\x03"
+
+def word_term_literals(pattern):
+	"""If everything pattern matches lies within a single word and starts at
+	the start of the word, return the runs of literal text (in lower case)
+	which every match has to contain. The runs have WORD_START and WORD_END
+	on them where they are at the start or end of the word. Otherwise return
+	None.
+
+	This is the case for the wildcard terms query_parser makes.
+
+	>>> word_term_literals(r"\\b\\w*ites\\b")
+	[u'\\x02', u'ites\\x03']
+	>>> word_term_literals(r"\\bb[aei]ll\\b")
+	[u'\\x02b', u'll\\x03']
+	>>> print word_term_literals(r"\\bb[^a]ll\\b")
+	None
+	>>> print word_term_literals(r"wor.d")
+	None
+	"""
+	try:
+		items = list(sre_parse.parse(pattern))
+	except (sre_constants.error, OverflowError, RuntimeError):
+		return None
+
+	boundary = (sre_constants.AT, sre_constants.AT_BOUNDARY)
+	if not items or items[0] != boundary:
+		return None
+
+	if not all(_matches_word_letters(item) for item in items):
+		return None
+
+	# and it must match something, so that it starts with a letter
+	if sre_parse.SubPattern(None, items).getwidth()[0] == 0:
+		return None
+
+	runs = [WORD_START]
+	for op, av in items[1:]:
+		if op == sre_constants.LITERAL:
+			runs[-1] += unichr(av).lower()
+
+		elif (op, av) == boundary:
+			runs[-1] += WORD_END
+
+		elif runs[-1]:
+			runs.append(u"")
+
+	return [run for run in runs if run]
+
+def _matches_word_letters((op, av)):
+	"""Does the parsed regular expression item only match letters (i.e. what
+	\\w matches)?"""
+	if op == sre_constants.LITERAL:
+		return bool(word_re.match(unichr(av)))
+
+	if op == sre_constants.AT:
+		# \b takes up no room
+		return av == sre_constants.AT_BOUNDARY
+
+	if op == sre_constants.IN:
+		for item_op, item_av in av:
+			if item_op == sre_constants.LITERAL:
+				if not word_re.match(unichr(item_av)):
+					return False
+
+			elif item_op == sre_constants.RANGE:
+				low, high = map(unichr, item_av)
+				if not any(start <= low and high <= end
+						for start, end in _letter_ranges):
+					return False
+
+			elif item_op != sre_constants.CATEGORY or item_av not in (
+					sre_constants.CATEGORY_WORD,
+					sre_constants.CATEGORY_DIGIT):
+				# including NEGATE
+				return False
+
+		return True
+
+	if op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+		return all(_matches_word_letters(item) for item in av[2])
+
+	if op == sre_constants.SUBPATTERN:
+		return all(_matches_word_letters(item) for item in av[1])
+
+	if op == sre_constants.BRANCH:
+		return all(
+			_matches_word_letters(item) for branch in av[1] for item in branch
+		)
+
+	return False
+
+_letter_ranges = [(u"0", u"9"), (u"A", u"Z"), (u"a", u"z")]
+
+def trigrams(text):
+	return [text[idx:idx + 3] for idx in range(len(text) - 2)]
+
+class TrigramIndex(object):
+	"""Finds the words in a vocabulary which a wildcard or regular expression
+	term matches. Only the words with all the trigrams of the literal text in
+	the term are checked against it.
+
+	>>> vocabulary = TrigramIndex([u"hittites", u"israelites", u"it", u"bell"])
+	>>> vocabulary.expand(r"\\b\\w*ites\\b")
+	[u'hittites', u'israelites']
+	>>> vocabulary.expand(r"\\bb\\wll\\b")
+	[u'bell']
+	>>> vocabulary.expand(r"\\bI\\w\\b")
+	[u'it']
+	>>> print vocabulary.expand(r"\\bit\\s\\w+")
+	None
+	"""
+	def __init__(self, words):
+		self.words = sorted(words)
+		self.trigrams = {}
+		for number, word in enumerate(self.words):
+			for trigram in set(trigrams(WORD_START + word + WORD_END)):
+				if trigram not in self.trigrams:
+					self.trigrams[trigram] = array("i")
+
+				self.trigrams[trigram].append(number)
+
+	def expand(self, pattern):
+		"""Get the words which pattern matches the start of, or None if
+		pattern can match other things than the start of a single word.
+
+		The check is made ignoring case, so this may give words which pattern
+		doesn't match in a case sensitive search."""
+		literals = word_term_literals(pattern)
+		if literals is None:
+			return None
+
+		candidates = None
+		for trigram in set(sum(map(trigrams, literals), [])):
+			numbers = self.trigrams.get(trigram, ())
+			if candidates is None:
+				candidates = set(numbers)
+			else:
+				candidates.intersection_update(numbers)
+
+		if candidates is None:
+			# no trigrams to go on
+			words = self.words
+		else:
+			words = [self.words[number] for number in sorted(candidates)]
+
+		regex = re.compile(pattern, re.IGNORECASE | re.UNICODE)
+		return [word for word in words if regex.match(word)]
+
+def phrase_words(pattern):
+	"""If pattern only matches a phrase of whole words, each separated by a
+	single space or newline, return the words (in lower case). Otherwise
+	return None."""
+	match = phrase_term_re.match(pattern)
+	if not match:
+		return None
+
+	return [word.lower() for word in phrase_separator_re.split(match.group(1))]
+
+def phrase_offsets(words, postings):
+	"""Get the offsets where the phrase made of words could start, from the
+	postings of its rarest word"""
+	if not all(word in postings for word in words):
+		return array("i")
+
+	anchor = min(range(len(words)),
+		key=lambda idx: len(postings[words[idx]][0]))
+
+	# how far the anchor is into the phrase (each word is followed by one
+	# separator)
+	shift = sum(len(word) + 1 for word in words[:anchor])
+	return array("i",
+		[offset - shift for offset in postings[words[anchor]][0]
+			if offset >= shift]
+	)
+
+def build_field_postings(field_data, field_names):
+	"""Build the postings for the given fields of a book.
+
+	Each line of a field's data is "value\\x00start end", where the value is
+	made up of space separated tokens (e.g. strong's numbers and morphology
+	codes). This returns a dictionary of field name -> {token: start, end
+	pairs}, where the pairs are kept flat in an array."""
+	field_postings = {}
+	for field_name in field_names:
+		postings = {}
+		for line in field_data.get(field_name, u"").split(u"\n"):
+			if not line:
+				continue
+
+			value, span = line.rsplit(u"\x00", 1)
+			start, end = span.split()
+			for token in set(value.split()):
+				if token not in postings:
+					postings[token] = array("i")
+
+				postings[token].extend((int(start), int(end)))
+
+		field_postings[field_name] = postings
+
+	return field_postings
+
+def literal_prefix(pattern):
+	"""Get the text that anything pattern matches must start with. This may
+	be empty.
+
+	>>> literal_prefix(r"robinson:V-PAI\\b")
+	'robinson:V-PAI'
+	>>> literal_prefix(r"G355?")
+	'G35'
+	>>> literal_prefix(r"G1|G2")
+	''
+	"""
+	if "|" in pattern:
+		return ""
+
+	prefix = literal_prefix_re.match(pattern).group()
+	if pattern[len(prefix):len(prefix) + 1] in ("?", "*", "{"):
+		# the last letter is optional
+		prefix = prefix[:-1]
+
+	return prefix
+
+literal_prefix_re = re.compile(r"[^\\.^$*+?{}\[\]|()]*")
+
+class FieldPostings(object):
+	"""Looks up the terms of a field search (as prepared by the classes in
+	search.fields) in the postings of one field of a book"""
+	def __init__(self, postings):
+		self.postings = postings
+		self.tokens = sorted(postings)
+
+		# e.g. robinson, for morphology codes
+		self.classes = sorted(set(
+			token.split(":", 1)[0] for token in self.tokens if ":" in token
+		))
+
+	def find_tokens(self, pattern):
+		"""Find the tokens which pattern matches"""
+		regex = re.compile(pattern, re.UNICODE)
+		prefix = literal_prefix(pattern)
+		if prefix.startswith(":"):
+			# a morphology code without its class, so try it in every class
+			prefixes = [cls + prefix for cls in self.classes]
+		else:
+			prefixes = [prefix]
+
+		tokens = []
+		for prefix in prefixes:
+			idx = bisect_left(self.tokens, prefix)
+			while idx < len(self.tokens) and \
+					self.tokens[idx].startswith(prefix):
+				if regex.search(self.tokens[idx]):
+					tokens.append(self.tokens[idx])
+
+				idx += 1
+
+		return tokens
+
+	def spans(self, pattern):
+		"""Get the sorted (start, end) spans which pattern matches"""
+		pair_lists = [
+			zip(spans[::2], spans[1::2])
+			for spans in (
+				self.postings[token] for token in self.find_tokens(pattern)
+			)
+		]
+
+		ret = []
+		for span in heapq.merge(*pair_lists):
+			# several matching tokens can be on the same span
+			if not ret or ret[-1] != span:
+				ret.append(span)
+
+		return ret
+
+def merge_offsets(offset_lists):
+	"""Merge several sorted offset lists into one sorted array
+
+	>>> list(merge_offsets([array("i", [1, 5]), array("i"), [2, 3, 9]]))
+	[1, 2, 3, 5, 9]
+	"""
+	offset_lists = [item for item in offset_lists if len(item)]
+	if len(offset_lists) == 1:
+		return offset_lists[0]
+
+	# sorting them all together is quicker than heapq.merge, as sort finds
+	# the sorted runs
+	merged = array("i")
+	for offsets in offset_lists:
+		merged.extend(offsets)
+
+	return array("i", sorted(merged))
+
+class TermMatcher(object):
+	"""Finds the matches of one compiled search regex in a book's text.
+
+	If the regex is a plain word term or a phrase of plain words and the book
+	has postings, the candidate offsets come from the postings and are checked
+	with the regex at that position only. Otherwise we fall back to scanning
+	the text.
+
+	words, if given, are the words that the regex can match the start of
+	(e.g. what a wildcard term expands to), to use instead of the plain word
+	term."""
+	def __init__(self, regex, text, postings=None, words=None):
+		self.regex = regex
+		self.text = text
+		self.offsets = None
+
+		if words is None:
+			words = plain_words(regex.pattern)
+
+		if postings is None:
+			return
+
+		if words is not None:
+			self.offsets = merge_offsets(
+				postings[word][0] for word in words if word in postings
+			)
+
+		else:
+			phrase = phrase_words(regex.pattern)
+			if phrase is not None:
+				self.offsets = phrase_offsets(phrase, postings)
+
+	@property
+	def uses_postings(self):
+		return self.offsets is not None
+
+	def estimate(self):
+		"""Estimate how many matches there are, to decide which term to drive
+		a search from. Without postings we can't tell, so say it is a lot."""
+		if self.offsets is None:
+			return sys.maxint
+
+		return len(self.offsets)
+
+	def is_empty(self):
+		"""Can we tell without scanning that this never matches?"""
+		return self.offsets is not None and not len(self.offsets)
+
+	def spans(self, lower=0, upper=None):
+		"""Iterate over the (start, end) spans of the matches lying in
+		text[lower:upper]. An upper of None or below 0 means the end of the
+		text."""
+		if upper is None or upper < 0:
+			upper = len(self.text)
+
+		if self.offsets is None:
+			if lower == 0 and upper == len(self.text):
+				iterator = self.regex.finditer(self.text)
+				lower = 0
+			else:
+				iterator = self.regex.finditer(self.text[lower:upper])
+
+			for match in iterator:
+				start, end = match.span()
+				yield start + lower, end + lower
+
+			return
+
+		offsets = self.offsets
+		for idx in xrange(bisect_left(offsets, lower), len(offsets)):
+			start = offsets[idx]
+			if start >= upper:
+				break
+
+			match = self.regex.match(self.text, start, upper)
+			if match:
+				yield match.span()
+
+	def search(self, lower, upper):
+		"""Return the first match in text[lower:upper], or None"""
+		for span in self.spans(lower, upper):
+			return span
+
+		return None
+
+	def last(self, lower, upper):
+		"""Return the last match in text[lower:upper], or None"""
+		if upper < 0:
+			upper = len(self.text)
+
+		if self.offsets is None:
+			span = None
+			for span in self.spans(lower, upper):
+				pass
+
+			return span
+
+		offsets = self.offsets
+		idx = bisect_right(offsets, upper) - 1
+		while idx >= 0 and offsets[idx] >= lower:
+			match = self.regex.match(self.text, offsets[idx], upper)
+			if match:
+				return match.span()
+
+			idx -= 1
+
+		return None
+
+if __name__ == '__main__':
+	import doctest
+	doctest.testmod()
@@ -17,11 +17,15 @@ import config
 import guiconfig
 import index
 from index import COMBINED
-from index import SearchException, RemoveDuplicates
+from index import SearchException
 from search.query_parser import separate_words, SpellingException
 from search.stemming import get_stemmer
 
-from search.highlighted_frame import HighlightedDisplayFrame
+from search.highlighted_frame import HighlightedDisplayFrame, highlight_results
+from search.distribution_dialog import DistributionDialog
+from search.multi_search import MultiSearch
+from search.multi_search_dialog import MultiSearchDialog
+from search.index_builder import index_builder
 from swlib.pysw import (
 	TK, VK, UserVK, GetBestRange, Searcher, VerseKeySearcher, SWREGEX
 )
@@ -30,6 +34,7 @@ from util.debug import dprint, WARNING, is_debugging
 from gui import virtuallist
 from gui import reference_display_frame
 from gui import fonts
+from gui.multichoice import MultiChoiceDialog
 import events
 from util.configmgr import config_manager
 from manage_topics_frame import ManageTopicsFrame
@@ -57,6 +62,29 @@ search_config.add_item("indexed_search", True, item_type=bool)
 search_config.add_item("past_search_length", 20, item_type=int)
 search_config.add_item("past_searches", [], item_type="pickle")
 
+# how many results to show when showing the best results first
+search_config.add_item("ranked_results", 100, item_type=int)
+
+_polling_index_builder = False
+
+def poll_index_builder():
+	"""Keep passing on what the background index builds are doing while there
+	are any"""
+	global _polling_index_builder
+	index_builder.poll()
+	if index_builder.is_busy():
+		wx.CallLater(250, poll_index_builder)
+	else:
+		_polling_index_builder = False
+
+def start_polling_index_builder():
+	global _polling_index_builder
+	if not _polling_index_builder:
+		_polling_index_builder = True
+		wx.CallLater(250, poll_index_builder)
+
+index_builder.on_busy += start_polling_index_builder
+
 class RangePanel(xrcRangePanel):
 	def __init__(self, parent):
 		super(RangePanel, self).__init__(parent)
@@ -167,6 +195,10 @@ class SearchPanel(xrcSearchPanel):
 		self.regexes = []
 		self.fields = []
 
+		# the arguments of the last indexed search, to count its matches
+		# again with
+		self.last_search = None
+
 		# if search panel is on screen at startup, on_show and set_version will
 		# both be called. Then if there is no index, it will prompt twice.
 		# This flag is false only before the end of the first call to
@@ -180,6 +212,13 @@ class SearchPanel(xrcSearchPanel):
 		fonts.fonts_changed += self.set_font
 		guiconfig.mainfrm.on_close += lambda:\
 			fonts.fonts_changed.remove(self.set_font)
+
+		index_builder.on_progress += self.on_index_progress
+		index_builder.on_finished += self.on_index_finished
+		guiconfig.mainfrm.on_close += lambda: (
+			index_builder.on_progress.remove(self.on_index_progress),
+			index_builder.on_finished.remove(self.on_index_finished)
+		)
 		
 	
 	def on_create(self, event=None):
@@ -253,6 +292,7 @@ class SearchPanel(xrcSearchPanel):
 
 		self.search_label.Label = _("%d references found") % 0
 		self.versepreview.SetReference(None)
+		self.last_search = None
 		
 
 		wx.CallAfter(self.clear_list)
@@ -319,25 +359,15 @@ class SearchPanel(xrcSearchPanel):
 			
 			return
 
-		if(self.version and index.IndexExists(self.version)):
-			busy_info = wx.BusyInfo(_("Reading search index..."))
-			try:
-				self.index = index.ReadIndex(self.version)
-			except Exception, e:
-				dprint(WARNING, "Error reading index. Deleting it...", e)
-				try:
-					index.DeleteIndex(self.version)
-				except Exception, e2:
-					dprint(WARNING, "Couldn't delete it", e2)
-
-				self.index = None
-				self.show_keyboard_button(shown=False)
-				self.set_index_available(False)
-			#	del busy_info
+		if index_builder.is_queued(self.version):
+			self.index = None
+			self.set_index_available(False)
+			self.show_index_building()
+			return
 
-				
-			else:
-				self.set_index_available(True)
+		if(self.version and index.IndexExists(self.version)):
+			if self.read_index():
+				self.check_index_up_to_date()
 				return
 			
 		self.search_button.Enable(self.version is not None)
@@ -504,6 +534,9 @@ class SearchPanel(xrcSearchPanel):
 		"""Sets the search type to be displayed in the GUI."""
 		self.options_panel.gui_search_type.SetSelection(not indexed_search)
 		self.show_keyboard_button(shown=indexed_search)
+
+		# only the index can tell which results are best
+		self.options_panel.best_first.Enable(indexed_search)
 		
 	def show_keyboard_button(self, shown=True):
 		self.keyboard_button.ContainingSizer.Show(self.keyboard_button, shown)
@@ -618,14 +651,7 @@ class SearchPanel(xrcSearchPanel):
 			succeeded = False
 
 		except SpellingException, spell:
-			wx.MessageBox(u"%s\n%s" % (
-				_("The following words were not found in this %s:") 
-					% self.book.noun, 
-				unicode(spell)
-			), _("Unknown word"),
-				parent=self
-			)
-		
+			self.suggest_spelling(key, spell.wrongwords)
 			succeeded = False
 		
 		if not succeeded:
@@ -656,6 +682,46 @@ class SearchPanel(xrcSearchPanel):
 			self.on_sword_search(regexes, excl_regexes, fields, excl_fields, 
 				scope, case_sensitive)
 
+	def suggest_spelling(self, key, wrong_words):
+		"""Tell the user which words of key aren't in the book, and offer to
+		search for the words they may have meant instead"""
+		message = u"%s\n%s" % (
+			_("The following words were not found in this %s:") 
+				% self.book.noun, 
+			u", ".join(wrong_words)
+		)
+
+		# the suggestions come from the words of the postings, which aren't
+		# all in the word list searches are checked against (e.g. words which
+		# only come before punctuation), so only offer ones which are, or
+		# searching for them would just find them wrong again
+		wordlist = self.index.statistics["wordlist"]
+
+		corrected = key
+		for word in wrong_words:
+			suggestions = [suggestion
+				for suggestion in self.index.SuggestWords(word)
+				if suggestion.lower() in wordlist]
+
+			if suggestions:
+				corrected = re.sub(r"(?iu)\b%s\b" % re.escape(word),
+					suggestions[0], corrected)
+
+		if corrected == key:
+			wx.MessageBox(message, _("Unknown word"), parent=self)
+			return
+
+		answer = wx.MessageBox(
+			u"%s\n\n%s" % (message, _("Did you mean %s?") % corrected),
+			_("Unknown word"), wx.YES_NO | wx.ICON_QUESTION, parent=self
+		)
+
+		if answer == wx.YES:
+			self.searchkey.SetValue(corrected)
+
+			# we are still in the middle of searching for key
+			wx.CallAfter(self.on_search)
+
 	def on_indexed_search(self, regexes, excl_regexes, fields, excl_fields, 
 		scope, case_sensitive, proximity, is_word_proximity):
 		"""This is what does the main bit of searching."""
@@ -680,13 +746,43 @@ class SearchPanel(xrcSearchPanel):
 		if case_sensitive:
 			search_type |= index.CASESENSITIVE
 		
+		self.last_search = dict(
+			regexes=regexes, excl_regexes=excl_regexes, fields=fields,
+			excl_fields=excl_fields, type=search_type, searchrange=scope,
+			proximity=proximity, is_word_proximity=is_word_proximity
+		)
+
+		# show the results for each book as it is searched
+		self.search_results = index.SearchResults(self.index)
+		self.hits = 0
+		self.verselist.results = self.search_results
+		self.verselist.set_data([_("Reference"), _("Preview")], length=0)
 		try:
-			self.search_results, self.maybe_incorrect_results = self.index.Search(
-				regexes, excl_regexes, fields, excl_fields, 
-				search_type, searchrange=scope,
-				progress=index_callback,
-				proximity=proximity, is_word_proximity=is_word_proximity
-			)
+			if self.options_panel.best_first.Value:
+				# the best results can't be shown until every book has been
+				# searched
+				results, self.maybe_incorrect_results = self.index.Search(
+					regexes, excl_regexes, fields, excl_fields, 
+					search_type | index.RANKED, searchrange=scope,
+					progress=index_callback,
+					proximity=proximity, is_word_proximity=is_word_proximity,
+					limit=search_config["ranked_results"]
+				)
+				if results:
+					self.add_results(results, ranked=True)
+
+			else:
+				for book_results in self.index.IterSearch(
+					regexes, excl_regexes, fields, excl_fields, 
+					search_type, searchrange=scope,
+					progress=index_callback,
+					proximity=proximity, is_word_proximity=is_word_proximity
+				):
+					if book_results:
+						self.add_results(book_results)
+			
+				self.maybe_incorrect_results = \
+					self.index.MaybeIncorrectResults(fields)
 
 		except SearchException, myexcept:
 			wx.MessageBox(str(myexcept), _("Error in search"), parent=self)
@@ -704,7 +800,6 @@ class SearchPanel(xrcSearchPanel):
 			succeeded = False
 
 		else:
-			self.hits = len(self.search_results)
 			if self.hits == 0:
 				succeeded = False
 				maybe_show = True
@@ -720,23 +815,53 @@ class SearchPanel(xrcSearchPanel):
 		maybe_show = maybe_show and self.maybe_incorrect_results
 
 		if not succeeded:
-			self.search_label.Label = (
-				"%s, %s, %s" % (
-					_("%d references found") % 0, 
-					i18n.ngettext(
-						_("1 word"),
-						_("%d words") % self.numwords,
-						self.numwords
-					),
-					_("%d hits") % 0
-				)
-			)
+			self.search_results = []
+			self.hits = 0
+			self.set_search_label()
 				
 			wx.CallAfter(self.clear_list, maybe_show)
 			return
 
-		self.search_results = index.RemoveDuplicates(self.search_results)
-		
+		self.search_button.SetLabel(_("&Search"))
+		self.save_results_button.Enable()
+
+	def add_results(self, results, ranked=False):
+		"""Show some more results while we are still searching. Ranked
+		results are shown in the order they are given, the best first."""
+		first = not self.search_results
+		self.hits += len(results)
+
+		if ranked:
+			# each range of lines only has its best result
+			self.search_results.extend(results)
+
+		else:
+			# results from different books never overlap, so they can have
+			# their duplicates removed separately
+			self.search_results.extend(index.RemoveOverlaps(results))
+
+		self.verselist.results = self.search_results
+		if first:
+			self.verselist.set_data(
+				[_("Reference"), _("Preview")], 
+				length=len(self.search_results)
+			)
+
+			self.versepreview.regexes = self.regexes	
+			self.versepreview.fields = self.fields
+			self.versepreview.SetReference(self.search_results[0])
+
+		else:
+			self.verselist.SetItemCount(len(self.search_results))
+
+		self.set_search_label()
+		self.set_title()
+
+		if first:
+			# show the first results straight away
+			guiconfig.app.Yield()
+
+	def set_search_label(self):
 		self.search_label.Label = (
 			"%s, %s, %s" % (
 				i18n.ngettext(
@@ -755,8 +880,6 @@ class SearchPanel(xrcSearchPanel):
 				)				
 			)
 		)
-		
-		self.insert_results()
 
 	def on_sword_search(self, regexes, excl_regexes, fields, excl_fields, 
 		scope, case_sensitive):
@@ -908,8 +1031,33 @@ class SearchPanel(xrcSearchPanel):
 		self.check_for_index()
 		
 
+	def read_index(self):
+		"""Read the index for the current version. If it can't be read, it is
+		deleted. Returns whether it was read."""
+		busy_info = wx.BusyInfo(_("Reading search index..."))
+		try:
+			self.index = index.GetIndex(self.version)
+		except Exception, e:
+			dprint(WARNING, "Error reading index. Deleting it...", e)
+			try:
+				index.DeleteIndex(self.version)
+			except Exception, e2:
+				dprint(WARNING, "Couldn't delete it", e2)
+
+			self.index = None
+			self.show_keyboard_button(shown=False)
+			self.set_index_available(False)
+			return False
+
+		self.set_index_available(True)
+		return True
+
 	def generate_index(self, event=None):
-		if(self.index):
+		if index_builder.is_queued(self.version):
+			# this is the cancel button while it is being built
+			index_builder.cancel(self.version)
+
+		elif(self.index):
 			self.index = None
 			error = index.DeleteIndex(self.version)
 			if error:
@@ -924,68 +1072,81 @@ class SearchPanel(xrcSearchPanel):
 			
 			
 
-	def build_index(self, version):
-		def callback(value):
-			self.progressbar.SetValue(value[1])
-			continuing, skip = p.Update(value[1], _("Processing %s") % value[0])
-			wx.GetApp().Yield()
-			return continuing
+	def check_index_up_to_date(self):
+		"""If the module has been changed since it was indexed (e.g. it has
+		been upgraded, or it is a personal commentary), offer to update the
+		index. Only the books which have changed are indexed again."""
+		try:
+			out_of_date = self.index.IsOutOfDate()
+		except Exception, e:
+			dprint(WARNING, "Couldn't check whether index is up to date", e)
+			return
 
-		p = wx.ProgressDialog(_("Indexing %s") % version, _("Preparing"), 
-			parent=self, style=wx.PD_APP_MODAL|wx.PD_CAN_ABORT|wx.PD_AUTO_HIDE )
+		if not out_of_date:
+			return
 
-		p.Size = (400, -1)
-		p.Show()
-		#self.show_progress_bar()
+		msg = _("%s has changed since its search index was created. "
+			"Update the index?") % self.version
+		update = wx.MessageBox(msg, _("Update Index?"), 
+			wx.YES_NO, parent=self)
+		if update == wx.YES:
+			self.build_index(self.version, update=True)
+
+	def build_index(self, version, update=False):
+		"""Build the index for version in the background. When it is done,
+		on_index_finished reads it in."""
+		if update:
+			# the index file is going to be replaced
+			self.index = None
+			index.CloseIndex(version)
+			self.set_index_available(False)
 
-		error = None
-		try:
-			#create index
-			try:
-				self.index = self.index_type(version, callback)
-			except index.Cancelled:
-				self.show_keyboard_button(False)
-				return None
-
-			except index.BadBook, e:
-				self.index = e.index
-				error = str(e)
-			
-			self.set_index_available(True)
-			self.show_keyboard_button()
-			
+		index_builder.build(version, self.index_type, update=update)
+		self.show_index_building()
 
-			#write it to file
+	def show_index_building(self):
+		"""Show the progress of building the current version's index, which
+		can be cancelled with the index button"""
+		job = index_builder.get_job(self.version)
+		if job is None:
+			return
 
-			def index_callback(value):
-				# calling GUI functions here is quite expensive (under linux,
-				# takes twice as long if you do it always), so only do it every
-				# 0.1 seconds
-				if time.time() - last_time[0] > 0.1:
-					continuing, skip = p.Update(value[1], 
-						_("Writing %s") % value[0])
-				
-					self.progressbar.SetValue(value[1])
-					
-					guiconfig.app.Yield()
-					last_time[0] = time.time()
-		                                                                           
-					return continuing
-				return True
-
-			p.Show()
-			
-			last_time = [time.time()]
-			self.index.WriteIndex(progress=index_callback)
-			
+		self.genindex.SetLabel(_("Cancel &Indexing"))
+		self.genindex.ContainingSizer.Show(self.genindex, True)
+		self.layout_panel_1()
+		if not self.searching:
+			self.show_progress_bar()
+			self.genindex.Enable()
+			self.progressbar.SetValue(job.percent)
 
-		finally:
-			if error:
-				wx.MessageBox(unicode(error), "Error on indexing", parent=self)
-		
-			#self.show_progress_bar(False)
-			p.Hide()
-			p.Destroy()
+	def on_index_progress(self, version, bookname, percent):
+		if version != self.version or self.searching:
+			return
+
+		if not self.progressbar.IsShown():
+			self.show_index_building()
+
+		self.progressbar.SetValue(percent)
+
+	def on_index_finished(self, version, status, message):
+		if version != self.version:
+			return
+
+		if not self.searching:
+			self.show_progress_bar(False)
+
+		if message:
+			wx.MessageBox(unicode(message), _("Error on indexing"), 
+				parent=self)
+
+		if index.IndexExists(version):
+			if self.read_index():
+				self.show_keyboard_button(
+					shown=search_config["indexed_search"])
+
+		else:
+			self.set_index_available(False)
+			self.show_keyboard_button(shown=False)
 
 	def _has_index(self):
 		"""Does the current module have an index?
@@ -1109,6 +1270,123 @@ class BibleSearchPanel(SearchPanel):
 	def _post_init(self):
 		super(BibleSearchPanel, self)._post_init()
 		self.save_results_button.Bind(wx.EVT_BUTTON, self._save_results)
+		self.verselist.Bind(wx.EVT_CONTEXT_MENU, self.show_results_menu)
+
+	def show_results_menu(self, event):
+		if not self.search_results:
+			return
+
+		menu = wx.Menu()
+		item = menu.Append(wx.ID_ANY, _("&Export Results..."))
+		self.Bind(wx.EVT_MENU, self.export_results, id=item.Id)
+
+		if self.indexed_search and self.last_search:
+			item = menu.Append(wx.ID_ANY, _("Show &Distribution..."))
+			self.Bind(wx.EVT_MENU, self.show_distribution, id=item.Id)
+
+			item = menu.Append(wx.ID_ANY, _("Search &Other Versions..."))
+			self.Bind(wx.EVT_MENU, self.search_other_versions, id=item.Id)
+
+		self.verselist.PopupMenu(menu)
+		menu.Destroy()
+
+	def show_distribution(self, event=None):
+		"""Show how the matches of the last search are spread over the books
+		and chapters. Only the matches are counted, so this is quick even
+		when there are a lot of them."""
+		args = dict(self.last_search)
+		args["type"] |= index.COUNT
+
+		busy_info = wx.BusyInfo(_("Counting matches..."))
+		try:
+			counts, maybe_incorrect = self.index.Search(**args)
+		except SearchException, e:
+			del busy_info
+			wx.MessageBox(str(e), _("Error in search"), parent=self)
+			return
+
+		del busy_info
+		dialog = DistributionDialog(self, self.index, counts,
+			_("Distribution of %s") % self.searchkey.Value)
+		dialog.ShowModal()
+		dialog.Destroy()
+
+	def search_other_versions(self, event=None):
+		"""Search the versions the user picks for the last search, and show
+		which of them have results at each reference. The query is as it was
+		parsed for this version (e.g. the words it was stemmed to)."""
+		versions = [version for version in self.book.GetModuleList()
+			if index.IndexExists(version)]
+
+		mcd = MultiChoiceDialog(self,
+			_("Choose the books to search. Only books which have a search "
+			"index can be searched."),
+			_("Choose books"), choices=versions)
+		mcd.SetSelections([versions.index(self.version)])
+
+		try:
+			if mcd.ShowModal() != wx.ID_OK:
+				return
+
+			chosen = [versions[idx] for idx in mcd.GetSelections()]
+		finally:
+			mcd.Destroy()
+
+		if not chosen:
+			return
+
+		p = wx.ProgressDialog(_("Searching"), _("Preparing"), parent=self,
+			style=wx.PD_APP_MODAL|wx.PD_CAN_ABORT)
+		p.Size = (400, -1)
+
+		def progress((text, percent)):
+			continuing, skip = p.Update(percent, text)
+			return continuing
+
+		try:
+			aligned, maybe_incorrect = MultiSearch(chosen,
+				progress=progress, **self.last_search)
+		except SearchException, e:
+			wx.MessageBox(str(e), _("Error in search"), parent=self)
+			return
+		finally:
+			p.Destroy()
+
+		dialog = MultiSearchDialog(self, chosen, aligned, maybe_incorrect,
+			_("Results of %s") % self.searchkey.Value)
+		dialog.ShowModal()
+		dialog.Destroy()
+
+	def export_results(self, event=None):
+		"""Save all the results, highlighted, as one HTML document"""
+		fd = wx.FileDialog(self,
+			wildcard=_("HTML files") + " (*.html)|*.html",
+			style=wx.FD_SAVE|wx.FD_OVERWRITE_PROMPT,
+			message=_("Export search results")
+		)
+
+		try:
+			if fd.ShowModal() != wx.ID_OK:
+				return
+
+			filename = fd.Path
+		finally:
+			fd.Destroy()
+
+		busy_info = wx.BusyInfo(_("Exporting search results..."))
+		data = highlight_results(self.book, self.search_results,
+			self.regexes, self.fields, template=self.template)
+
+		try:
+			f = open(filename, "w")
+			try:
+				f.write(data.encode("utf8"))
+			finally:
+				f.close()
+		except EnvironmentError, e:
+			del busy_info
+			wx.MessageBox(_("Couldn't export the search results: %s") % e,
+				parent=self)
 
 	def _save_results(self, event):
 		manage_topics_frame = ManageTopicsFrame(guiconfig.mainfrm)
@@ -0,0 +1,137 @@
+"""Suggests corrections for words which aren't in an index.
+
+Corrections are found with a symmetric deletion index. The start of every
+word in the vocabulary is stored under each way of deleting up to two
+letters from it. Deleting up to two letters from the start of a misspelt
+word and looking the results up in this finds the words within two edits of
+it, without comparing it against the whole vocabulary. These are then ranked
+by their edit distance and how common they are.
+
+>>> suggester = Suggester({u"loved": 10, u"love": 50, u"lord": 400,
+... 	u"glove": 1, u"the": 5000, u"beginning": 20})
+>>> suggester.suggest(u"lovd")
+[u'lord', u'love', u'loved', u'glove']
+>>> suggester.suggest(u"teh")
+[u'the']
+>>> suggester.suggest(u"begining")
+[u'beginning']
+>>> suggester.suggest(u"xyzzy")
+[]
+"""
+
+# how many edits a suggestion can be away from the word
+MAX_DISTANCE = 2
+
+# only the start of words is indexed, to keep the index small. Candidates
+# are checked against the whole word.
+PREFIX_LENGTH = 5
+
+def deletions(word, distance=MAX_DISTANCE):
+	"""Get the set of strings made by deleting up to distance letters from
+	word (including word itself)"""
+	result = set([word])
+	edge = [word]
+	for x in range(distance):
+		next_edge = []
+		for item in edge:
+			for idx in range(len(item)):
+				deleted = item[:idx] + item[idx + 1:]
+				if deleted not in result:
+					result.add(deleted)
+					next_edge.append(deleted)
+
+		edge = next_edge
+
+	return result
+
+def edit_distance(first, second, limit=MAX_DISTANCE):
+	"""The number of insertions, deletions, substitutions and transpositions
+	of neighbouring letters to turn first into second. If this is more than
+	limit, limit + 1 is returned.
+
+	>>> edit_distance("the", "teh")
+	1
+	>>> edit_distance("kitten", "sitting")
+	3
+	>>> edit_distance("kitten", "sitting", limit=1)
+	2
+	"""
+	if abs(len(first) - len(second)) > limit:
+		return limit + 1
+
+	previous_row = None
+	row = range(len(second) + 1)
+	for idx in range(1, len(first) + 1):
+		previous_row, row = row, [idx] + [0] * len(second)
+		for jdx in range(1, len(second) + 1):
+			cost = first[idx - 1] != second[jdx - 1]
+			row[jdx] = min(
+				row[jdx - 1] + 1,
+				previous_row[jdx] + 1,
+				previous_row[jdx - 1] + cost,
+			)
+
+			if (idx > 1 and jdx > 1 and
+					first[idx - 1] == second[jdx - 2] and
+					first[idx - 2] == second[jdx - 1]):
+				row[jdx] = min(row[jdx], before_previous_row[jdx - 2] + 1)
+
+		if min(row) > limit:
+			return limit + 1
+
+		before_previous_row = previous_row
+
+	return min(row[-1], limit + 1)
+
+class Suggester(object):
+	"""Suggests words from a vocabulary (a dictionary of lower case word ->
+	how often it occurs) for words which aren't in it"""
+	def __init__(self, word_counts):
+		self.word_counts = word_counts
+		self.words = sorted(word_counts)
+
+		# deletion -> word number, or a list of them
+		self.deletions = {}
+		for number, word in enumerate(self.words):
+			for deleted in deletions(word[:PREFIX_LENGTH]):
+				numbers = self.deletions.get(deleted)
+				if numbers is None:
+					self.deletions[deleted] = number
+				elif isinstance(numbers, list):
+					numbers.append(number)
+				else:
+					self.deletions[deleted] = [numbers, number]
+
+	def suggest(self, word, limit=5):
+		"""Get up to limit words which word may be a misspelling of, the
+		best first"""
+		word = word.lower()
+		candidates = set()
+		for deleted in deletions(word[:PREFIX_LENGTH]):
+			numbers = self.deletions.get(deleted)
+			if numbers is None:
+				continue
+
+			if isinstance(numbers, list):
+				candidates.update(numbers)
+			else:
+				candidates.add(numbers)
+
+		ranked = []
+		for number in candidates:
+			candidate = self.words[number]
+			if candidate == word:
+				continue
+
+			distance = edit_distance(word, candidate)
+			if distance <= MAX_DISTANCE:
+				ranked.append(
+					(distance, -self.word_counts[candidate], candidate)
+				)
+
+		ranked.sort()
+		return [candidate for distance, count, candidate in ranked[:limit]]
+
+if __name__ == '__main__':
+	import doctest
+	doctest.testmod()
@@ -0,0 +1,12 @@
+"""\
+This module is a convenience module.
+It collects all the classes from all the different test modules into one
+module, so that all unit tests can be run at once.
+"""
+from test_indexed_text import *
+from test_index import *
+from test_index_file import *
+from test_highlighted_frame import *
+
+import unittest
+unittest.main()
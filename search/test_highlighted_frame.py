@@ -0,0 +1,168 @@
+import re
+import unittest
+from swlib.pysw import SW
+from backend.book import Bible
+from backend.verse_template import VerseTemplate
+from search import highlighted_frame
+from search.highlighted_frame import (
+	get_alignment, highlight, alignment_cache, prepare_plain_text,
+	highlight_results
+)
+
+class FakeBook(object):
+	"""A book with one reference, which counts how often it is rendered"""
+	version = "Test"
+	rendered = u'In the <i>beginning</i> God created the <b>heaven</b>.'
+	plain = u'In the beginning God created the heaven.'
+
+	def __init__(self):
+		self.templatelist = []
+		self.renders = 0
+
+	def GetReference(self, reference, end_ref=None, stripped=False):
+		if stripped:
+			return self.plain
+
+		self.renders += 1
+		return self.rendered
+
+class TestAlignmentCache(unittest.TestCase):
+	regexes = [re.compile("beginning"), re.compile("heaven")]
+
+	def setUp(self):
+		alignment_cache.clear()
+		self.book = FakeBook()
+
+	def highlight_cached(self, template=None):
+		data, content, results = get_alignment(self.book, "Genesis 1:1",
+			None, template, True)
+		return highlight(content, data, True, self.regexes, results=results)
+
+	def testSameAsUncached(self):
+		uncached = highlight(prepare_plain_text(self.book.plain),
+			self.book.rendered, True, self.regexes)
+		self.assert_("search_highlight" in uncached)
+
+		# the second time comes from the cache, after highlighting has
+		# changed the results the first time
+		self.assertEquals(self.highlight_cached(), uncached)
+		self.assertEquals(self.highlight_cached(), uncached)
+
+	def testNotRenderedAgain(self):
+		self.highlight_cached()
+		self.highlight_cached()
+		self.assertEquals(self.book.renders, 1)
+
+	def testRenderedAgainForAnotherTemplate(self):
+		self.highlight_cached(VerseTemplate(u"$text"))
+		self.highlight_cached(VerseTemplate(u"$text"))
+		self.assertEquals(self.book.renders, 1)
+
+		self.highlight_cached(VerseTemplate(u"<p>$text</p>"))
+		self.assertEquals(self.book.renders, 2)
+
+	def testForgotten(self):
+		self.highlight_cached()
+		highlighted_frame.forget_alignments()
+		self.highlight_cached()
+		self.assertEquals(self.book.renders, 2)
+
+class FakeVerseList(object):
+	def __init__(self, keys):
+		self.keys = keys
+		self.upto = 0
+
+	def setPosition(self, position):
+		self.upto = 0
+
+	def Error(self):
+		return chr(self.upto >= len(self.keys))
+
+	def getText(self):
+		return self.keys[self.upto]
+
+	def increment(self, steps):
+		self.upto += steps
+
+class FakeModule(object):
+	def Type(self):
+		return Bible.type
+
+	def Name(self):
+		return "Test"
+
+	def Description(self):
+		return "Test bible"
+
+	def Encoding(self):
+		return chr(SW.ENC_UTF8)
+
+class FakeBible(object):
+	"""A small bible, which counts how often its verses are gone through"""
+	verses = [
+		("Genesis 1:1", u"In the <i>beginning</i> God created the heaven."),
+		("Genesis 1:2", u"And the earth was without form."),
+		("Genesis 1:3", u"And God said, Let there be light."),
+		("Genesis 1:4", u"And God saw the light, that it was good."),
+	]
+
+	def __init__(self):
+		self.mod = FakeModule()
+		self.vk = self
+		self.templatelist = [VerseTemplate(u"$text ")]
+		self.end_of_render = u""
+		self.passes = 0
+
+	def ParseVerseList(self, text, context, expand):
+		keys = [key for key, verse in self.verses]
+		result = []
+		for item in text.split("; "):
+			parts = item.split(" - ")
+			result += keys[keys.index(parts[0]):keys.index(parts[-1]) + 1]
+
+		return FakeVerseList(result)
+
+	def GetReference_yield(self, verselist, max_verses, stripped,
+			display_tags):
+		self.passes += 1
+		verses = dict(self.verses)
+		verselist.setPosition(None)
+		while not ord(verselist.Error()):
+			key = verselist.getText()
+			text = verses[key]
+			if stripped:
+				text = re.sub("<[^>]*>", "", text)
+
+			yield dict(text=text, reference=key,
+				internal_reference=key), []
+			verselist.increment(1)
+
+class TestHighlightResults(unittest.TestCase):
+	def setUp(self):
+		self.book = FakeBible()
+		self.html = highlight_results(self.book,
+			["Genesis 1:1", "Genesis 1:3 - Genesis 1:4"],
+			[re.compile("God")], template=VerseTemplate(u"<p>$text</p>"))
+
+	def get_results(self):
+		return self.html.split(u'<div class="search_result">')[1:]
+
+	def testOneDocument(self):
+		self.assert_(self.html.startswith(u"<html><body>"))
+		self.assert_(self.html.endswith(u"</body></html>"))
+		self.assertEquals(len(self.get_results()), 2)
+
+	def testOnePassForAllResults(self):
+		# one for the rendered text and one for the plain text
+		self.assertEquals(self.book.passes, 2)
+
+	def testEachResultHighlighted(self):
+		first, second = self.get_results()
+		self.assertEquals(first.count(u'class="search_highlight"'), 1)
+		self.assertEquals(second.count(u'class="search_highlight"'), 2)
+		self.assert_(u"<i>beginning</i>" in first)
+		self.assert_(u"Let there be light" in second)
+		self.assert_(u"earth" not in self.html)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,61 @@
+import unittest
+from search.index import Index
+
+def make_index(statistics):
+	"""Make an index with just the given statistics, without a module"""
+	index = Index.__new__(Index)
+	index.version = "Test"
+	index.books = []
+	index.statistics = statistics
+	return index
+
+def term(word):
+	return r"\b%s\b" % word
+
+class TestPlanSearch(unittest.TestCase):
+	word_counts = {u"the": 100, u"melchizedek": 2, u"king": 20, u"of": 90,
+		u"salem": 3}
+
+	def plan(self, words, statistics=None):
+		if statistics is None:
+			statistics = {"word_counts": self.word_counts}
+
+		return make_index(statistics).plan_search(map(term, words), {})
+
+	def testRarestFirst(self):
+		self.assertEquals(self.plan([u"the", u"melchizedek", u"king"]),
+			map(term, [u"melchizedek", u"king", u"the"]))
+
+	def testRegularExpressionsLast(self):
+		self.assertEquals(self.plan([u"k\\w+", u"the"]),
+			map(term, [u"the", u"k\\w+"]))
+
+	def testPhraseAsRareAsItsRarestWord(self):
+		self.assertEquals(self.plan([u"king", u"of\\ssalem"]),
+			map(term, [u"of\\ssalem", u"king"]))
+
+	def testWordNotInIndex(self):
+		self.assertEquals(self.plan([u"the", u"abraham"]), None)
+		self.assertEquals(self.plan([u"king\\sof\\sjerusalem"]), None)
+
+	def testExpansions(self):
+		index = make_index({"word_counts": self.word_counts})
+		self.assertEquals(index.plan_search([u"\\bk\\w+\\b"],
+			{u"\\bk\\w+\\b": []}), None)
+		self.assertEquals(index.plan_search([u"\\bk\\w+\\b", term(u"salem")],
+			{u"\\bk\\w+\\b": [u"king"]}), [term(u"salem"), u"\\bk\\w+\\b"])
+
+	def testOldIndex(self):
+		# only the wordlist, with punctuation on its words. The terms are
+		# searched in the order given.
+		statistics = {"wordlist": set([u"the", u"melchizedek,", u"god's"])}
+		self.assertEquals(self.plan([u"the", u"melchizedek", u"god"],
+			statistics), map(term, [u"the", u"melchizedek", u"god"]))
+		self.assertEquals(self.plan([u"the", u"salem"], statistics), None)
+
+	def testNoStatistics(self):
+		self.assertEquals(self.plan([u"salem", u"the"], {}),
+			map(term, [u"salem", u"the"]))
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,67 @@
+import os
+import shutil
+import tempfile
+import unittest
+from search import index_file
+from search.index import Index
+from search.indexed_text import VerseIndexedText
+from search.test_indexed_text import make_book
+
+def make_index(books):
+	index = Index.__new__(Index)
+	index.version = "Test"
+	index.booktype = VerseIndexedText
+	index.books = books
+	index.statistics = {}
+	return index
+
+class TestIndexFile(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.filename = os.path.join(self.directory, "Test.idx")
+
+	def tearDown(self):
+		index_file.close_index_file(self.filename)
+		shutil.rmtree(self.directory)
+
+	def write_and_read(self, books):
+		index_file.write_index(make_index(books), self.filename)
+		return index_file.read_index(self.filename)
+
+class TestTextRepresentation(TestIndexFile):
+	def testAsciiBookIsBytes(self):
+		read = self.write_and_read([make_book([u"in the beginning"])])
+		self.assertEquals(type(read.books[0].text), str)
+		self.assertEquals(read.books[0].text, "in the beginning")
+
+	def testNonAsciiBookIsUnicode(self):
+		# one curly quote is enough for the whole book to be decoded
+		lines = [u"in the beginning", u"\u201cLet there be light\u201d"]
+		read = self.write_and_read([make_book(lines)])
+		self.assertEquals(type(read.books[0].text), unicode)
+		self.assertEquals(read.books[0].text, u"\n".join(lines))
+
+	def testEachBookIsDecodedOnItsOwn(self):
+		read = self.write_and_read([
+			make_book([u"in the beginning"]),
+			make_book([u"Melchiz\xe9dek"]),
+		])
+		self.assertEquals([type(book.text) for book in read.books],
+			[str, unicode])
+
+class TestHeaderAttributes(TestIndexFile):
+	def testSearchStateNotWritten(self):
+		book = make_book([u"in the beginning"])
+		book.fingerprint = "abc"
+		book.strongs = [[], []]
+		book.strongs_upto = [[], []]
+		book.current_strongs = [[], []]
+		read = self.write_and_read([book])
+
+		attributes = read._mapped[0].header["books"][0]["attributes"]
+		self.assertEquals(sorted(attributes), ["bookname", "fingerprint",
+			"version"])
+		self.assertEquals(read.books[0].fingerprint, "abc")
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,305 @@
+import re
+import random
+import unittest
+from swlib.pysw import SW
+from search.indexed_text import (
+	VerseIndexedText, DictionaryIndexedText, read_entry_chunks
+)
+from search.postings import build_postings, plain_words, TrigramIndex
+
+def make_book(lines, with_postings=True):
+	"""Make a book of lines, one verse each, without a module"""
+	book = VerseIndexedText.__new__(VerseIndexedText)
+	book.bookname = book.version = "Test"
+	book.text = u"\n".join(lines)
+	book.field_data = {}
+	book.field_postings = {}
+	book.index = []
+	for number, match in enumerate(re.finditer("(?m)^.*$", book.text)):
+		book.index.append(((1, number + 1), match.start(),
+			match.end() - match.start()))
+
+	book.postings = None
+	if with_postings:
+		book.postings = build_postings(book.text)
+
+	return book
+
+def compile_terms(words):
+	return [(re.compile(r"\b%s\b" % word, re.I | re.U | re.M), len(word))
+		for word in words]
+
+def search(book, words, proximity=15, is_word_proximity=True):
+	return book.find_ranges(book.multi_search(compile_terms(words), proximity,
+		is_word_proximity=is_word_proximity))
+
+def by_estimate(book, words, expansions=None):
+	"""Put words in the order the postings will drive the search from, so
+	that a search without postings (which drives from the first word) looks
+	for the same ranges"""
+	expansions = expansions or {}
+	def estimate(word):
+		regex = compile_terms([word])[0][0]
+		return book.get_matcher(regex, expansions.get(regex.pattern)).estimate()
+
+	return sorted(words, key=estimate)
+
+def random_lines(rng, vocabulary, count=40):
+	return [u" ".join(rng.choice(vocabulary) for i in range(rng.randint(1, 12)))
+		for line in range(count)]
+
+class PostingsAgreeWithScan(object):
+	"""Searches answered from the postings should find the same ranges as
+	scanning the text with the regular expressions does"""
+	vocabulary = []
+
+	def terms(self, rng):
+		return rng.sample(self.vocabulary, rng.randint(1, 3))
+
+	def expansions(self, book, words):
+		return {}
+
+	def testRandomSearches(self):
+		rng = random.Random(1)
+		for iteration in range(100):
+			lines = random_lines(rng, self.vocabulary)
+			indexed = make_book(lines)
+			scanned = make_book(lines, with_postings=False)
+
+			words = self.terms(rng)
+			expansions = self.expansions(indexed, words)
+			words = by_estimate(indexed, words, expansions)
+			excludes = compile_terms(rng.sample(self.vocabulary,
+				rng.randint(0, 1)))
+
+			proximity = rng.randint(1, 15)
+			is_word_proximity = rng.choice((True, False))
+			args = (compile_terms(words), proximity, is_word_proximity)
+			self.assertEquals(
+				indexed.multi_search(excludes=excludes,
+					expansions=expansions, *args),
+				scanned.multi_search(excludes=excludes, *args),
+				(lines, words, excludes, proximity, is_word_proximity)
+			)
+
+class TestWordsAgreeWithScan(PostingsAgreeWithScan, unittest.TestCase):
+	vocabulary = [u"the", u"lord", u"god", u"and", u"in", u"beginning",
+		u"was", u"word", u"light", u"darkness"]
+
+	def testUsesPostings(self):
+		book = make_book([u"in the beginning"])
+		matcher = book.get_matcher(compile_terms([u"beginning"])[0][0])
+		self.assert_(matcher.uses_postings)
+
+class TestWildcardsAgreeWithScan(PostingsAgreeWithScan, unittest.TestCase):
+	"""Wildcard terms are looked up in the postings of the words the trigram
+	index expands them to"""
+	vocabulary = [u"the", u"hittites", u"israelites", u"bell", u"ball",
+		u"bill", u"bull", u"it", u"item", u"lord"]
+	wildcards = [r"\w*ites", r"b[aei]ll", r"b\wll", r"it\w*", r"\w*l\w*"]
+
+	def terms(self, rng):
+		return rng.sample(self.vocabulary + self.wildcards, rng.randint(1, 3))
+
+	def expansions(self, book, words):
+		vocabulary = TrigramIndex(book.postings)
+		expansions = {}
+		for regex, length in compile_terms(words):
+			if plain_words(regex.pattern) is None:
+				expansions[regex.pattern] = vocabulary.expand(regex.pattern)
+
+		return expansions
+
+	def testUsesPostings(self):
+		book = make_book([u"the hittites and the israelites"])
+		regex = compile_terms([r"\w*ites"])[0][0]
+		words = self.expansions(book, [r"\w*ites"])[regex.pattern]
+		self.assertEquals(words, [u"hittites", u"israelites"])
+		self.assert_(book.get_matcher(regex, words).uses_postings)
+
+class TestPhrasesAgreeWithScan(PostingsAgreeWithScan, unittest.TestCase):
+	"""Phrases of plain words are found from the postings of their rarest
+	word, and can run across verses"""
+	vocabulary = [u"in", u"the", u"beginning", u"was", u"word"]
+	phrases = [r"in\sthe", r"the\sword", r"in\sthe\sbeginning",
+		r"was\sthe\sword", r"word\sin"]
+
+	def terms(self, rng):
+		return rng.sample(self.vocabulary + self.phrases, rng.randint(1, 3))
+
+	def testUsesPostings(self):
+		book = make_book([u"in the", u"beginning was the word"])
+		matcher = book.get_matcher(
+			compile_terms([r"in\sthe\sbeginning"])[0][0])
+		self.assert_(matcher.uses_postings)
+		self.assertEquals(list(matcher.spans()), [(0, 16)])
+
+class TestProximityAtEndOfBook(unittest.TestCase):
+	"""The range a match is looked for in may end in the last word of the
+	book, which has no space after it"""
+	lines = [
+		u"and the earth was without form and void",
+		u"and the spirit of god moved upon the waters",
+		u"in the beginning was everlasting",
+	]
+
+	def assertFound(self, words, expected, **kwargs):
+		for with_postings in (True, False):
+			book = make_book(self.lines, with_postings)
+			self.assertEquals(search(book, words, **kwargs), expected)
+
+	def testWordsInLastVerse(self):
+		# the range around beginning ends in the middle of everlasting
+		self.assertFound([u"beginning", u"everlasting"], [(2, 2)],
+			proximity=1)
+
+	def testWordBeforeInLastVerse(self):
+		# beginning is the rarest, so the search is driven from it, and the
+		# is looked for in the range around it
+		self.assertFound([u"the", u"beginning"], [(2, 2)], proximity=1)
+
+	def testVerseProximityInLastVerse(self):
+		self.assertFound([u"beginning", u"everlasting"], [(2, 2)],
+			proximity=1, is_word_proximity=False)
+
+class TestDriverTerm(unittest.TestCase):
+	"""Ranges are built around the matches of the rarest term, and take the
+	nearest occurrence of each of the others"""
+	lines = [
+		u"god blessed abram and said to him",
+		u"and melchizedek brought bread and wine to god",
+		u"he was the priest of the most high",
+	]
+
+	def testRarestTermDrives(self):
+		# god is nearer after melchizedek than before it. Driving from the
+		# first god would have matched the first two verses.
+		book = make_book(self.lines)
+		self.assertEquals(search(book, [u"god", u"melchizedek"]), [(1, 1)])
+
+	def testOrderDoesNotMatter(self):
+		book = make_book(self.lines)
+		self.assertEquals(search(book, [u"god", u"melchizedek"]),
+			search(book, [u"melchizedek", u"god"]))
+
+	def testWithoutPostings(self):
+		# we can't tell which is rarest, so the first term drives
+		book = make_book(self.lines, with_postings=False)
+		self.assertEquals(search(book, [u"god", u"melchizedek"]), [(0, 1)])
+		self.assertEquals(search(book, [u"melchizedek", u"god"]), [(1, 1)])
+
+class FakeDictionaryKey(object):
+	"""The key of a FakeDictionary. The module's own key is always at the
+	module's position; a copy keeps its own."""
+	def __init__(self, module, position=None):
+		self.module = module
+		self.position = position
+
+	def Persist(self, value=None):
+		return chr(0)
+
+	def clone(self):
+		return FakeDictionaryKey(self.module, self.module.position)
+
+	def setText(self, text):
+		self.module.seeks += 1
+		self.module.position = [key for key, entry in
+			self.module.entries].index(text)
+
+	def getText(self):
+		return self.module.getKeyText()
+
+class FakeDictionary(object):
+	"""Just enough of a SWORD dictionary module to collect the text of"""
+	def __init__(self, entries):
+		self.entries = entries
+		self.position = 0
+		self.reads = 0
+		self.seeks = 0
+
+	def setPosition(self, position):
+		self.position = 0
+
+	def getKey(self):
+		return FakeDictionaryKey(self)
+
+	def setKey(self, key):
+		if key.position is not None:
+			self.position = key.position
+
+	def Error(self):
+		return chr(self.position >= len(self.entries))
+
+	def increment(self, steps):
+		self.position += steps
+
+	def getKeyText(self):
+		return self.entries[self.position][0]
+
+	def getRawEntry(self):
+		self.reads += 1
+		return self.entries[self.position][1]
+
+	def StripText(self, entry):
+		return entry
+
+	def Markup(self):
+		return chr(SW.FMT_PLAIN)
+
+	def Encoding(self):
+		return chr(SW.ENC_UTF8)
+
+class FakeDictionaryText(DictionaryIndexedText):
+	module = None
+	def load_module(self, version):
+		return self.module
+
+class TestDictionaryChunks(unittest.TestCase):
+	"""A dictionary is read in one pass from the top, in chunks of entries"""
+	entries = [
+		("AARON", "the brother of Moses"),
+		("ABADDON", "the angel of the bottomless pit"),
+		("ABBA", "father"),
+		("ABEL", "the second son of Adam"),
+		("ABRAHAM", "the father of the faithful"),
+	]
+
+	def setUp(self):
+		FakeDictionaryText.module = FakeDictionary(self.entries)
+
+	def tearDown(self):
+		FakeDictionaryText.module = None
+
+	def read_texts(self):
+		module = FakeDictionaryText.module
+		return [FakeDictionaryText("Test", start=items[0][0], entries=2,
+			items=items) for items in read_entry_chunks(module, 2)]
+
+	def testChunks(self):
+		self.assertEquals(
+			list(read_entry_chunks(FakeDictionaryText.module, 2)),
+			[self.entries[:2], self.entries[2:4], self.entries[4:]]
+		)
+
+	def testEachEntryReadOnce(self):
+		self.read_texts()
+		self.assertEquals(FakeDictionaryText.module.reads, len(self.entries))
+		self.assertEquals(FakeDictionaryText.module.seeks, 0)
+
+	def testSameAsReadingByKey(self):
+		for text in self.read_texts():
+			by_key = FakeDictionaryText("Test", start=text.start, entries=2)
+			self.assertEquals(text.text, by_key.text)
+			self.assertEquals(text.index, by_key.index)
+			self.assertEquals(text.reference_table, by_key.reference_table)
+			self.assertEquals(text.fingerprint, by_key.fingerprint)
+
+	def testText(self):
+		texts = self.read_texts()
+		self.assertEquals(texts[1].text,
+			u"father\nthe second son of Adam")
+		self.assertEquals(texts[1].reference_table, [u"ABBA", u"ABEL"])
+		self.assertEquals(texts[2].index, [("ABRAHAM", 0, 26)])
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,375 @@
+"""Benchmark building, loading and searching search indexes.
+
+Synthetic bibles of several sizes are made with ModuleCreator, with and
+without strong's numbers and morphology. Each is indexed, the index is read
+back, and a fixed mix of queries is run against it. The timings are written
+out as JSON, so that they can be compared from one commit to the next.
+
+Run it from the top directory:
+	python test/search_benchmark.py [small] [medium] [large]
+		[--module=name...] [--output=file]
+
+With no sizes or modules given, small and medium are run. --module
+benchmarks an installed module as well; its index is made in the temporary
+directory, so the one in the index path is left alone.
+
+The memory the loaded book text takes is given for each index, with how much
+it would take as the UTF-8 it is stored as. Only books which are all ASCII
+are kept as UTF-8 (see search.index_file), and the made up bibles are all
+ASCII, so use --module with a real module to see what happens to text with
+other characters in it, such as curly quotes or accented names. The results go to standard
+output unless --output is given. The modules and indexes are made in a
+temporary directory, which is removed afterwards.
+
+Indexes are built in this process, as index worker processes only see the
+modules in the configured SWORD paths.
+"""
+import os
+import sys
+import time
+import random
+import json
+import shutil
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from swlib.pysw import SW, books
+from backend.bibleinterface import biblemgr
+from backend.create_module import ModuleCreator
+from util import search_utils
+from util.search_utils import search_config, search_cache
+from search import index
+from search.query_parser import separate_words
+from search.stemming import get_stemmer
+
+# which books each size of bible has
+SIZES = dict(
+	small=[book for book in books if book.bookname == "Genesis"],
+	medium=[book for book in books if book.testament == 2],
+	large=books,
+)
+
+# (name, query, proximity, is_word_proximity, scoped)
+# scoped searches are limited to the first half of the books
+QUERIES = [
+	("word", "lord", 15, True, False),
+	("common word", "the", 15, True, False),
+	("words", "lord god", 15, True, False),
+	("rare and common word", "the melchizedek", 15, True, False),
+	("phrase", '"in the beginning"', 15, True, False),
+	("wildcard", "lov*", 15, True, False),
+	("wildcard suffix", "*ites", 15, True, False),
+	("regex", r"/\bb[aei]ll/", 15, True, False),
+	("excluded word", "king -kings", 15, True, False),
+	("verse proximity", "love lord", 3, False, False),
+	("scoped", "lord god", 15, True, True),
+]
+
+STRONGS_QUERIES = [
+	("strong's number", "strongs:G0003", 15, True, False),
+	("word and strong's number", "love strongs:G0002", 15, True, False),
+	("morphology", "morph:V-PAI-3S", 15, True, False),
+]
+
+# words the queries look for, most frequent first. The rest of the
+# vocabulary is made up.
+QUERY_WORDS = ("the and of in lord god king kings love loved beginning "
+	"israelites hittites ball bell bill melchizedek").split()
+QUERY_WORD_RANKS = [0, 1, 2, 3, 20, 30, 60, 90, 200, 300, 400, 800, 1500,
+	2000, 2500, 3000, 4000]
+
+VOCABULARY_SIZE = 5000
+VERSE_LENGTH = (8, 40)
+REPEATS = 3
+
+def make_vocabulary(rnd):
+	syllables = [consonant + vowel for consonant in "bcdfghjklmnprstvw"
+		for vowel in "aeiou"]
+
+	words = set(QUERY_WORDS)
+	made_up = []
+	while len(made_up) < VOCABULARY_SIZE - len(QUERY_WORDS):
+		word = "".join(rnd.choice(syllables)
+			for x in range(rnd.randint(1, 4)))
+		if word not in words:
+			words.add(word)
+			made_up.append(word)
+
+	for rank, word in zip(QUERY_WORD_RANKS, QUERY_WORDS):
+		made_up.insert(rank, word)
+
+	return made_up
+
+class VerseMaker(object):
+	"""Makes up the text of verses, with words chosen with a Zipf
+	distribution, so that they are about as common as in real text"""
+	def __init__(self, seed, strongs):
+		self.rnd = random.Random(seed)
+		self.strongs = strongs
+		self.vocabulary = make_vocabulary(self.rnd)
+		self.cumulative = []
+		total = 0.
+		for rank in range(len(self.vocabulary)):
+			total += 1. / (rank + 1)
+			self.cumulative.append(total)
+
+	def choose_word(self):
+		value = self.rnd.random() * self.cumulative[-1]
+		low, high = 0, len(self.cumulative) - 1
+		while low < high:
+			middle = (low + high) // 2
+			if self.cumulative[middle] < value:
+				low = middle + 1
+			else:
+				high = middle
+
+		return low
+
+	def make_verse(self):
+		words = []
+		for x in range(self.rnd.randint(*VERSE_LENGTH)):
+			rank = self.choose_word()
+			word = self.vocabulary[rank]
+			if self.rnd.random() < 0.05:
+				word = word.capitalize()
+
+			if self.strongs:
+				attributes = 'lemma="strong:G%04d"' % (rank % 9999 + 1)
+				if rank % 3 == 0:
+					attributes += ' morph="robinson:V-PAI-3S"'
+
+				word = '<w %s>%s</w>' % (attributes, word)
+
+			words.append(word)
+
+		return " ".join(words) + "."
+
+def make_bible(working_directory, module_name, bible_books, strongs):
+	"""Make a bible with a verse of made up text for each verse of
+	bible_books. Returns the number of verses."""
+	extra_attrs = dict(
+		SourceType="OSIS",
+		Description="Search benchmark bible",
+		Lang="en",
+	)
+	if strongs:
+		extra_attrs.update(
+			GlobalOptionFilter="OSISStrongs",
+			Feature="StrongsNumbers",
+		)
+
+	creator = ModuleCreator(module_name, SW.RawText, SW.VerseKey,
+		extra_attrs=extra_attrs, working_directory=working_directory)
+
+	maker = VerseMaker(len(bible_books), strongs)
+	verses = 0
+	for book in bible_books:
+		for chapter in book.chapters:
+			for verse in chapter:
+				creator.add_entry(u"%s %s:%s" % (book.bookname, chapter, verse),
+					maker.make_verse())
+				verses += 1
+
+	return verses
+
+def load_modules(working_directory):
+	"""Make the modules in working_directory available"""
+	mgr = biblemgr.make_manager(working_directory)
+	modules = [(name.c_str(), mod) for name, mod
+				in mgr.getModules().iteritems()]
+	biblemgr.mgrs.append([working_directory, mgr, modules])
+	biblemgr._get_modules()
+
+def timed(function, *args, **kwargs):
+	"""Call function, returning (seconds taken, result)"""
+	start = time.time()
+	result = function(*args, **kwargs)
+	return time.time() - start, result
+
+def time_query(searched_index, query, proximity, is_word_proximity, scoped):
+	"""Time a query, without the search cache. Returns a dictionary of the
+	fastest and median times, and the number of results."""
+	if scoped:
+		bookname = searched_index.books[len(searched_index.books) // 2].bookname
+		searchrange = u"%s-%s" % (searched_index.books[0].bookname, bookname)
+	else:
+		searchrange = None
+
+	times = []
+	for x in range(REPEATS):
+		search_cache.clear()
+		taken, (results, maybe_incorrect) = timed(
+			search_query, searched_index, query, proximity,
+			is_word_proximity, searchrange
+		)
+		times.append(taken)
+
+	times.sort()
+	return dict(
+		query=query,
+		results=len(results),
+		fastest=times[0],
+		median=times[len(times) // 2],
+	)
+
+def search_query(searched_index, query, proximity, is_word_proximity,
+		searchrange):
+	stemmer = get_stemmer(searched_index.book.mod)
+	(regexes, excl_regexes), (fields, excl_fields) = separate_words(query,
+		searched_index.statistics["wordlist"],
+		searched_index.statistics["stem_map"], stemmer,
+		cross_verse_search=is_word_proximity or proximity > 1)
+
+	return searched_index.Search(regexes, excl_regexes, fields, excl_fields,
+		proximity=proximity, is_word_proximity=is_word_proximity,
+		searchrange=searchrange)
+
+def measure_text(read_index):
+	"""How many bytes the text of the books takes once it is loaded, and how
+	many it would take as UTF-8"""
+	loaded = utf8 = books_as_str = 0
+	for book in read_index.books:
+		text = book.text
+		loaded += sys.getsizeof(text)
+		if isinstance(text, str):
+			books_as_str += 1
+			utf8 += sys.getsizeof(text)
+		else:
+			utf8 += sys.getsizeof(text.encode("utf8"))
+
+	return dict(
+		books_as_str=books_as_str,
+		loaded=loaded,
+		utf8=utf8,
+	)
+
+def get_module_name(size, strongs):
+	return "Benchmark%s%s" % (size.capitalize(), strongs and "Strongs" or "")
+
+def benchmark(working_directory, module_name, queries):
+	path = working_directory + "/"
+
+	build_time, built_index = timed(index.Index, module_name,
+		progress=lambda x: True)
+	write_time, written = timed(search_utils.WriteIndex, built_index,
+		path=path)
+	del built_index
+
+	open_time, read_index = timed(search_utils.ReadIndex, module_name,
+		path=path)
+
+	def load_books():
+		for book in read_index.books:
+			# these are loaded when they are first used
+			for name in ("text", "index", "postings"):
+				getattr(book, name)
+
+	load_time, loaded = timed(load_books)
+	text_memory = measure_text(read_index)
+
+	query_times = {}
+	for name, query, proximity, is_word_proximity, scoped in queries:
+		query_times[name] = time_query(read_index, query, proximity,
+			is_word_proximity, scoped)
+
+	index_size = os.path.getsize("%s%s.idx" % (path, module_name))
+	search_utils.CloseIndex(module_name, path=path)
+
+	return dict(
+		books=len(read_index.books),
+		build=build_time,
+		write=write_time,
+		index_size=index_size,
+		open=open_time,
+		load=load_time,
+		text_memory=text_memory,
+		queries=query_times,
+	)
+
+def get_commit():
+	try:
+		process = subprocess.Popen(["git", "rev-parse", "HEAD"],
+			stdout=subprocess.PIPE)
+		commit = process.communicate()[0].strip()
+	except OSError:
+		return None
+
+	return commit or None
+
+def main(args):
+	output = None
+	sizes = []
+	module_names = []
+	for arg in args:
+		if arg.startswith("--output="):
+			output = arg[len("--output="):]
+		elif arg.startswith("--module="):
+			module_names.append(arg[len("--module="):])
+		elif arg in SIZES:
+			sizes.append(arg)
+		else:
+			sys.exit("Unknown argument %s" % arg)
+
+	if not sizes and not module_names:
+		sizes = ["small", "medium"]
+
+	for module_name in module_names:
+		if biblemgr.get_module(module_name) is None:
+			sys.exit("Module %s is not installed" % module_name)
+
+	# see the module docstring
+	search_config["index_processes"] = 1
+
+	working_directory = tempfile.mkdtemp(prefix="search_benchmark")
+	try:
+		bibles = []
+		for size in sizes:
+			for strongs in (False, True):
+				verses = make_bible(working_directory,
+					get_module_name(size, strongs), SIZES[size], strongs)
+				bibles.append((size, strongs, verses))
+
+		if bibles:
+			load_modules(working_directory)
+
+		results = []
+		for size, strongs, verses in bibles:
+			queries = QUERIES
+			if strongs:
+				queries = queries + STRONGS_QUERIES
+
+			result = benchmark(working_directory,
+				get_module_name(size, strongs), queries)
+			result.update(size=size, strongs=strongs, verses=verses)
+			results.append(result)
+
+		for module_name in module_names:
+			result = benchmark(working_directory, module_name, QUERIES)
+			result.update(module=module_name)
+			results.append(result)
+
+	finally:
+		shutil.rmtree(working_directory, ignore_errors=True)
+
+	report = dict(
+		commit=get_commit(),
+		time=time.strftime("%Y-%m-%d %H:%M:%S"),
+		python=sys.version.split()[0],
+		search_processes=index.search_processes(),
+		results=results,
+	)
+
+	if output is None:
+		json.dump(report, sys.stdout, indent=1, sort_keys=True)
+		print
+	else:
+		f = open(output, "w")
+		try:
+			json.dump(report, f, indent=1, sort_keys=True)
+		finally:
+			f.close()
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
@@ -0,0 +1,77 @@
+"""A dictionary which only keeps the items used most recently.
+
+>>> cache = LRUCache(2)
+>>> cache["a"] = 1
+>>> cache["b"] = 2
+>>> cache["a"]
+1
+>>> cache["c"] = 3
+>>> sorted(cache.keys())
+['a', 'c']
+>>> cache.get("b") is None
+True
+
+on_evict is called with each item which is pushed out to make room.
+
+>>> evicted = []
+>>> cache = LRUCache(1, on_evict=evicted.append)
+>>> cache["a"] = 1
+>>> cache["b"] = 2
+>>> evicted
+[1]
+"""
+from collections import OrderedDict
+
+class LRUCache(object):
+	def __init__(self, maxsize, on_evict=None):
+		self.maxsize = maxsize
+		self.items = OrderedDict()
+		self.on_evict = on_evict
+
+	def __getitem__(self, key):
+		# move it to the end, as the most recently used
+		value = self.items.pop(key)
+		self.items[key] = value
+		return value
+
+	def get(self, key, default=None):
+		if key not in self.items:
+			return default
+
+		return self[key]
+
+	def __setitem__(self, key, value):
+		self.items.pop(key, None)
+		self.items[key] = value
+		while len(self.items) > max(self.maxsize, 0):
+			key, value = self.items.popitem(last=False)
+			if self.on_evict is not None:
+				self.on_evict(value)
+
+	def __delitem__(self, key):
+		del self.items[key]
+
+	def __contains__(self, key):
+		return key in self.items
+
+	def __len__(self):
+		return len(self.items)
+
+	def keys(self):
+		return self.items.keys()
+
+	def values(self):
+		return self.items.values()
+
+	def remove_if(self, predicate):
+		"""Remove all the items whose key matches predicate"""
+		for key in self.items.keys():
+			if predicate(key):
+				del self.items[key]
+
+	def clear(self):
+		self.items.clear()
+
+if __name__ == '__main__':
+	import doctest
+	doctest.testmod()
@@ -11,61 +11,136 @@ import zipfile
 import gzip
 from configmgr import config_manager
 import util
+from util.debug import dprint, WARNING
+from util.lru_cache import LRUCache
+from util.observerlist import ObserverList
 from swlib import pysw
+from search import index_file
+from search import indexed_text
+from search.postings import build_postings, build_field_postings
 
 
 search_config = config_manager.add_section("Search")
 search_config.add_item("zip_indexes", False, item_type=bool)
 
-def WriteIndex(index, path = config.index_path, progress=util.noop):
-	z = zipfile.ZipFile("%s%s.idx" % (path, index.version), "w",  
-		zipfile.ZIP_DEFLATED)
+# the number of processes to build indexes with. 0 means one per CPU. The
+# default of 1 builds them in process: a pool of workers has to be asked for,
+# as on POSIX its workers are forked with a copy of the wx state, and on
+# Windows a frozen build only starts them because of freeze_support().
+search_config.add_item("index_processes", 1, item_type=int)
+
+# the number of processes to search the books of an index with. 0 means one
+# per CPU. The default of 1 searches in process, for the same reasons as
+# index_processes. The pool is kept between searches and is shut down when
+# biblemgr reloads, when a search is cancelled and before an index file it
+# may have open is replaced (see on_index_file_closing).
+search_config.add_item("search_processes", 1, item_type=int)
+
+# how many searches to keep the results of
+search_config.add_item("search_cache_size", 20, item_type=int)
+
+# how many indexes to keep loaded, so that switching between versions or
+# searching several at once doesn't read them again
+search_config.add_item("index_cache_size", 4, item_type=int)
+
+# how many books of the loaded indexes to keep the text and postings of.
+# The rest are loaded from their index file again when they are searched.
+search_config.add_item("resident_books", index_file.MAX_RESIDENT_BOOKS,
+	item_type=int)
+index_file.resident_books.maxsize = max(search_config["resident_books"], 1)
+
+# results of recent searches: (version, stamp, query) -> {book number: results}
+search_cache = LRUCache(search_config["search_cache_size"])
+
+# indexes which have been read: (path, version) -> (index, stamp of the file
+# it was read from)
+index_cache = LRUCache(search_config["index_cache_size"])
 
-	length = float(len(index.books) + 2)
-	for idx, item in enumerate(index.books):
+# called with the filename of an index file before it is closed so that it
+# can be replaced or deleted, for anything else which may have it open (e.g.
+# the search workers)
+on_index_file_closing = ObserverList()
+
+def InvalidateSearchCache(version):
+	"""Forget the search results for version, as its index has changed"""
+	search_cache.remove_if(lambda key: key[0] == version)
+
+def WriteIndex(index, path = config.index_path, progress=util.noop):
+	def book_progress((bookname, percent)):
 		# two translates in case of dashes
 		bookname_ui = pysw.locale.translate(
 			pysw.locale.translate(
-				item.bookname.encode("utf8")
+				bookname.encode("utf8")
 			)
 		).decode(pysw.locale_encoding)
 		
-		continuing = progress((bookname_ui, 100*idx/length))
-		if not continuing: return
-		
-		z.writestr("books/" + item.bookname.encode("utf8"),
-			cPickle.dumps(item, cPickle.HIGHEST_PROTOCOL)
-		)
-	
-	b = index.books
-	del index.books
+		return progress((bookname_ui, percent))
+
+	InvalidateSearchCache(index.version)
+	ForgetIndex(index.version, path)
+	index_file.write_index(index, "%s%s.idx" % (path, index.version),
+		progress=book_progress)
 
-	index.book_names = [x.bookname for x in b]
+def ReadIndex(version, path = config.index_path):
+	filename = "%s%s.idx" % (path, version)
+	if index_file.is_index_file(filename):
+		return index_file.read_index(filename)
 	
+	# this is an index from before we had our own index format.
+	# Convert it, so that next time we can just map it in
+	index = ReadZipIndex(filename)
+	for book in index.books:
+		if book.get_postings() is None:
+			book.postings = build_postings(book.text)
+
+		if getattr(book, "field_postings", None) is None:
+			book.field_postings = build_field_postings(book.field_data,
+				indexed_text.tokenized_fields())
+
 	try:
-		continuing = progress(("Index", 100*(length-1)/length))	
-		if not continuing: return
-	
-		z.writestr("index", cPickle.dumps(
-			index,
-			cPickle.HIGHEST_PROTOCOL
-		))
-	finally:
-		del index.book_names	
-		index.books = b
+		index_file.write_index(index, filename)
+	except EnvironmentError, e:
+		dprint(WARNING, "Couldn't convert old index", version, e)
 
-	z.close()
+	return index
 
-	#if search_config["zip_indexes"]:
-	#	f = gzip.GzipFile("%s%s.idxz" % (path, index.version), "w",
-	#			compresslevel=5)
-	#else:
-	#	f = open("%s%s.idx" % (path, index.version), "wb")
+def file_stamp(filename):
+	"""Get the (size, modification time) of filename, or None if it doesn't
+	exist"""
+	try:
+		info = os.stat(filename)
+	except OSError:
+		return None
 
-	#cPickle.dump(index, f, cPickle.HIGHEST_PROTOCOL)
+	return info.st_size, info.st_mtime
 
-def ReadIndex(version, path = config.index_path):
-	z = zipfile.ZipFile("%s%s.idx" % (path, version))
+def GetIndex(version, path=config.index_path):
+	"""Get the index for version, reading it if it isn't one of the indexes
+	we have loaded already, or if it has changed since (e.g. it was
+	rebuilt by the index builder)"""
+	filename = "%s%s.idx" % (path, version)
+	cached = index_cache.get((path, version))
+	if cached is not None:
+		index, stamp = cached
+		if stamp is not None and stamp == file_stamp(filename):
+			return index
+
+	stamp = file_stamp(filename)
+	index = ReadIndex(version, path)
+
+	# an old index which has been converted is in a new file now. If it
+	# couldn't be converted, it is still the one we read.
+	index_cache[path, version] = index, index.get_stamp() or stamp
+	return index
+
+def ForgetIndex(version, path=config.index_path):
+	"""Stop keeping the index for version loaded"""
+	if (path, version) in index_cache:
+		del index_cache[path, version]
+
+def ReadZipIndex(filename):
+	"""Read an index in the old format: a zip file of pickled books"""
+	z = zipfile.ZipFile(filename)
 	try:
 	
 		index = cPickle.loads(z.read("index"))
@@ -85,16 +160,21 @@ def ReadIndex(version, path = config.index_path):
 		z.close()
 	
 	return index
-	#if os.path.exists("%s%s.idxz" % (path, version)):
-	#	f = gzip.GzipFile("%s%s.idxz" % (path, version))
-	#else:
-	#	f = open("%s%s.idx" % (path, version), "rb")
-	#
-	#return cPickle.load(f)
 
 def IndexExists(version, path = config.index_path):
 	return os.path.exists("%s%s.idx" % (path, version))
 
+def CloseIndex(version, path=config.index_path):
+	"""Stop using the index file for version, so that it can be replaced or
+	deleted (which windows won't allow while it is mapped in)"""
+	ForgetIndex(version, path)
+	filename = "%s%s.idx" % (path, version)
+	on_index_file_closing(filename)
+	index_file.close_index_file(filename)
+
 def DeleteIndex(version, path=config.index_path):
-	if os.path.exists("%s%s.idx" % (path, version)):
-		os.remove("%s%s.idx" % (path, version))
+	filename = "%s%s.idx" % (path, version)
+	InvalidateSearchCache(version)
+	if os.path.exists(filename):
+		CloseIndex(version, path)
+		os.remove(filename)
@@ -79,6 +79,7 @@ class xrcOptionsPanel(wx.Panel):
         self.proximity = xrc.XRCCTRL(self, "proximity")
         self.proximity_type = xrc.XRCCTRL(self, "proximity_type")
         self.case_sensitive = xrc.XRCCTRL(self, "case_sensitive")
+        self.best_first = xrc.XRCCTRL(self, "best_first")
 
 
 
@@ -154,6 +155,8 @@ def __gettext_strings():
     _("Verses")
     _("Case sensitive")
     _("Match only if case is same")
+    _("Best results first")
+    _("Show the most relevant results first, rather than in order")
     _("Search Options")
     _("Whole &Bible")
     _("&Old Testament")